@@ -28,7 +28,7 @@ c.JupyterHub.services = [
         "name": "Feedback",
         "url": "http://127.0.0.1:10102",
         "command": ["livefeedback-hub"],
-        "environment": {"SERVICE_DB_URL": "sqlite:////srv/jupyterhub/data.db", "PYTHONUNBUFFERED": "1"},
+        "environment": {"SERVICE_DB_URL": "sqlite:////srv/jupyterhub/data.db", "SERVICE_ZIP_STORE": "/srv/jupyterhub/zips", "PYTHONUNBUFFERED": "1"},
         "oauth_no_confirm": True
     },
 ]
@@ -15,10 +15,15 @@ class CoreRequestHandler(RequestHandler):
         self.service = service
         self.log: logging.Logger = service.log
 
+    def on_finish(self):
+        self.service.metrics.request_duration.labels(handler=type(self).__name__, method=self.request.method, code=self.get_status()).observe(self.request.request_time())
+
     def write_error(self, status_code: int, **kwargs: Any) -> None:
         self.set_status(status_code)
         if status_code == 403:
             msg = "Zugriff verweigert!"
+        elif status_code == 400:
+            msg = "Ungültige Anfrage!"
         else:
             msg = "Interner Serverfehler!"
         self.render("error.html", base=self.service.prefix, msg=msg)
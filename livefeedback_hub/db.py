@@ -3,9 +3,9 @@ import enum
 from sqlalchemy import Column
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.schema import Index, UniqueConstraint
 from sqlalchemy.sql.schema import ForeignKey
-from sqlalchemy.types import BLOB, Enum, Integer, String
+from sqlalchemy.types import Boolean, DateTime, Enum, Float, Integer, LargeBinary, String
 
 Base = declarative_base()
 
@@ -16,14 +16,20 @@ class State(enum.Enum):
     ready = 1
     building = 2
     error = 3
+    deleted = 4
+
+
+class JobKind(enum.Enum):
+    grade = 1
+    build = 2
 
 
 class AutograderZip(Base):
     __tablename__ = "autograder_zips"
 
     id = Column(String, primary_key=True)
-    owner = Column(String)
-    data = Column(BLOB)
+    owner = Column(String, index=True)
+    digest = Column(String, index=True)
     description = Column(String)
     state = Column(Enum(State), default=State.building)
     results = relationship("Result")
@@ -34,7 +40,87 @@ class Result(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user = Column(String)
-    assignment = Column(String, ForeignKey("autograder_zips.id"))
+    assignment = Column(String, ForeignKey("autograder_zips.id"), index=True)
     data = Column(String)
+    # Time the graded submission was received
+    received = Column(Float)
 
     __table_args__ = (UniqueConstraint("user", "assignment"),)
+
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+
+
+class RunningJob(Base):
+    __tablename__ = "running_jobs"
+
+    user = Column(String, primary_key=True)
+    started = Column(DateTime)
+
+
+class BacklogEntry(Base):
+    __tablename__ = "backlog"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user = Column(String, index=True)
+    assignment = Column(String)
+    zip_digest = Column(String)
+    notebook = Column(LargeBinary)
+    received = Column(Float)
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(Enum(JobKind))
+    user = Column(String)
+    assignment = Column(String)
+    zip_digest = Column(String)
+    notebook = Column(LargeBinary)
+    update = Column(Boolean, default=False)
+    received = Column(Float)
+    claimed_by = Column(String)
+    claimed_at = Column(DateTime)
+
+
+class ImageUsage(Base):
+    __tablename__ = "image_usage"
+
+    digest = Column(String, primary_key=True)
+    last_used = Column(DateTime)
+
+
+class JobTiming(Base):
+    __tablename__ = "job_timings"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    assignment = Column(String)
+    finished = Column(DateTime)
+    queue = Column(Float)
+    prepare = Column(Float)
+    grading = Column(Float)
+    write = Column(Float)
+
+    # Covers the lookups of the timings of a task
+    __table_args__ = (Index("ix_job_timings_assignment_finished", "assignment", "finished"),)
+
+
+class ResultHistory(Base):
+    """
+    Append-only history of the scores of every graded submission, one row per question
+    """
+    __tablename__ = "result_history"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    assignment = Column(String)
+    user = Column(String)
+    # Seconds since the epoch, integers allow bucketing in SQL on every database
+    graded = Column(Integer)
+    question = Column(String)
+    score = Column(Float)
+
+    __table_args__ = (Index("ix_result_history_assignment_graded", "assignment", "graded"),)
@@ -0,0 +1,28 @@
+from sqlalchemy import text
+
+from livefeedback_hub import core
+
+
+class HealthHandler(core.CoreRequestHandler):
+    """
+    Readiness probe of the service. Reports the service as not ready while it shuts down or if the database is not
+    reachable, so load balancers stop sending requests to this process.
+    """
+
+    def check_xsrf_cookie(self):
+        pass
+
+    async def get(self):
+        status = "ready"
+        if self.service.shutdown_manager.draining:
+            status = "draining"
+        else:
+            try:
+                with self.service.engine.connect() as connection:
+                    connection.execute(text("SELECT 1"))
+            except Exception as e:
+                self.log.warning(f"Database not reachable: {e}")
+                status = "unavailable"
+        if status != "ready":
+            self.set_status(503)
+        await self.finish({"status": status})
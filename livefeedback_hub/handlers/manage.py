@@ -1,34 +1,92 @@
-import shutil
+import datetime
+import math
+import os
 import subprocess
 import tempfile
+import threading
+import time
 import unittest.mock
 import uuid
 import zipfile
 from concurrent.futures.thread import ThreadPoolExecutor
-from io import BytesIO
-from typing import Optional
+from typing import Dict, Optional
 
-import pkg_resources
 from jupyterhub.services.auth import HubOAuthenticated
-from otter.grade import utils
-from python_on_whales import docker
+from sqlalchemy.orm import load_only
 from tornado import web
-from tornado.httputil import HTTPFile
 
 import livefeedback_hub
 from livefeedback_hub import core
-from livefeedback_hub.db import AutograderZip, Result, State
+from livefeedback_hub.db import AutograderZip, ImageUsage, Job, JobKind, JobTiming, Result, ResultHistory, State
 from livefeedback_hub.server import JupyterService
-from livefeedback_hub.helper.misc import calcuate_zip_hash, get_user_hash, teacher_only, delete_docker_image, timeout_injector
+from livefeedback_hub.helper.misc import get_user_hash, teacher_only, delete_docker_image, delete_zip, image_cache_file, image_name, timeout_injector
+from livefeedback_hub.helper.multipart import MultipartSpooler, SpooledFile, UploadError
+from livefeedback_hub.helper.history import submission_activity
+from livefeedback_hub.helper.zip_store import InvalidZipError, environment_digest, validate_autograder_zip
 manage_executor = ThreadPoolExecutor(max_workers=16)
+_image_locks: Dict[str, threading.Lock] = dict()
+_image_locks_mutex = threading.Lock()
 
+BASE_IMAGE = "ucbdsinfra/otter-grader"
+ENVIRONMENT_IMAGE_SUFFIX = "-environment"
+DOCKERFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Dockerfile")
+ENVIRONMENT_DOCKERFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Dockerfile.environment")
 
-def build(service: JupyterService, id: str, zip_file: HTTPFile, update: bool = False):
+
+def environment_image(service: JupyterService, digest: str) -> str:
+    """
+    Tag of the environment image shared by all zip files with the same environment files
+    :param service: a service instance used for accessing the zip store
+    :param digest: the digest of the zip file in the zip store
+    """
+    with open(ENVIRONMENT_DOCKERFILE, "rb") as f:
+        return image_name(environment_digest(service.zip_store.path(digest), salt=BASE_IMAGE.encode('utf-8') + f.read()), suffix=ENVIRONMENT_IMAGE_SUFFIX)
+
+
+def build_image(service: JupyterService, id: str, digest: str):
+    """
+    Builds the docker image (or the local environment) of a zip file unless it already exists
+    :param service: a service instance used for logging
+    :param id: the id of live feedback task
+    :param digest: the digest of the zip file in the zip store
+    """
+    if service.grading_backend == "local":
+        service.local_grader.prepare(digest)
+        return
+
+    from python_on_whales import docker
+
+    base = BASE_IMAGE
+    image = image_name(digest)
+
+    if docker.image.exists(image):
+        service.log.info(f"Image for {id} exists ({image})")
+        return
+    path = service.zip_store.path(digest)
+    environment = environment_image(service, digest)
+    run = timeout_injector(subprocess.run)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with zipfile.ZipFile(path, "r") as zip_ref:
+            zip_ref.extractall(tmp_dir)
+        with unittest.mock.patch("subprocess.run", run):
+            # Zips differing only in tests and support files share the environment image with the installed setup.sh
+            if not docker.image.exists(environment):
+                service.log.info(f"Building new environment image {environment} for {id} using {base} as base image")
+                for line in docker.build(tmp_dir, build_args={"BASE_IMAGE": base}, tags=[environment], file=ENVIRONMENT_DOCKERFILE, load=True, stream_logs=True):
+                    service.log.debug(line)
+            else:
+                service.log.info(f"Reusing environment image {environment} for {id}")
+            for line in docker.build(tmp_dir, build_args={"ENVIRONMENT_IMAGE": environment}, tags=[image], file=DOCKERFILE, load=True, stream_logs=True):
+                service.log.debug(line)
+        service.log.info(f"Building new docker image {image} for {id} completed")
+
+
+def build(service: JupyterService, id: str, digest: str, update: bool = False):
     """
     Builds a docker image from a zip file and optional deletes the old image if requested
     :param service: a service instance used for logging
     :param id: the id of live feedback task
-    :param zip_file: the provided zip file
+    :param digest: the digest of the zip file in the zip store
     :param update: flag indicating whether an update is executed (or a new image was added)
     """
 
@@ -36,54 +94,309 @@ def build(service: JupyterService, id: str, zip_file: HTTPFile, update: bool = F
         item: Optional[AutograderZip] = session.query(AutograderZip).filter_by(id=id).first()
         if item is None:
             return
+        previous = item.digest
+        started = time.time()
         try:
-
-            base = "ucbdsinfra/otter-grader"
             service.log.info(f"Building new docker image for {id}")
-            image = utils.OTTER_DOCKER_IMAGE_TAG + ":" + calcuate_zip_hash(zip_file["body"])
-
-            if update and docker.image.exists(image):
-                service.log.info(f"Image for {id} exists ({image})")
-                item.state = State.ready
-                return
-            dockerfile = pkg_resources.resource_filename("livefeedback_hub.handlers", "Dockerfile")
-
-            if not docker.image.exists(image):
-                with tempfile.TemporaryDirectory() as tmp_dir:
-                    with zipfile.ZipFile(BytesIO(zip_file["body"]), "r") as zip_ref:
-                        zip_ref.extractall(tmp_dir)
-                    shutil.copy(dockerfile, tmp_dir)
-                    service.log.info(f"Building new image for {id} using {base} as base image")
-                    run = timeout_injector(subprocess.run)
-                    with unittest.mock.patch("subprocess.run", run):
-                        for line in docker.build(tmp_dir, build_args={"BASE_IMAGE": base}, tags=[image], file=dockerfile, load=True, stream_logs=True):
-                            service.log.debug(line)
-                    service.log.info(f"Building new docker image {image} for {id} completed")
-
+            build_image(service, id, digest)
+            service.metrics.build_duration.labels(result="ready").observe(time.time() - started)
         except Exception as e:
+            service.metrics.build_duration.labels(result="error").observe(time.time() - started)
             service.log.error(f"Error while building docker image for {id}: {e}")
             item.state = State.error
+            session.commit()
+            if digest != previous:
+                delete_zip(service, session, digest)
             return
 
-        if update and calcuate_zip_hash(zip_file["body"]) != calcuate_zip_hash(item.data):
-            delete_docker_image(service, item)
+        # A new image must not look unused to the image collector before its first submission
+        service.image_collector.touch(digest)
         service.log.info(f"Marking {id} as ready")
-        item.data = zip_file["body"]
+        item.digest = digest
         item.state = State.ready
         session.commit()
+        # The environment image of the previous zip is kept if the new one is based on it
+        if update and previous is not None and digest != previous:
+            delete_docker_image(service, previous)
+        if previous != digest:
+            delete_zip(service, session, previous)
+    export_image(service, digest)
+
+
+def export_image(service: JupyterService, digest: str):
+    """
+    Saves the docker image of a zip file to the image cache unless it is already cached
+    :param service: a service instance used for logging
+    :param digest: the digest of the zip file in the zip store
+    """
+    cached = image_cache_file(service, digest)
+    if cached is None or cached.is_file() or service.grading_backend == "local":
+        return
+    from python_on_whales import docker
+
+    image = image_name(digest)
+    try:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=cached.parent)
+        os.close(fd)
+        try:
+            docker.image.save(image, output=tmp)
+            os.replace(tmp, cached)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        service.log.info(f"Exported docker image {image} to {cached}")
+    except Exception as e:
+        service.log.warning(f"Error while exporting docker image {image}: {e}")
+
+
+def ensure_image(service: JupyterService, id: str, digest: str):
+    """
+    Makes sure the docker image of a zip file exists. Missing images are loaded from the image cache or built again.
+    :param service: a service instance used for logging
+    :param id: the id of live feedback task
+    :param digest: the digest of the zip file in the zip store
+    """
+    if service.grading_backend == "local":
+        service.local_grader.prepare(digest)
+        return
+    from python_on_whales import docker
+
+    image = image_name(digest)
+    with _image_lock(digest):
+        if docker.image.exists(image):
+            return
+        cached = image_cache_file(service, digest)
+        if cached is not None and cached.is_file():
+            try:
+                service.log.info(f"Loading docker image {image} for {id} from {cached}")
+                docker.image.load(str(cached), quiet=True)
+                service.image_collector.touch(digest)
+                return
+            except Exception as e:
+                service.log.warning(f"Error while loading docker image {image}: {e}")
+                cached.unlink()
+        service.log.info(f"Docker image {image} for {id} is missing, building it again")
+        build_image(service, id, digest)
+        service.image_collector.touch(digest)
+    export_image(service, digest)
+
+
+def _image_lock(digest: str) -> threading.Lock:
+    with _image_locks_mutex:
+        return _image_locks.setdefault(digest, threading.Lock())
+
+
+def reconcile_images(service: JupyterService):
+    """
+    Restores the missing images of all ready tasks in the background, e.g. after the docker host was reset. If the
+    image collector limits the disk usage, only images used within image_gc_min_idle seconds are restored, as the
+    collector would keep them anyway. The other images are restored by ensure_image when they are used again.
+    :param service: a service instance used for logging
+    """
+    with service.session() as session:
+        query = session.query(AutograderZip.id, AutograderZip.digest).filter_by(state=State.ready)
+        if service.image_disk_budget > 0 and service.grading_backend == "docker":
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=service.image_gc_min_idle)
+            query = query.join(ImageUsage, ImageUsage.digest == AutograderZip.digest).filter(ImageUsage.last_used >= cutoff)
+        tasks = query.all()
+    service.log.info(f"Checking the images of {len(tasks)} tasks")
+    for id, digest in tasks:
+        manage_executor.submit(_reconcile_image, service, id, digest)
+
+
+def _reconcile_image(service: JupyterService, id: str, digest: str):
+    try:
+        ensure_image(service, id, digest)
+    except Exception as e:
+        service.log.error(f"Error while restoring the image of {id}: {e}")
+        with service.session() as session:
+            session.query(AutograderZip).filter_by(id=id, digest=digest, state=State.ready).update({"state": State.error})
+
+
+def submit_build(service: JupyterService, id: str, digest: str, update: bool = False):
+    """
+    Runs the build in this process or queues it for a grading worker depending on the execution backend
+    """
+    if service.execution_backend == "worker":
+        service.job_queue.put_build(id, digest, update=update)
+    else:
+        # Queued and running builds are checkpointed if the service is stopped before they finish
+        service.shutdown_manager.build_queued(id, digest, update=update)
+        manage_executor.submit(_tracked_build, service, id, digest, update=update)
+
+
+def _tracked_build(service: JupyterService, id: str, digest: str, update: bool = False):
+    try:
+        build(service, id, digest, update=update)
+    finally:
+        service.shutdown_manager.build_finished(id)
+
+
+def delete_task(service: JupyterService, id: str, chunk_size: int = 1000):
+    """
+    Removes the docker image, the results and the zip of a task marked as deleted
+    :param service: a service instance used for logging
+    :param id: the id of live feedback task
+    :param chunk_size: the number of results deleted per transaction
+    """
+    from livefeedback_hub.handlers.submission import process_notebook, submission_executor
+
+    # Queued gradings would write results of the deleted task, running ones are dropped by the result writer
+    for item in submission_executor.find_and_remove(lambda item: item.fn is process_notebook and item.kwargs.get("id") == id):
+        service.result_notifier.notify(item.kwargs["user_hash"], id, None, item.kwargs.get("received"))
+    with service.session() as session:
+        session.query(Job).filter(Job.kind == JobKind.grade, Job.assignment == id, Job.claimed_by.is_(None)).delete(synchronize_session=False)
+
+    with service.session() as session:
+        task: Optional[AutograderZip] = session.query(AutograderZip).filter_by(id=id, state=State.deleted).first()
+        if task is None:
+            return
+        try:
+            livefeedback_hub.helper.misc.delete_docker_image(service, task.digest)
+        except Exception as e:
+            service.log.error(f"Error while deleting docker image of {id}: {e}")
+
+    # Short transactions keep the database available for the results of other tasks
+    deleted = 0
+    for model in [Result, ResultHistory]:
+        while True:
+            with service.session() as session:
+                ids = [row_id for (row_id,) in session.query(model.id).filter_by(assignment=id).limit(chunk_size).all()]
+                if len(ids) == 0:
+                    break
+                session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+                if model is Result:
+                    deleted += len(ids)
+
+    with service.session() as session:
+        task: Optional[AutograderZip] = session.query(AutograderZip).filter_by(id=id, state=State.deleted).first()
+        if task is None:
+            return
+        # Removes results written by gradings which finished during the deletion
+        for model in [Result, ResultHistory, JobTiming]:
+            session.query(model).filter_by(assignment=id).delete(synchronize_session=False)
+        session.delete(task)
+        session.flush()
+        delete_zip(service, session, task.digest)
+    service.log.info(f"Deleted task {id} and {deleted} results")
+
+
+def resume_deletions(service: JupyterService):
+    """
+    Continues deleting the tasks whose deletion was interrupted by a restart
+    :param service: a service instance used for logging
+    """
+    with service.session() as session:
+        ids = [id for (id,) in session.query(AutograderZip.id).filter_by(state=State.deleted).all()]
+    for id in ids:
+        manage_executor.submit(delete_task, service, id)
 
 
 class FeedbackManagementHandler(HubOAuthenticated, core.CoreRequestHandler):
+    """
+    Overview of the tasks of a teacher, overview_page_size tasks per page (?page=)
+    """
+
     @teacher_only
     async def get(self):
         user_hash = get_user_hash(self.get_current_user())
+        try:
+            page = int(self.get_argument("page", "1"))
+        except ValueError:
+            raise web.HTTPError(400)
+        size = self.service.overview_page_size
         with self.service.session() as session:
-            tasks = session.query(AutograderZip).filter_by(owner=user_hash).all()
-            self.log.info(f"Found {len(tasks)} tasks by {user_hash}")
-            await self.render("overview.html", tasks=tasks, base=self.service.prefix)
+            query = session.query(AutograderZip).filter(AutograderZip.owner == user_hash, AutograderZip.state != State.deleted)
+            count = query.count()
+            pages = max(math.ceil(count / size), 1)
+            page = min(max(page, 1), pages)
+            tasks = query.options(load_only(AutograderZip.id, AutograderZip.description, AutograderZip.state)) \
+                .order_by(AutograderZip.description, AutograderZip.id).offset((page - 1) * size).limit(size).all()
+            self.log.info(f"Found {count} tasks by {user_hash}")
+            activity = submission_activity(self.service, [task.id for task in tasks])
+            await self.render("overview.html", tasks=tasks, activity=activity, page=page, pages=pages, base=self.service.prefix)
+
+
+@web.stream_request_body
+class ZipUploadHandler(HubOAuthenticated, core.CoreRequestHandler):
+    """
+    Base class for handlers receiving an autograder zip. The multipart body is parsed while it is received and the
+    zip is spooled to disk instead of being buffered in memory.
+    """
+
+    upload: Optional[MultipartSpooler] = None
+
+    def prepare(self):
+        if self.request.method != "POST":
+            return
+        # Reject uploads before receiving the body
+        if not livefeedback_hub.helper.misc.is_teacher(self.current_user):
+            raise web.HTTPError(403)
+        if self.service.shutdown_manager.draining:
+            raise web.HTTPError(503)
+        content_type = self.request.headers.get("Content-Type", "")
+        fields = dict(field.strip().split("=", 1) for field in content_type.split(";")[1:] if "=" in field)
+        if not content_type.startswith("multipart/form-data") or "boundary" not in fields:
+            raise web.HTTPError(400)
+        if self.request.connection is not None:
+            self.request.connection.set_max_body_size(self.service.max_zip_size + 64 * 1024)
+        boundary = fields["boundary"].strip('"').encode("latin1")
+        self.upload = MultipartSpooler(boundary, self.service.zip_store.spool_dir(), max_file_size=self.service.max_zip_size)
+
+    def data_received(self, chunk: bytes):
+        if self.upload is None:
+            return
+        try:
+            self.upload.feed(chunk)
+        except UploadError as e:
+            self.log.warning(f"Invalid upload: {e}")
+            raise web.HTTPError(400)
+
+    def check_xsrf_cookie(self):
+        # The token is part of the streamed body and is checked in receive_upload
+        if self.request.method != "POST":
+            super().check_xsrf_cookie()
+
+    def receive_upload(self) -> Optional[SpooledFile]:
+        """
+        Completes the upload and checks the xsrf token
+        :return: the spooled zip or None if no zip was uploaded
+        """
+        try:
+            self.upload.finish()
+        except UploadError:
+            raise web.HTTPError(400)
+        for name, values in self.upload.fields.items():
+            self.request.body_arguments.setdefault(name, []).extend(values)
+            self.request.arguments.setdefault(name, []).extend(values)
+        if self.settings.get("xsrf_cookies"):
+            super().check_xsrf_cookie()
+
+        return self.upload.files.get("zip")
+
+    async def validate_upload(self, zip_file: SpooledFile) -> bool:
+        """
+        Validates the uploaded zip and renders an error page for invalid zips
+        :param zip_file: the spooled zip
+        :return: flag indicating whether the zip is valid
+        """
+        try:
+            validate_autograder_zip(zip_file.path, max_size=self.service.max_zip_extracted_size, max_entries=self.service.max_zip_entries)
+        except InvalidZipError as e:
+            self.log.warning(f"Invalid zip file {zip_file.filename}: {e}")
+            self.set_status(400)
+            await self.render("error.html", base=self.service.prefix, msg=f"Ungültige Zip-Datei: {e}")
+            return False
+        return True
+
+    def on_finish(self):
+        super().on_finish()
+        if self.upload is not None:
+            self.upload.cleanup()
 
 
-class FeedbackZipAddHandler(HubOAuthenticated, core.CoreRequestHandler):
+class FeedbackZipAddHandler(ZipUploadHandler):
     @teacher_only
     async def get(self):
         task = AutograderZip()
@@ -92,25 +405,27 @@ class FeedbackZipAddHandler(HubOAuthenticated, core.CoreRequestHandler):
 
     @teacher_only
     async def post(self):
+        zip_file = self.receive_upload()
         user_hash = get_user_hash(self.get_current_user())
         description = self.get_body_argument("description")
-        if "zip" in self.request.files:
-            if self.request.files["zip"][0]:
-                zip_file = self.request.files["zip"][0]
-                self.insert_new_grader(user_hash, zip_file, description)
+        if zip_file is not None:
+            if not await self.validate_upload(zip_file):
+                return
+            self.insert_new_grader(user_hash, zip_file, description)
         self.redirect(self.service.prefix)
 
-    def insert_new_grader(self, user_hash, zip_file, description):
+    def insert_new_grader(self, user_hash, zip_file: SpooledFile, description):
         # Insert zip file into database and build docker image
-        self.log.info(f"Got zip file {zip_file['filename']}")
+        self.log.info(f"Got zip file {zip_file.filename}")
+        digest = self.service.zip_store.put_file(zip_file.path, zip_file.digest)
         with self.service.session() as session:
             # get new uuid
             new_uuid = str(uuid.uuid4())
-            item = AutograderZip(id=new_uuid, owner=user_hash, data=zip_file["body"], description=description,
+            item = AutograderZip(id=new_uuid, owner=user_hash, digest=digest, description=description,
                                  state=State.building)
             session.add(item)
             session.commit()
-            manage_executor.submit(build, self.service, new_uuid, zip_file)
+            submit_build(self.service, new_uuid, digest)
 
 
 class FeedbackZipDeleteHandler(HubOAuthenticated, core.CoreRequestHandler):
@@ -119,7 +434,7 @@ class FeedbackZipDeleteHandler(HubOAuthenticated, core.CoreRequestHandler):
 
         user_hash = get_user_hash(self.get_current_user())
         with self.service.session() as session:
-            task: Optional[AutograderZip] = session.query(AutograderZip).filter_by(id=live_id, owner=user_hash).first()
+            task: Optional[AutograderZip] = session.query(AutograderZip).filter(AutograderZip.id == live_id, AutograderZip.owner == user_hash, AutograderZip.state != State.deleted).first()
             if not task:
                 raise web.HTTPError(403)
             else:
@@ -129,20 +444,20 @@ class FeedbackZipDeleteHandler(HubOAuthenticated, core.CoreRequestHandler):
                     await self.render("error.html", base=self.service.prefix)
                     return
                     # Delete task from database and delete docker image
+                # The task is hidden immediately, the image and the results are removed in the background
                 self.service.log.info(f"Deleting task {live_id}")
-                livefeedback_hub.helper.misc.delete_docker_image(self.service, task)
-                session.delete(task)
-            session.query(Result).filter_by(assignment=live_id).delete()
+                task.state = State.deleted
+        manage_executor.submit(delete_task, self.service, live_id)
         self.redirect(self.service.prefix)
 
 
-class FeedbackZipUpdateHandler(HubOAuthenticated, core.CoreRequestHandler):
+class FeedbackZipUpdateHandler(ZipUploadHandler):
     @teacher_only
     async def get(self, live_id: str):
 
         user_hash = get_user_hash(self.get_current_user())
         with self.service.session() as session:
-            task: Optional[AutograderZip] = session.query(AutograderZip).filter_by(id=live_id, owner=user_hash).first()
+            task: Optional[AutograderZip] = session.query(AutograderZip).filter(AutograderZip.id == live_id, AutograderZip.owner == user_hash, AutograderZip.state != State.deleted).first()
             if not task:
                 raise web.HTTPError(403)
             else:
@@ -153,32 +468,33 @@ class FeedbackZipUpdateHandler(HubOAuthenticated, core.CoreRequestHandler):
 
     @teacher_only
     async def post(self, live_id: str):
-
+        zip_file = self.receive_upload()
         user_hash = get_user_hash(self.get_current_user())
         with self.service.session() as session:
-            task: Optional[AutograderZip] = session.query(AutograderZip).filter_by(id=live_id, owner=user_hash).first()
+            task: Optional[AutograderZip] = session.query(AutograderZip).filter(AutograderZip.id == live_id, AutograderZip.owner == user_hash, AutograderZip.state != State.deleted).first()
             if not task:
                 raise web.HTTPError(403)
             else:
                 if task.state == State.building:
                     await self.render("error.html", base=self.service.prefix)
                     return
+                if zip_file is not None and not await self.validate_upload(zip_file):
+                    return
                 task.description = self.get_body_argument("description")
                 session.commit()
 
-                if "zip" in self.request.files:
-                    if self.request.files["zip"][0]:
-                        zip_file = self.request.files["zip"][0]
-                        self.update_grader(user_hash, live_id, zip_file)
+                if zip_file is not None:
+                    self.update_grader(user_hash, live_id, zip_file)
 
         self.redirect(self.service.prefix)
 
-    def update_grader(self, user_hash, live_id, zip_file):
-        self.log.info(f"Got zip file {zip_file['filename']}")
+    def update_grader(self, user_hash, live_id, zip_file: SpooledFile):
+        self.log.info(f"Got zip file {zip_file.filename}")
+        digest = self.service.zip_store.put_file(zip_file.path, zip_file.digest)
 
         with self.service.session() as session:
-            task: Optional[AutograderZip] = session.query(AutograderZip).filter_by(id=live_id, owner=user_hash).first()
+            task: Optional[AutograderZip] = session.query(AutograderZip).filter(AutograderZip.id == live_id, AutograderZip.owner == user_hash, AutograderZip.state != State.deleted).first()
             # Mark as not ready, rebuild image and mark as ready afterwards
             task.state = State.building
             session.commit()
-            manage_executor.submit(build, self.service, live_id, zip_file, update=True)
+            submit_build(self.service, live_id, digest, update=True)
@@ -0,0 +1,24 @@
+import hmac
+
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from tornado import web
+
+from livefeedback_hub import core
+
+
+class MetricsHandler(core.CoreRequestHandler):
+    """
+    Exports the metrics of the service in the Prometheus text format. If a metrics token is configured, scrapers have
+    to send it as bearer token.
+    """
+
+    def check_xsrf_cookie(self):
+        pass
+
+    async def get(self):
+        token = self.service.metrics_token
+        if token and not hmac.compare_digest(self.request.headers.get("Authorization", ""), f"Bearer {token}"):
+            raise web.HTTPError(403)
+        self.set_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.write(generate_latest(self.service.metrics.registry))
+        await self.finish()
@@ -0,0 +1,40 @@
+from jupyterhub.services.auth import HubOAuthenticated
+from tornado import web
+from tornado.ioloop import IOLoop
+from tornado.web import authenticated
+
+import livefeedback_hub.helper.misc
+from livefeedback_hub import core
+from livefeedback_hub.helper.profiler import ProfilerBusyError, folded
+
+
+class ProfileHandler(HubOAuthenticated, core.CoreRequestHandler):
+    """
+    Records a profile of all threads of the service for ?seconds= (default 10, at most profile_max_duration) and
+    returns it as folded stacks for flame graphs. Threads waiting for work are left out unless ?idle=1 is given.
+    Restricted to teachers and JupyterHub admins.
+    """
+
+    @authenticated
+    async def get(self):
+        user = self.get_current_user()
+        if not (livefeedback_hub.helper.misc.is_teacher(user) or user.get("admin", False)):
+            raise web.HTTPError(403)
+        try:
+            seconds = float(self.get_argument("seconds", "10"))
+            interval = float(self.get_argument("interval", "0.01"))
+        except ValueError:
+            raise web.HTTPError(400)
+        seconds = min(max(seconds, 0.0), self.service.profile_max_duration)
+        interval = min(max(interval, 0.001), 1.0)
+        idle = self.get_argument("idle", "0") == "1"
+
+        self.log.info(f"Recording a profile for {seconds}s")
+        try:
+            # The sampling runs in another thread so the IOLoop keeps serving the requests being profiled
+            stacks = await IOLoop.current().run_in_executor(None, self.service.profiler.profile, seconds, interval, idle)
+        except ProfilerBusyError:
+            raise web.HTTPError(409)
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.set_header("Content-Disposition", 'attachment; filename="profile.folded"')
+        await self.finish(folded(stacks))
@@ -1,14 +1,55 @@
 import io
+import itertools
+import json
 from typing import Optional
 
-import pandas as pd
 from jupyterhub.services.auth import HubOAuthenticated
 from tornado import web
-from tornado.web import authenticated
+from tornado.util import TimeoutError
+from tornado.web import RequestHandler, authenticated
 
 import livefeedback_hub.helper.misc
 from livefeedback_hub import core
-from livefeedback_hub.db import AutograderZip, Result
+from livefeedback_hub.db import AutograderZip, Result, State
+from livefeedback_hub.helper.export import ENCODERS, export_rows
+from livefeedback_hub.helper.history import pass_rates
+from livefeedback_hub.helper.result_notifier import parse_scores
+from livefeedback_hub.helper.timings import stage_percentiles
+
+
+def wait_argument(handler: RequestHandler) -> float:
+    """
+    Reads the wait argument of a request
+    :return: the seconds to wait for a result, limited by result_wait_timeout
+    """
+    try:
+        wait = float(handler.get_argument("wait", "0"))
+    except ValueError:
+        raise web.HTTPError(400)
+    return min(max(wait, 0.0), handler.service.result_wait_timeout)
+
+
+async def wait_for_result(handler: RequestHandler, user_hash: str, live_id: str, since: float, wait: float):
+    """
+    Waits for the result of a submission and writes the scores. Responds with 202 if grading did not finish in time
+    and 204 if grading failed.
+    """
+    try:
+        data = await handler.service.result_notifier.wait(user_hash, live_id, since, timeout=wait)
+    except TimeoutError:
+        handler.set_status(202)
+        await handler.finish()
+        return
+    await write_scores(handler, data)
+
+
+async def write_scores(handler: RequestHandler, data: Optional[str]):
+    if data is None:
+        handler.set_status(204)
+    else:
+        handler.set_header("Content-Type", "application/json")
+        handler.write(json.dumps(parse_scores(data)))
+    await handler.finish()
 
 
 class FeedbackResultsHandler(HubOAuthenticated, core.CoreRequestHandler):
@@ -20,7 +61,7 @@ class FeedbackResultsHandler(HubOAuthenticated, core.CoreRequestHandler):
         user_hash = livefeedback_hub.helper.misc.get_user_hash(self.get_current_user())
 
         with self.service.session() as session:
-            entry: Optional[AutograderZip] = session.query(AutograderZip).filter_by(id=live_id, owner=user_hash).first()
+            entry: Optional[AutograderZip] = session.query(AutograderZip).filter(AutograderZip.id == live_id, AutograderZip.owner == user_hash, AutograderZip.state != State.deleted).first()
             if not entry:
                 raise web.HTTPError(403)
             else:
@@ -36,10 +77,12 @@ class FeedbackResultsApiHandler(HubOAuthenticated, core.CoreRequestHandler):
         user_hash = livefeedback_hub.helper.misc.get_user_hash(self.get_current_user())
 
         with self.service.session() as session:
-            entry: Optional[AutograderZip] = session.query(AutograderZip).filter_by(id=live_id, owner=user_hash).first()
+            entry: Optional[AutograderZip] = session.query(AutograderZip).filter(AutograderZip.id == live_id, AutograderZip.owner == user_hash, AutograderZip.state != State.deleted).first()
             if not entry:
                 raise web.HTTPError(403)
             else:
+                import pandas as pd
+
                 results = session.query(Result).filter_by(assignment=live_id)
                 dataframes = [pd.read_table(io.StringIO(result.data), sep=",") for result in results]
                 if len(dataframes) > 0:
@@ -52,3 +95,122 @@ class FeedbackResultsApiHandler(HubOAuthenticated, core.CoreRequestHandler):
                 else:
                     self.set_status(204)
                 await self.finish()
+
+
+class FeedbackTimingsApiHandler(HubOAuthenticated, core.CoreRequestHandler):
+
+    @authenticated
+    async def get(self, live_id):
+        user_hash = livefeedback_hub.helper.misc.get_user_hash(self.get_current_user())
+
+        with self.service.session() as session:
+            entry: Optional[AutograderZip] = session.query(AutograderZip).filter(AutograderZip.id == live_id, AutograderZip.owner == user_hash, AutograderZip.state != State.deleted).first()
+            if not entry:
+                raise web.HTTPError(403)
+
+        timings = stage_percentiles(self.service, live_id, limit=self.service.timing_window)
+        if timings["count"] == 0:
+            self.set_status(204)
+        else:
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps(timings))
+        await self.finish()
+
+
+class FeedbackHistoryApiHandler(HubOAuthenticated, core.CoreRequestHandler):
+    """
+    Pass rates of the questions of a task per minute over the last window minutes (default 60)
+    """
+
+    @authenticated
+    async def get(self, live_id):
+        user_hash = livefeedback_hub.helper.misc.get_user_hash(self.get_current_user())
+        try:
+            window = int(self.get_argument("window", "60"))
+        except ValueError:
+            raise web.HTTPError(400)
+        window = min(max(window, 1), self.service.history_max_window)
+
+        with self.service.session() as session:
+            entry: Optional[AutograderZip] = session.query(AutograderZip).filter(AutograderZip.id == live_id, AutograderZip.owner == user_hash, AutograderZip.state != State.deleted).first()
+            if not entry:
+                raise web.HTTPError(403)
+
+        buckets = pass_rates(self.service, live_id, window)
+        if len(buckets) == 0:
+            self.set_status(204)
+        else:
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps({"window": window, "buckets": buckets}))
+        await self.finish()
+
+
+class FeedbackUserResultApiHandler(HubOAuthenticated, core.CoreRequestHandler):
+    """
+    Result of the latest submission of the current user. If a submission of the user is still being graded, the
+    request waits up to wait seconds for its result and responds with 202 if it is not finished in time.
+    """
+
+    @authenticated
+    async def get(self, live_id):
+        user_hash = livefeedback_hub.helper.misc.get_user_hash(self.get_current_user())
+        wait = wait_argument(self)
+
+        with self.service.session() as session:
+            if session.query(AutograderZip.id).filter(AutograderZip.id == live_id, AutograderZip.state != State.deleted).first() is None:
+                raise web.HTTPError(403)
+
+        expected = self.service.result_notifier.expected(user_hash, live_id)
+        with self.service.session() as session:
+            row = session.query(Result.data, Result.received).filter_by(user=user_hash, assignment=live_id).first()
+        if expected is not None:
+            if row is None or row.received is None or row.received < expected:
+                await wait_for_result(self, user_hash, live_id, expected, wait)
+                return
+            # Graded by another process, e.g. from a shared backlog
+            self.service.result_notifier.notify(user_hash, live_id, row.data, row.received)
+        await write_scores(self, row.data if row is not None else None)
+
+
+class FeedbackExportApiHandler(HubOAuthenticated, core.CoreRequestHandler):
+    """
+    Streams the scores of all students of a task, or without id of all tasks of the current user, as csv or parquet
+    (?format=parquet). The results are read and sent in chunks, so the memory does not grow with the size of the class.
+    """
+
+    @authenticated
+    async def get(self, live_id: Optional[str] = None):
+        encoder_class = ENCODERS.get(self.get_argument("format", "csv"))
+        if encoder_class is None:
+            raise web.HTTPError(400)
+        user_hash = livefeedback_hub.helper.misc.get_user_hash(self.get_current_user())
+
+        with self.service.session() as session:
+            query = session.query(AutograderZip.id).filter(AutograderZip.owner == user_hash, AutograderZip.state != State.deleted)
+            if live_id is not None:
+                query = query.filter(AutograderZip.id == live_id)
+            ids = [id for id, in query]
+        if live_id is not None and len(ids) == 0:
+            raise web.HTTPError(403)
+
+        try:
+            encoder = encoder_class()
+        except ImportError as e:
+            self.log.error(f"Export format not available: {e}")
+            raise web.HTTPError(501)
+        chunks = export_rows(self.service, ids, chunk_size=self.service.export_chunk_size)
+        try:
+            first = next(chunks, None)
+            if first is None:
+                self.set_status(204)
+                await self.finish()
+                return
+            self.set_header("Content-Type", encoder.content_type)
+            self.set_header("Content-Disposition", f'attachment; filename="results-{live_id or "all"}.{encoder.extension}"')
+            for chunk in itertools.chain([first], chunks):
+                self.write(encoder.encode(chunk))
+                await self.flush()
+            self.write(encoder.close())
+        finally:
+            chunks.close()
+        await self.finish()
@@ -3,65 +3,92 @@ import os
 import re
 import shutil
 import tempfile
-from multiprocessing import Lock
-from typing import Optional, Tuple
+import time
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
 
-import pandas as pd
 from jupyterhub.services.auth import HubOAuthenticated
-from otter.grade import containers, utils
+from tornado import web
 from tornado.web import authenticated
 
 import livefeedback_hub.helper.misc
 from livefeedback_hub import core
-from livefeedback_hub.db import AutograderZip, GUID_REGEX, Result
+from livefeedback_hub.db import AutograderZip, GUID_REGEX, Result, State
+from livefeedback_hub.handlers.manage import ensure_image
+from livefeedback_hub.handlers.results import wait_argument, wait_for_result
+from livefeedback_hub.helper.misc import image_name
+from livefeedback_hub.helper.notebook import strip_notebook
 from livefeedback_hub.helper.temporary_submission import TemporarySubmission
-from livefeedback_hub.helper.unique_action_thread_pool_executor import UniqueActionThreadPoolExecutor
+from livefeedback_hub.helper.unique_action_thread_pool_executor import Priority, UniqueActionThreadPoolExecutor
 from livefeedback_hub.server import JupyterService
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 submission_executor = UniqueActionThreadPoolExecutor(max_workers=16)
-backlog: list[TemporarySubmission] = list()
-running_store = set()
-mutex = Lock()
 
 
-def process_notebook(service: JupyterService, autograder_zip: bytes, notebook: bytes, id: str, user_hash: str):
-    running_store.add(user_hash)
+def process_notebook(service: JupyterService, zip_digest: str, notebook: bytes, id: str, user_hash: str, received: Optional[float] = None):
+    scheduler = service.scheduler
+    submission = TemporarySubmission(notebook=notebook, id=id, user_hash=user_hash, zip_digest=zip_digest, received=received)
+    with scheduler.lock():
+        if not scheduler.start(user_hash):
+            # Another process grades a submission of this student and picks up this one afterwards
+            scheduler.queue(submission)
+            if scheduler.shared and received is not None:
+                service.result_notifier.forget(user_hash, id, received)
+            return
+        service.shutdown_manager.grading_started(submission)
+    started = time.time()
+    timing = {"queue": started - received if received is not None else 0.0}
     tmp_dir = tempfile.mkdtemp()
     fd, path = tempfile.mkstemp(suffix=".ipynb", dir=tmp_dir)
-    cwd = os.getcwd()
     try:
+        with service.session() as session:
+            live = session.query(AutograderZip.id).filter(AutograderZip.id == id, AutograderZip.state != State.deleted).first() is not None
+        if not live:
+            # The task was deleted while the submission was queued, its image must not be built again
+            service.log.info(f"Skipping the submission of {user_hash} for the deleted task {id}")
+            os.close(fd)
+            service.result_notifier.notify(user_hash, id, None, received)
+            return
         with os.fdopen(fd, "wb") as tmp:
             tmp.write(notebook)
             tmp.flush()
 
-        os.chdir(tmp_dir)
         service.log.info(f"Launching otter-grader for {user_hash} and {id}")
-        image = utils.OTTER_DOCKER_IMAGE_TAG + ":" + livefeedback_hub.helper.misc.calcuate_zip_hash(autograder_zip)
-        user_result = containers.grade_assignments(path, image, debug=True, verbose=True)
-        add_or_update_results(service, user_hash, id, user_result)
+        # Restores images removed by the image collector or missing on this docker host
+        ensure_image(service, id, zip_digest)
+        service.image_collector.touch(zip_digest)
+        timing["prepare"] = time.time() - started
+        if service.grading_backend == "local":
+            user_result = service.local_grader.grade(path, zip_digest)
+        else:
+            from otter.grade import containers
+
+            user_result = containers.grade_assignments(path, image_name(zip_digest), debug=True, verbose=True)
+        # Includes the start of the container, which otter does not report separately
+        timing["grading"] = time.time() - started - timing["prepare"]
+        service.metrics.grading_duration.observe(timing["grading"])
+        add_or_update_results(service, user_hash, id, user_result, timing=timing, received=received)
         service.log.info(f"Grading complete for {user_hash} and {id}")
     except Exception as e:
         service.log.exception(e)
+        service.result_notifier.notify(user_hash, id, None, received)
     finally:
-        os.chdir(cwd)
         shutil.rmtree(tmp_dir)
-        with mutex:
-            running_store.remove(user_hash)
-            items = [x for x in backlog if x.user_hash == user_hash]
-            if len(items) > 0:
-                item = items[0]
-                submission_executor.submit(process_notebook, service=service, autograder_zip=item.autograder_zip, notebook=item.notebook, id=item.id, user_hash=item.user_hash)
-                backlog.remove(item)
-
-
-def add_or_update_results(service, user_hash, assignment_id, user_result: pd.DataFrame):
-    with service.session() as session:
-        existing: Optional[Result] = session.query(Result).filter_by(assignment=assignment_id, user=user_hash).first()
-        if existing:
-            existing.data = user_result.to_csv(index=False)
-        else:
-            result = Result(user=user_hash, assignment=assignment_id, data=user_result.to_csv(index=False))
-            session.add(result)
+        with scheduler.lock():
+            scheduler.finish(user_hash)
+            item = scheduler.pop(user_hash)
+            if item is not None:
+                submission_executor.submit(process_notebook, service=service, zip_digest=item.zip_digest, notebook=item.notebook, id=item.id, user_hash=item.user_hash,
+                                           received=item.received)
+            service.shutdown_manager.grading_finished(user_hash, id)
+
+
+def add_or_update_results(service: JupyterService, user_hash, assignment_id, user_result: "pd.DataFrame", timing: Optional[Dict[str, float]] = None,
+                          received: Optional[float] = None):
+    # Results are written in batches by the result writer to avoid concurrent writers
+    service.result_writer.put(user_hash, assignment_id, user_result.to_csv(index=False), timing=timing, received=received)
 
 
 class FeedbackSubmissionHandler(HubOAuthenticated, core.CoreRequestHandler):
@@ -79,7 +106,7 @@ class FeedbackSubmissionHandler(HubOAuthenticated, core.CoreRequestHandler):
             return match.group(1)
         return None
 
-    def _get_autograding_zip(self, nb) -> Tuple[Optional[str], Optional[bytes]]:
+    def _get_autograding_zip(self, nb) -> Tuple[Optional[str], Optional[str]]:
         cells = [cell["source"] for cell in nb["cells"]]
         pattern = self._create_pattern()
         live_ids = [self._check_line(pattern, line) for item in cells for line in item.split("\n") if self._check_line(pattern, line)]
@@ -91,28 +118,49 @@ class FeedbackSubmissionHandler(HubOAuthenticated, core.CoreRequestHandler):
         live_id = live_ids[0]
         self.log.info("Searching for grading zip with id %s", live_id)
         with self.service.session() as session:
-            entry: Optional[AutograderZip] = session.query(AutograderZip).filter_by(id=live_id).first()
-            if entry:
+            digest: Optional[str] = session.query(AutograderZip.digest).filter(AutograderZip.id == live_id, AutograderZip.state != State.deleted).scalar()
+            if digest:
                 self.log.info("Found grading zip for %s", live_id)
-                return (live_id, entry.data)
+                return (live_id, digest)
 
         return None, None
 
+    def _priority(self, user_hash: str, id: str) -> Priority:
+        """
+        Submissions of the owner or of teachers (e.g. testing a new task) are graded first, followed by the first
+        submission of a student and finally resubmissions
+        """
+        if livefeedback_hub.helper.misc.is_teacher(self.get_current_user()):
+            return Priority.owner
+        with self.service.session() as session:
+            if session.query(AutograderZip.id).filter_by(id=id, owner=user_hash).first() is not None:
+                return Priority.owner
+            if session.query(Result.id).filter_by(user=user_hash, assignment=id).first() is None:
+                return Priority.first
+        return Priority.resubmission
+
     @authenticated
     async def post(self):
+        if self.service.shutdown_manager.draining:
+            # The client submits again to another instance or after the restart
+            raise web.HTTPError(503)
         self.log.info("Handing live feedback submission")
+        received = time.time()
         try:
             nb = json.loads(self.request.body.decode("utf-8"))
         except Exception:
             self.set_status(400)
             return
-        id, autograder_zip = self._get_autograding_zip(nb)
+        wait = wait_argument(self)
+        id, zip_digest = self._get_autograding_zip(nb)
 
-        if autograder_zip is None:
+        if zip_digest is None:
             await self.finish()
             return
 
         user_hash = livefeedback_hub.helper.misc.get_user_hash(self.get_current_user())
+        # Outputs are dropped before the notebook is queued, otter executes the notebook again anyway
+        notebook = json.dumps(nb).encode("utf-8") if strip_notebook(nb) else self.request.body
 
         def search_same_id(args):
             if args.kwargs["user_hash"] == user_hash and args.kwargs["id"] == id:
@@ -126,22 +174,37 @@ class FeedbackSubmissionHandler(HubOAuthenticated, core.CoreRequestHandler):
             else:
                 return False
 
-        with mutex:
+        if self.service.execution_backend == "worker":
+            # A grading worker picks up the submission, its result is not notified to this process
+            self.service.job_queue.put_grading(user_hash, id, zip_digest, notebook, received=received)
+            if wait > 0:
+                self.set_status(202)
+            await self.finish()
+            return
+
+        priority = self._priority(user_hash, id)
+        scheduler = self.service.scheduler
+        notifier = self.service.result_notifier
+        with scheduler.lock():
 
             def queue_backlog():
-                matches = [x for x in backlog if x.user_hash == user_hash and x.id == id]
-                if len(matches) > 0:
-                    match = matches[0]
-                    backlog.remove(match)
-                backlog.append(TemporarySubmission(notebook=self.request.body, id=id, user_hash=user_hash, autograder_zip=autograder_zip))
+                # Only submissions graded by this process are expected, others may pick up a shared backlog
+                if not scheduler.shared:
+                    notifier.expect(user_hash, id, received)
+                scheduler.queue(TemporarySubmission(notebook=notebook, id=id, user_hash=user_hash, zip_digest=zip_digest, received=received))
 
-            if user_hash in running_store:
+            if scheduler.is_running(user_hash):
                 queue_backlog()
             else:
                 item = submission_executor.find(search_same_user)
                 if item is None or (item is not None and item.kwargs["id"] == id):
                     submission_executor.find_and_remove(search_same_id)
-                    submission_executor.submit(process_notebook, service=self.service, autograder_zip=autograder_zip, notebook=self.request.body, id=id, user_hash=user_hash)
+                    notifier.expect(user_hash, id, received)
+                    submission_executor.submit(process_notebook, service=self.service, zip_digest=zip_digest, notebook=notebook, id=id, user_hash=user_hash,
+                                               received=received, priority=priority)
                 else:
                     queue_backlog()
+        if wait > 0:
+            await wait_for_result(self, user_hash, id, received, wait)
+            return
         await self.finish()
@@ -0,0 +1,117 @@
+import csv
+import io
+from typing import Iterator, List, Tuple
+
+from livefeedback_hub.db import Result
+from livefeedback_hub.helper.result_notifier import parse_scores
+
+COLUMNS = ["assignment", "user", "question", "score"]
+
+Row = Tuple[str, str, str, float]
+
+
+def export_rows(service, assignment_ids: List[str], chunk_size: int = 1000) -> Iterator[List[Row]]:
+    """
+    Reads the results of the tasks with a server-side cursor and converts them to one row per question, so the export
+    has the same columns for all tasks
+    :param service: a service instance used for database access
+    :param assignment_ids: the ids of the exported tasks
+    :param chunk_size: the number of results fetched at once
+    :return: the rows in chunks of the results of at most chunk_size students
+    """
+    with service.session() as session:
+        query = session.query(Result.assignment, Result.user, Result.data).filter(Result.assignment.in_(assignment_ids)).order_by(Result.assignment, Result.id)
+        chunk: List[Row] = []
+        results = 0
+        for assignment, user, data in query.execution_options(stream_results=True).yield_per(chunk_size):
+            try:
+                scores = parse_scores(data)
+            except ValueError:
+                continue
+            chunk.extend((assignment, user, question, score) for question, score in scores.items())
+            results += 1
+            if results >= chunk_size and chunk:
+                yield chunk
+                chunk, results = [], 0
+        if chunk:
+            yield chunk
+
+
+class CsvEncoder:
+    content_type = "text/csv"
+    extension = "csv"
+
+    def __init__(self):
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._writer.writerow(COLUMNS)
+
+    def _take(self) -> bytes:
+        data = self._buffer.getvalue().encode("utf-8")
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+    def encode(self, rows: List[Row]) -> bytes:
+        self._writer.writerows(rows)
+        return self._take()
+
+    def close(self) -> bytes:
+        return self._take()
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    Write-only file collecting the bytes written by the parquet writer until they are sent
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ParquetEncoder:
+    """
+    Writes every chunk as a row group of the parquet file, requires pyarrow
+    """
+    content_type = "application/vnd.apache.parquet"
+    extension = "parquet"
+
+    def __init__(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._schema = pa.schema([("assignment", pa.string()), ("user", pa.string()), ("question", pa.string()), ("score", pa.float64())])
+        self._sink = _ChunkSink()
+        self._writer = pq.ParquetWriter(self._sink, self._schema)
+
+    def encode(self, rows: List[Row]) -> bytes:
+        columns = list(zip(*rows))
+        self._writer.write_table(self._pa.Table.from_arrays([self._pa.array(column, type=field.type) for column, field in zip(columns, self._schema)],
+                                                            schema=self._schema))
+        return self._sink.take()
+
+    def close(self) -> bytes:
+        self._writer.close()
+        return self._sink.take()
+
+
+ENCODERS = {"csv": CsvEncoder, "parquet": ParquetEncoder}
@@ -0,0 +1,54 @@
+import datetime
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import case, func
+
+from livefeedback_hub.db import ResultHistory
+
+BUCKET = 60
+
+
+def pass_rates(service, assignment_id: str, window: int, now: Optional[float] = None) -> List[Dict[str, object]]:
+    """
+    Calculates the share of submissions passing every question per minute. The aggregation runs in the database using
+    the index on the task and the time of grading.
+    :param service: a service instance used for accessing the database
+    :param assignment_id: the id of the live feedback task
+    :param window: the number of minutes to consider
+    :param now: the end of the window in seconds since the epoch, defaults to the current time
+    :return: the buckets ordered by time, each with its start and the number of submissions, the pass rate and the mean
+             score of every question
+    """
+    now = time.time() if now is None else now
+    start = int(now) - window * BUCKET
+    minute = (ResultHistory.graded - ResultHistory.graded % BUCKET).label("minute")
+    with service.session() as session:
+        rows = session.query(minute, ResultHistory.question, func.count(), func.sum(case((ResultHistory.score > 0, 1), else_=0)), func.avg(ResultHistory.score)) \
+            .filter(ResultHistory.assignment == assignment_id, ResultHistory.graded >= start) \
+            .group_by(minute, ResultHistory.question) \
+            .order_by(minute, ResultHistory.question).all()
+
+    buckets: Dict[int, Dict[str, object]] = dict()
+    for bucket, question, submissions, passed, score in rows:
+        entry = buckets.setdefault(bucket, {"start": bucket, "questions": dict()})
+        entry["questions"][question] = {"submissions": submissions, "passed": passed / submissions, "score": score}
+    return list(buckets.values())
+
+
+def submission_activity(service, assignment_ids: List[str]) -> Dict[str, Tuple[int, Optional[datetime.datetime]]]:
+    """
+    Counts the graded submissions of tasks recorded in the result history and finds the latest one in a single grouped
+    query. Submissions without scores (e.g. failed gradings) are not part of the history and not counted.
+    :param service: a service instance used for accessing the database
+    :param assignment_ids: the ids of the live feedback tasks
+    :return: the number of graded submissions and the time the latest one was graded (UTC) for every task with submissions
+    """
+    if len(assignment_ids) == 0:
+        return dict()
+    with service.session() as session:
+        # Every submission has one history entry per question, all graded at the same time
+        submissions = session.query(ResultHistory.assignment, ResultHistory.user, ResultHistory.graded) \
+            .filter(ResultHistory.assignment.in_(assignment_ids)).distinct().subquery()
+        rows = session.query(submissions.c.assignment, func.count(), func.max(submissions.c.graded)).group_by(submissions.c.assignment).all()
+    return {assignment: (count, datetime.datetime.utcfromtimestamp(graded)) for assignment, count, graded in rows}
@@ -0,0 +1,150 @@
+import datetime
+import threading
+from typing import Dict, List, Optional
+
+from livefeedback_hub.db import AutograderZip, ImageUsage, State
+
+
+class ImageCollector:
+    """
+    Removes the least recently used autograder images when the images of the docker host exceed the disk budget.
+    The last use of every image is recorded when it is built, restored or used by process_notebook and stored in the
+    database, images without a recorded use count as used when they were created. Images used within min_idle seconds
+    and images of tasks being built are kept, removed images are built again on their next use.
+    """
+
+    def __init__(self, service, budget: int, interval: float = 300, min_idle: int = 3600):
+        self.service = service
+        self.budget = budget
+        self.interval = interval
+        self.min_idle = min_idle
+        self._used: Dict[str, datetime.datetime] = dict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="image-collector", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def touch(self, digest: str):
+        """
+        Records the use of the image of a zip file
+        :param digest: the digest of the zip file
+        """
+        with self._lock:
+            self._used[digest] = datetime.datetime.utcnow()
+
+    def flush(self):
+        """
+        Writes the recorded uses to the database
+        """
+        with self._lock:
+            used, self._used = self._used, dict()
+        if len(used) == 0:
+            return
+        try:
+            with self.service.session() as session:
+                for digest, last_used in used.items():
+                    usage: Optional[ImageUsage] = session.query(ImageUsage).get(digest)
+                    if usage is None:
+                        session.add(ImageUsage(digest=digest, last_used=last_used))
+                    elif usage.last_used < last_used:
+                        usage.last_used = last_used
+        except Exception as e:
+            self.service.log.warning(f"Error while recording the use of {len(used)} images: {e}")
+
+    def usage(self) -> int:
+        """
+        :return: the disk space used by all images of the docker host in bytes
+        """
+        from python_on_whales import docker
+
+        return docker.system.disk_free().images.size
+
+    def collect(self) -> List[str]:
+        """
+        Removes images until the disk budget is met
+        :return: the digests of the removed images
+        """
+        from python_on_whales import docker
+
+        from livefeedback_hub.handlers.manage import environment_image
+        from livefeedback_hub.helper.misc import image_name
+
+        self.flush()
+        if self.budget <= 0:
+            return []
+        size = self.usage()
+        if size <= self.budget:
+            return []
+
+        prefix = image_name("")
+        created = {tag[len(prefix):]: _utc(image.created) for image in docker.image.list() for tag in image.repo_tags if tag.startswith(prefix)}
+        images = set(created)
+        with self.service.session() as session:
+            last_used = dict(session.query(ImageUsage.digest, ImageUsage.last_used).all())
+            building = {digest for (digest,) in session.query(AutograderZip.digest).filter_by(state=State.building)}
+        # Images built or restored before their use was recorded must not look like the oldest ones
+        for digest in images:
+            last_used.setdefault(digest, created[digest])
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.min_idle)
+        candidates = [digest for digest in images if digest not in building and last_used[digest] < cutoff]
+        candidates.sort(key=lambda digest: last_used[digest])
+
+        environments = dict()
+        for digest in images:
+            if self.service.zip_store.exists(digest):
+                environments[digest] = environment_image(self.service, digest)
+
+        removed = []
+        for digest in candidates:
+            if size <= self.budget:
+                break
+            self.service.log.info(f"Removing image {prefix}{digest} last used at {last_used.get(digest)}")
+            self._remove(prefix + digest)
+            removed.append(digest)
+            environment = environments.pop(digest, None)
+            # The environment image is only kept while another image uses it
+            if environment is not None and environment not in environments.values():
+                self._remove(environment)
+            size = self.usage()
+        self.service.log.info(f"Removed {len(removed)} images, images use {size} of {self.budget} bytes")
+        return removed
+
+    def _remove(self, image: str):
+        from python_on_whales import docker
+        from python_on_whales.exceptions import NoSuchImage
+
+        try:
+            docker.image.remove(image, force=True)
+        except NoSuchImage:
+            pass
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.collect()
+            except Exception as e:
+                self.service.log.error(f"Error while removing unused images: {e}")
+
+
+def _utc(value: Optional[datetime.datetime]) -> datetime.datetime:
+    """
+    Converts the creation time reported by docker to the naive UTC times stored in the database
+    """
+    if not isinstance(value, datetime.datetime):
+        return datetime.datetime.utcnow()
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
@@ -0,0 +1,72 @@
+import datetime
+from typing import Iterable, Optional
+
+from livefeedback_hub.db import Job, JobKind
+
+
+class JobQueue:
+    """
+    Queue of grading and build jobs in the service database. Jobs are added by the web processes and claimed by the
+    worker processes. Workers refresh the claims of their running jobs with heartbeat(), claims which were not refreshed
+    within stale_timeout seconds belong to crashed workers and are released.
+    """
+
+    def __init__(self, service, stale_timeout: int = 900):
+        self.service = service
+        self.stale_timeout = stale_timeout
+
+    def put_grading(self, user_hash: str, assignment_id: str, zip_digest: str, notebook: bytes, received: Optional[float] = None):
+        """
+        Adds a grading job replacing a not yet claimed job of the same student and task
+        """
+        with self.service.session() as session:
+            session.query(Job).filter(Job.kind == JobKind.grade, Job.user == user_hash, Job.assignment == assignment_id, Job.claimed_by.is_(None)).delete(synchronize_session=False)
+            session.add(Job(kind=JobKind.grade, user=user_hash, assignment=assignment_id, zip_digest=zip_digest, notebook=notebook, received=received))
+
+    def put_build(self, assignment_id: str, zip_digest: str, update: bool = False):
+        with self.service.session() as session:
+            session.add(Job(kind=JobKind.build, assignment=assignment_id, zip_digest=zip_digest, update=update))
+
+    def claim(self, worker_id: str) -> Optional[Job]:
+        """
+        Claims the oldest unclaimed job
+        :param worker_id: an identifier of the claiming worker
+        :return: the detached job or None if no job is available
+        """
+        now = datetime.datetime.utcnow()
+        cutoff = now - datetime.timedelta(seconds=self.stale_timeout)
+        with self.service.session() as session:
+            session.query(Job).filter(Job.claimed_by.isnot(None), Job.claimed_at < cutoff).update({"claimed_by": None, "claimed_at": None}, synchronize_session=False)
+
+        while True:
+            with self.service.session() as session:
+                candidate = session.query(Job.id).filter(Job.claimed_by.is_(None)).order_by(Job.id).first()
+                if candidate is None:
+                    return None
+                # Another worker may claim the same job in the meantime, so the claim is only valid if a row was updated
+                claimed = session.query(Job).filter(Job.id == candidate.id, Job.claimed_by.is_(None)).update({"claimed_by": worker_id, "claimed_at": now}, synchronize_session=False)
+                if claimed == 1:
+                    job = session.query(Job).filter_by(id=candidate.id).one()
+                    session.expunge(job)
+                    return job
+
+    def heartbeat(self, worker_id: str, job_ids: Iterable[int]) -> int:
+        """
+        Refreshes the claims of running jobs, so long builds and gradings are not claimed by another worker
+        :param worker_id: the identifier of the claiming worker
+        :param job_ids: the ids of the jobs still running
+        :return: the number of refreshed claims
+        """
+        job_ids = list(job_ids)
+        if not job_ids:
+            return 0
+        with self.service.session() as session:
+            return session.query(Job).filter(Job.id.in_(job_ids), Job.claimed_by == worker_id).update({"claimed_at": datetime.datetime.utcnow()}, synchronize_session=False)
+
+    def complete(self, job_id: int):
+        with self.service.session() as session:
+            session.query(Job).filter_by(id=job_id).delete(synchronize_session=False)
+
+    def size(self) -> int:
+        with self.service.session() as session:
+            return session.query(Job).count()
@@ -0,0 +1,167 @@
+import multiprocessing
+import os
+import pathlib
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import zipfile
+from typing import Dict, Optional
+
+from livefeedback_hub.helper.zip_store import environment_digest
+
+# Modules imported once by the fork server instead of by every grading process
+PRELOAD = ["otter.run.run_autograder", "pandas"]
+
+
+def _run_autograder(autograder_dir: str, packages: Optional[str]):
+    """
+    Entry point of the grading processes
+    :param autograder_dir: directory with the layout of /autograder in the grading images
+    :param packages: directory with the packages of the task or None
+    """
+    if packages is not None:
+        sys.path.insert(0, packages)
+    from otter.run.run_autograder import main
+
+    main(autograder_dir)
+
+
+class LocalGrader:
+    """
+    Grades submissions in local processes instead of docker containers. The processes are forked from a fork server
+    which has otter already imported, and every task has a cached environment with its extracted zip and the packages
+    of its requirements.txt, which are shared by zips with the same environment. setup.sh is not executed.
+    Submissions are not isolated from the service, so this is only suited for trusted deployments.
+    """
+
+    def __init__(self, service, root, timeout: int = 300):
+        self.service = service
+        self.root = pathlib.Path(root)
+        self.timeout = timeout
+        self._context = None
+        self._mutex = threading.Lock()
+        self._locks: Dict[str, threading.Lock] = dict()
+
+    def start(self):
+        """
+        Starts the fork server so the first submission does not wait for otter being imported
+        """
+        with self._mutex:
+            if self._context is not None:
+                return
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(PRELOAD)
+            from multiprocessing import forkserver
+
+            forkserver.ensure_running()
+            self._context = context
+
+    def path(self, digest: str) -> pathlib.Path:
+        return self.root / digest
+
+    def _lock(self, digest: str) -> threading.Lock:
+        with self._mutex:
+            return self._locks.setdefault(digest, threading.Lock())
+
+    def prepare(self, digest: str) -> pathlib.Path:
+        """
+        Creates the environment of a zip file unless it already exists
+        :param digest: the digest of the zip file in the zip store
+        :return: the path of the environment
+        """
+        env = self.path(digest)
+        with self._lock(digest):
+            if env.is_dir():
+                return env
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp = pathlib.Path(tempfile.mkdtemp(suffix=".tmp", dir=self.root))
+            try:
+                with zipfile.ZipFile(self.service.zip_store.path(digest), "r") as zip_ref:
+                    zip_ref.extractall(tmp / "source")
+                requirements = tmp / "source" / "requirements.txt"
+                if requirements.is_file():
+                    packages = self._install(requirements, environment_digest(self.service.zip_store.path(digest)))
+                    os.symlink(packages, tmp / "packages")
+                os.rename(tmp, env)
+            except OSError:
+                # Another process created the environment in the meantime
+                shutil.rmtree(tmp, ignore_errors=True)
+                if not env.is_dir():
+                    raise
+            except Exception:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+        self.service.log.info(f"Environment for {digest} created")
+        return env
+
+    def _install(self, requirements: pathlib.Path, key: str) -> pathlib.Path:
+        """
+        Installs the requirements of a zip unless a zip with the same environment was installed before
+        :param requirements: the path of requirements.txt
+        :param key: the environment digest of the zip
+        :return: the directory containing the packages
+        """
+        packages = self.root / "packages" / key
+        with self._lock(key):
+            if packages.is_dir():
+                return packages
+            packages.parent.mkdir(parents=True, exist_ok=True)
+            tmp = pathlib.Path(tempfile.mkdtemp(suffix=".tmp", dir=packages.parent))
+            try:
+                self.service.log.info(f"Installing requirements of environment {key}")
+                subprocess.run([sys.executable, "-m", "pip", "install", "--quiet", "--target", str(tmp), "-r", str(requirements)], check=True, timeout=600)
+                os.rename(tmp, packages)
+            except OSError:
+                shutil.rmtree(tmp, ignore_errors=True)
+                if not packages.is_dir():
+                    raise
+            except Exception:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+        return packages
+
+    def remove(self, digest: str):
+        self.service.log.info(f"Deleting environment {digest}")
+        shutil.rmtree(self.path(digest), ignore_errors=True)
+
+    def grade(self, submission_path, digest: str):
+        """
+        Grades a notebook using the environment of a zip file
+        :param submission_path: path to the notebook
+        :param digest: the digest of the zip file in the zip store
+        :return: a dataframe with the scores like containers.grade_assignments
+        """
+        import pandas as pd
+
+        env = self.prepare(digest)
+        self.start()
+        job_dir = pathlib.Path(tempfile.mkdtemp())
+        try:
+            os.symlink(env / "source", job_dir / "source")
+            (job_dir / "submission").mkdir()
+            (job_dir / "results").mkdir()
+            shutil.copy(submission_path, job_dir / "submission")
+            packages = env / "packages"
+
+            process = self._context.Process(target=_run_autograder, args=(str(job_dir), str(packages) if packages.is_dir() else None), daemon=True)
+            process.start()
+            process.join(self.timeout)
+            if process.is_alive():
+                process.kill()
+                process.join()
+                raise Exception(f"Grading '{submission_path}' timed out after {self.timeout} seconds")
+            if process.exitcode != 0:
+                raise Exception(f"Grading '{submission_path}' failed! Exit code: {process.exitcode}")
+
+            with open(job_dir / "results" / "results.pkl", "rb") as f:
+                scores = pickle.load(f)
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+        scores = scores.to_dict()
+        scores = {t: [scores[t]["score"]] if isinstance(scores[t], dict) else scores[t] for t in scores}
+        scores["file"] = os.path.basename(submission_path)
+        return pd.DataFrame(scores)
@@ -0,0 +1,71 @@
+import time
+
+from prometheus_client import CollectorRegistry, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class _StateCollector:
+    """
+    Collects the gauges describing the current load when the metrics are scraped
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    def collect(self):
+        from livefeedback_hub.handlers.manage import manage_executor
+        from livefeedback_hub.handlers.submission import submission_executor
+
+        queue = GaugeMetricFamily("livefeedback_executor_queue_depth", "Number of jobs waiting for a thread of an executor", labels=["executor"])
+        queue.add_metric(["submission"], submission_executor._work_queue.qsize())
+        queue.add_metric(["manage"], manage_executor._work_queue.qsize())
+        yield queue
+
+        try:
+            scheduler = self.service.scheduler
+            backlog, running, jobs = scheduler.backlog_size(), scheduler.running_count(), self.service.job_queue.size()
+        except Exception as e:
+            self.service.log.warning(f"Error while collecting metrics: {e}")
+            return
+        yield GaugeMetricFamily("livefeedback_backlog_size", "Number of submissions waiting for a running job of the same student", value=backlog)
+        yield GaugeMetricFamily("livefeedback_running_jobs", "Number of running grading jobs", value=running)
+        yield GaugeMetricFamily("livefeedback_job_queue_size", "Number of jobs queued for grading workers", value=jobs)
+
+
+class ServiceMetrics:
+    """
+    Prometheus metrics of a service instance. Every instance uses its own registry, so the metrics of JupyterHub
+    in the default registry are not exported.
+    """
+
+    def __init__(self, service):
+        self.registry = CollectorRegistry()
+        self.grading_duration = Histogram("livefeedback_grading_duration_seconds", "Duration of grading a submission", registry=self.registry,
+                                          buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600))
+        self.build_duration = Histogram("livefeedback_build_duration_seconds", "Duration of building the image of a task", ["result"],
+                                        registry=self.registry, buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200))
+        self.db_query_duration = Histogram("livefeedback_db_query_duration_seconds", "Duration of database queries", registry=self.registry,
+                                           buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+        self.request_duration = Histogram("livefeedback_request_duration_seconds", "Duration of HTTP requests", ["handler", "method", "code"],
+                                          registry=self.registry)
+        self.registry.register(_StateCollector(service))
+
+    def instrument_engine(self, engine: Engine):
+        """
+        Records the duration of all queries executed by the engine
+        """
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            self.db_query_duration.observe(time.perf_counter() - conn.info["query_start"].pop())
+
+        @event.listens_for(engine, "handle_error")
+        def handle_error(context):
+            if context.connection is not None and context.connection.info.get("query_start"):
+                context.connection.info["query_start"].pop()
@@ -1,26 +1,36 @@
-import os
 import functools
 import hashlib
-from typing import Awaitable, Callable, Optional
+import pathlib
+import zipfile
+from typing import Awaitable, Callable, Collection, Optional
 
-from otter.grade import utils
-from python_on_whales import docker
-from python_on_whales.exceptions import NoSuchImage
+from sqlalchemy.orm import Session
 from tornado.web import HTTPError, RequestHandler, authenticated
 
-from livefeedback_hub.db import AutograderZip
+from livefeedback_hub.db import AutograderZip, State
+from livefeedback_hub.helper.teacher_roster import TeacherRoster
 from livefeedback_hub.server import JupyterService
 
 
-def teachers():
-    with open(os.getenv("FEEDBACK_TEACHERS"), 'r') as f:
-        return [line.strip() for line in f.readlines()]
+roster = TeacherRoster()
+
+
+def teachers() -> Collection[str]:
+    return roster.members()
+
+
+def is_teacher(user_model) -> bool:
+    if user_model is None:
+        return False
+    if roster.group and roster.group in (user_model.get("groups") or []):
+        return True
+    return user_model["name"] in teachers()
 
 
 def teacher_only(method: Callable[..., Optional[Awaitable[None]]]) -> Callable[..., Optional[Awaitable[None]]]:
     @functools.wraps(method)
     def wrapper(self: RequestHandler, *args, **kwargs) -> Optional[Awaitable[None]]:
-        if self.current_user['name'] not in teachers():
+        if not is_teacher(self.current_user):
             raise HTTPError(403)
         return method(self, *args, **kwargs)
 
@@ -41,21 +51,96 @@ def calcuate_zip_hash(data: bytes):
     return zip_hash
 
 
-def delete_docker_image(service: JupyterService, task: AutograderZip):
+def image_name(digest: str, suffix: str = "") -> str:
     """
-    Trys to delete the docker image belonging to the provided task
+    Name of the autograder image of a zip file. otter takes more than a second to import, so it is only imported once
+    images are used.
+    :param digest: the digest of the zip file or of its environment
+    :param suffix: the suffix of the repository, e.g. "-environment"
+    """
+    from otter.grade import utils
+
+    return f"{utils.OTTER_DOCKER_IMAGE_TAG}{suffix}:{digest}"
+
+
+def delete_docker_image(service: JupyterService, digest: str):
+    """
+    Trys to delete the docker image of a zip file unless another task uses the same zip. The environment image is
+    deleted as well unless the image of a remaining task is based on it.
     :param service: a service instance used for logging
-    :param task: the task to delete
+    :param digest: the digest of the zip file
     """
-    m = hashlib.md5()
-    m.update(task.data)
-    image = f"{utils.OTTER_DOCKER_IMAGE_TAG}:{m.hexdigest()}"
+    with service.session() as session:
+        remaining = {other for (other,) in session.query(AutograderZip.digest).filter(AutograderZip.state != State.deleted, AutograderZip.digest.isnot(None))}
+    if digest in remaining:
+        # E.g. a copied task, its image and cached export are still needed
+        service.log.info(f"Keeping the image of {digest} used by another task")
+        return
+    if service.grading_backend == "local":
+        service.local_grader.remove(digest)
+        return
+    from python_on_whales import docker
+    from python_on_whales.exceptions import NoSuchImage
+
+    image = image_name(digest)
     service.log.info(f"Deleting docker image {image}")
+    cached = image_cache_file(service, digest)
+    if cached is not None and cached.is_file():
+        cached.unlink()
     try:
         docker.image.remove(image, force=True)
     except NoSuchImage as e:
         service.log.warning(f"Image not found: {e}")
 
+    environment = _environment_image(service, digest)
+    if environment is None:
+        return
+    if any(_environment_image(service, other) == environment for other in remaining):
+        return
+    service.log.info(f"Deleting environment image {environment}")
+    try:
+        docker.image.remove(environment, force=True)
+    except NoSuchImage:
+        pass
+
+
+def _environment_image(service: JupyterService, digest: str) -> Optional[str]:
+    """
+    :return: the environment image of a zip file or None if the zip is not stored (anymore)
+    """
+    from livefeedback_hub.handlers.manage import environment_image
+
+    if not service.zip_store.exists(digest):
+        return None
+    try:
+        return environment_image(service, digest)
+    except zipfile.BadZipFile:
+        return None
+
+
+def image_cache_file(service: JupyterService, digest: str) -> Optional[pathlib.Path]:
+    """
+    Path of the exported docker image of a zip file in the image cache
+    :return: the path or None if the image cache is disabled
+    """
+    if not service.image_cache_path:
+        return None
+    return pathlib.Path(service.image_cache_path) / digest[:2] / f"{digest}.tar"
+
+
+def delete_zip(service: JupyterService, session: Session, digest: Optional[str]):
+    """
+    Deletes the zip from the zip store unless it is still used by another task
+    :param service: a service instance used for logging and accessing the zip store
+    :param session: the session used to search for other tasks
+    :param digest: the digest of the zip
+    """
+    if digest is None:
+        return
+    if session.query(AutograderZip.id).filter_by(digest=digest).first() is None:
+        service.log.info(f"Deleting zip {digest}")
+        service.zip_store.remove(digest)
+
 
 def timeout_injector(method_to_decorate):
     """
@@ -0,0 +1,190 @@
+import hashlib
+import os
+import tempfile
+from email.message import Message
+from typing import Dict, List, Optional, Union
+
+PREAMBLE = 0
+DELIMITER = 1
+HEADERS = 2
+BODY = 3
+END = 4
+
+MAX_HEADER_SIZE = 16 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class SpooledFile:
+    """
+    A file part of a multipart body written to a temporary file. The md5 digest is calculated while writing.
+    """
+
+    def __init__(self, name: str, filename: str, directory):
+        self.name = name
+        self.filename = filename
+        self.size = 0
+        self.digest = None
+        fd, self.path = tempfile.mkstemp(suffix=".upload", dir=directory)
+        self._file = os.fdopen(fd, "wb")
+        self._hash = hashlib.md5()
+
+    def write(self, data: bytes):
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def close(self):
+        self._file.close()
+        self.digest = self._hash.hexdigest()
+
+    def remove(self):
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class MultipartSpooler:
+    """
+    Incremental parser for multipart/form-data bodies. Files are spooled to disk while the body is received,
+    all other fields are kept in memory.
+    """
+
+    def __init__(self, boundary: bytes, directory, max_file_size: int, max_field_size: int = 64 * 1024):
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.max_field_size = max_field_size
+        self.fields: Dict[str, List[bytes]] = dict()
+        self.files: Dict[str, SpooledFile] = dict()
+        # Every delimiter is preceded by a line break, also the first one in the body
+        self._delimiter = b"\r\n--" + boundary
+        self._buffer = b"\r\n"
+        self._state = PREAMBLE
+        self._name: Optional[str] = None
+        self._part: Union[SpooledFile, bytearray, None] = None
+
+    def feed(self, data: bytes):
+        self._buffer += data
+        while self._step():
+            pass
+
+    def finish(self):
+        """
+        Completes parsing after the whole body was received
+        """
+        if self._state != END:
+            self.cleanup()
+            raise UploadError("Unvollständige Anfrage")
+
+    def cleanup(self):
+        """
+        Removes all spooled files which were not moved to another location
+        """
+        if isinstance(self._part, SpooledFile):
+            self._part.remove()
+        for file in self.files.values():
+            file.remove()
+
+    def _step(self) -> bool:
+        if self._state == PREAMBLE:
+            index = self._buffer.find(self._delimiter)
+            if index == -1:
+                self._buffer = self._buffer[-len(self._delimiter):]
+                return False
+            self._buffer = self._buffer[index + len(self._delimiter):]
+            self._state = DELIMITER
+            return True
+
+        if self._state == DELIMITER:
+            if len(self._buffer) < 2:
+                return False
+            if self._buffer.startswith(b"--"):
+                self._state = END
+            elif self._buffer.startswith(b"\r\n"):
+                self._state = HEADERS
+            else:
+                raise UploadError("Ungültige Anfrage")
+            self._buffer = self._buffer[2:]
+            return True
+
+        if self._state == HEADERS:
+            header_end = self._buffer.find(b"\r\n\r\n")
+            index = self._buffer.find(self._delimiter)
+            if index != -1 and (header_end == -1 or index < header_end):
+                # Part without body, skip it
+                self._buffer = self._buffer[index + len(self._delimiter):]
+                self._state = DELIMITER
+                return True
+            if header_end == -1:
+                if len(self._buffer) > MAX_HEADER_SIZE:
+                    raise UploadError("Ungültige Anfrage")
+                return False
+            self._start_part(self._buffer[:header_end].decode("utf-8"))
+            self._buffer = self._buffer[header_end + 4:]
+            self._state = BODY
+            return True
+
+        if self._state == BODY:
+            index = self._buffer.find(self._delimiter)
+            if index == -1:
+                # Keep enough data to detect a delimiter split over two chunks
+                keep = len(self._delimiter) - 1
+                if len(self._buffer) > keep:
+                    self._write(self._buffer[:-keep])
+                    self._buffer = self._buffer[-keep:]
+                return False
+            self._write(self._buffer[:index])
+            self._end_part()
+            self._buffer = self._buffer[index + len(self._delimiter):]
+            self._state = DELIMITER
+            return True
+
+        self._buffer = b""
+        return False
+
+    def _start_part(self, headers: str):
+        message = Message()
+        for line in headers.split("\r\n"):
+            if ":" in line:
+                key, value = line.split(":", 1)
+                message[key.strip()] = value.strip()
+        self._name = message.get_param("name", header="content-disposition")
+        filename = message.get_param("filename", header="content-disposition")
+        if self._name is None:
+            self._part = None
+        elif filename is None:
+            self._part = bytearray()
+        elif filename == "":
+            # File inputs without a selected file
+            self._part = None
+        else:
+            self._part = SpooledFile(self._name, filename, self.directory)
+
+    def _write(self, data: bytes):
+        if isinstance(self._part, SpooledFile):
+            if self._part.size + len(data) > self.max_file_size:
+                raise UploadError("Die Datei ist zu groß")
+            self._part.write(data)
+        elif self._part is not None:
+            if len(self._part) + len(data) > self.max_field_size:
+                raise UploadError("Ungültige Anfrage")
+            self._part.extend(data)
+
+    def _end_part(self):
+        if isinstance(self._part, SpooledFile):
+            self._part.close()
+            if self._part.size == 0:
+                self._part.remove()
+            else:
+                if self._name in self.files:
+                    self.files[self._name].remove()
+                self.files[self._name] = self._part
+        elif self._part is not None:
+            self.fields.setdefault(self._name, []).append(bytes(self._part))
+        self._part = None
+        self._name = None
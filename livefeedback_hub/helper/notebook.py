@@ -0,0 +1,23 @@
+def strip_notebook(nb: dict) -> bool:
+    """
+    Removes outputs, attachments and widget state which are not needed for grading, since otter executes the
+    notebook again. The notebook is changed in place.
+    :param nb: the parsed notebook
+    :return: flag indicating whether the notebook was changed
+    """
+    changed = False
+    metadata = nb.get("metadata")
+    if isinstance(metadata, dict) and "widgets" in metadata:
+        del metadata["widgets"]
+        changed = True
+    for cell in nb.get("cells", []):
+        if cell.get("outputs"):
+            cell["outputs"] = []
+            changed = True
+        if cell.get("execution_count") is not None:
+            cell["execution_count"] = None
+            changed = True
+        if "attachments" in cell:
+            del cell["attachments"]
+            changed = True
+    return changed
@@ -1,4 +1,4 @@
-import collections
+import collections.abc
 from weakref import proxy
 
 
@@ -6,7 +6,7 @@ class Link(object):
     __slots__ = "prev", "next", "key", "__weakref__"
 
 
-class OrderedSet(collections.MutableSet):
+class OrderedSet(collections.abc.MutableSet):
     "Set the remembers the order elements were added"
 
     # Big-O running times for all methods are the same as for regular sets.
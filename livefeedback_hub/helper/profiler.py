@@ -0,0 +1,82 @@
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+# Innermost frames of threads waiting for work, e.g. idle executor threads or the IOLoop waiting for events
+IDLE_FRAMES = {"threading:Condition.wait", "threading:Event.wait", "threading:Thread.join", "threading:Semaphore.acquire", "queue:Queue.get",
+               "selectors:EpollSelector.select", "selectors:PollSelector.select", "selectors:KqueueSelector.select", "selectors:SelectSelector.select"}
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def _thread_name(thread: Optional[threading.Thread]) -> str:
+    if thread is None:
+        return "unknown"
+    # Threads of the same executor share one root, e.g. ThreadPoolExecutor-0_3 and ThreadPoolExecutor-0_7
+    return re.sub(r"_\d+$", "", thread.name).replace(";", ":").replace(" ", "_")
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads of the process, i.e. the IOLoop running the handlers and the executor threads
+    grading and building, for a bounded time. Nothing is hooked into the interpreter, so there is no overhead unless a
+    profile is recorded. The stacks are counted in the folded format of flamegraph.pl, which is also read by
+    speedscope and most other flame graph viewers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def profile(self, duration: float, interval: float = 0.01, idle: bool = False) -> Dict[str, int]:
+        """
+        Records a profile, blocking the calling thread for the duration
+        :param duration: seconds to sample
+        :param interval: seconds between two samples
+        :param idle: flag indicating whether stacks of threads waiting for work are included
+        :return: the number of samples of every folded stack (thread;outermost frame;...;innermost frame)
+        :raises ProfilerBusyError: if another profile is being recorded
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError()
+        try:
+            stacks: Counter = Counter()
+            own = threading.get_ident()
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                threads = {thread.ident: thread for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    names: List[str] = []
+                    while frame is not None:
+                        names.append(_frame_name(frame))
+                        frame = frame.f_back
+                    if not idle and names and names[0] in IDLE_FRAMES:
+                        continue
+                    names.append(_thread_name(threads.get(ident)))
+                    stacks[";".join(reversed(names))] += 1
+                time.sleep(interval)
+            return dict(stacks)
+        finally:
+            self._lock.release()
+
+
+def folded(stacks: Dict[str, int]) -> str:
+    """
+    Formats a profile as input of flamegraph.pl, one stack and its number of samples per line
+    """
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
@@ -0,0 +1,130 @@
+import csv
+import io
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+Key = Tuple[str, str]
+
+
+def parse_scores(data: str) -> Dict[str, float]:
+    """
+    Converts a grading result stored as csv to the scores of the questions
+    :param data: the grading result as csv
+    :return: the score of every question
+    """
+    rows = list(csv.DictReader(io.StringIO(data)))
+    if len(rows) == 0:
+        return dict()
+    return {question: float(score) if score else 0.0 for question, score in rows[-1].items() if question != "file"}
+
+
+class ResultNotifier:
+    """
+    In-memory registry of requests waiting for the result of a student. Submissions are registered by expect before
+    they are queued and the result writer notifies the waiting requests once a result is committed, so no request polls
+    the database. A waiter only accepts results of submissions received not before its own submission.
+    Results written by other processes (e.g. grading workers) are not notified, waiting requests time out instead and
+    later requests read them from the database.
+    Expected submissions are forgotten after ttl seconds, e.g. if they were picked up by another process.
+    """
+
+    def __init__(self, ttl: float = 900):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._expected: Dict[Key, float] = dict()
+        self._waiters: Dict[Key, List[Tuple[float, IOLoop, Future]]] = dict()
+        self._purged = time.time()
+
+    def expect(self, user_hash: str, assignment_id: str, received: float):
+        """
+        Registers a submission whose result will be notified
+        :param user_hash: the hashed user name
+        :param assignment_id: the id of the live feedback task
+        :param received: the time the submission was received
+        """
+        with self._lock:
+            self._expected[(user_hash, assignment_id)] = max(received, self._expected.get((user_hash, assignment_id), received))
+            now = time.time()
+            if now - self._purged > self.ttl:
+                self._purged = now
+                self._expected = {key: value for key, value in self._expected.items() if now - value <= self.ttl}
+
+    def expected(self, user_hash: str, assignment_id: str) -> Optional[float]:
+        """
+        :return: the time the latest submission of the student without result was received or None
+        """
+        key = (user_hash, assignment_id)
+        with self._lock:
+            received = self._expected.get(key)
+            if received is not None and time.time() - received > self.ttl:
+                del self._expected[key]
+                return None
+            return received
+
+    def forget(self, user_hash: str, assignment_id: str, received: float):
+        """
+        Removes the expectation of a submission which will not be graded by this process
+        """
+        key = (user_hash, assignment_id)
+        with self._lock:
+            if self._expected.get(key) == received:
+                del self._expected[key]
+
+    def notify(self, user_hash: str, assignment_id: str, data: Optional[str], received: Optional[float] = None):
+        """
+        Resolves the requests waiting for the result of a student. May be called from any thread.
+        :param user_hash: the hashed user name
+        :param assignment_id: the id of the live feedback task
+        :param data: the committed result as csv or None if grading failed
+        :param received: the time the graded submission was received, None matches all waiters
+        """
+        key = (user_hash, assignment_id)
+        with self._lock:
+            if key in self._expected and (received is None or received >= self._expected[key]):
+                del self._expected[key]
+            waiters = self._waiters.pop(key, [])
+            resolved = [waiter for waiter in waiters if received is None or received >= waiter[0]]
+            if len(resolved) < len(waiters):
+                # Waiting for a newer submission of the student
+                self._waiters[key] = [waiter for waiter in waiters if waiter not in resolved]
+        for since, loop, future in resolved:
+            loop.add_callback(self._resolve, future, data)
+
+    @staticmethod
+    def _resolve(future: Future, data: Optional[str]):
+        if not future.done():
+            future.set_result(data)
+
+    async def wait(self, user_hash: str, assignment_id: str, since: float, timeout: float) -> Optional[str]:
+        """
+        Waits for the result of a submission of the student received at or after since
+        :param user_hash: the hashed user name
+        :param assignment_id: the id of the live feedback task
+        :param since: the time the awaited submission was received
+        :param timeout: seconds to wait
+        :return: the result as csv or None if grading failed
+        :raises tornado.util.TimeoutError: if no result was committed in time
+        """
+        key = (user_hash, assignment_id)
+        future = Future()
+        waiter = (since, IOLoop.current(), future)
+        with self._lock:
+            self._waiters.setdefault(key, []).append(waiter)
+        try:
+            return await gen.with_timeout(IOLoop.current().time() + timeout, future)
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(key, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                    if len(waiters) == 0:
+                        del self._waiters[key]
+
+    def waiting(self) -> int:
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
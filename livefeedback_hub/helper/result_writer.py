@@ -0,0 +1,202 @@
+import datetime
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import OperationalError
+
+from livefeedback_hub.db import AutograderZip, JobTiming, Result, ResultHistory, State
+from livefeedback_hub.helper.result_notifier import parse_scores
+
+BATCH_SIZE = 200
+
+
+class ResultWriter:
+    """
+    Collects the results of finished grading jobs and writes them to the database from a single thread.
+    Pending results are kept per (user, assignment) so only the latest result of a student is written and
+    all pending results are flushed in batched INSERT ... ON CONFLICT upserts. If a batch fails, its results are
+    written one by one, so an invalid result does not block the others. Results of deleted tasks, e.g. of gradings
+    running while the task was deleted, are dropped.
+    """
+
+    def __init__(self, service, interval: float = 0.5):
+        self.service = service
+        self.interval = interval
+        self._pending: Dict[Tuple[str, str], Tuple[str, Optional[float]]] = dict()
+        self._timings: List[Tuple[str, float, Dict[str, float]]] = list()
+        self._history: List[dict] = list()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the background thread flushing the pending results every interval seconds
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread and writes all remaining results
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def put(self, user_hash: str, assignment_id: str, data: str, timing: Optional[Dict[str, float]] = None, received: Optional[float] = None):
+        """
+        Queues a result for the next flush. An already pending result of the same user and assignment is replaced,
+        the scores are appended to the result history nonetheless.
+        :param user_hash: the hashed user name
+        :param assignment_id: the id of the live feedback task
+        :param data: the grading result as csv
+        :param timing: durations of the stages of the grading job in seconds, completed by the write stage
+        :param received: the time the graded submission was received, passed to the result notifier
+        """
+        try:
+            scores = parse_scores(data)
+        except ValueError:
+            scores = dict()
+        graded = int(time.time())
+        history = [{"assignment": assignment_id, "user": user_hash, "graded": graded, "question": question, "score": score} for question, score in scores.items()]
+        with self._lock:
+            self._pending[(user_hash, assignment_id)] = (data, received)
+            self._history.extend(history)
+            if timing is not None:
+                self._timings.append((assignment_id, time.time(), timing))
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """
+        Writes all pending results to the database using the calling thread
+        :return: the number of written results
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, dict()
+                timings, self._timings = self._timings, list()
+                history, self._history = self._history, list()
+            if len(batch) == 0:
+                return 0
+            try:
+                batch, timings, history = self._skip_deleted(batch, timings, history)
+            except Exception:
+                self._requeue(batch, timings, history)
+                raise
+            rows = [self._row(key, item) for key, item in batch.items()]
+            try:
+                with self.service.session() as session:
+                    for i in range(0, len(rows), BATCH_SIZE):
+                        self._upsert(session, rows[i:i + BATCH_SIZE])
+                    self._insert_statistics(session, timings, history)
+                written = batch
+            except Exception as e:
+                self.service.log.error(f"Error while writing {len(rows)} results, writing them one by one: {e}")
+                written = self._flush_each(batch, timings, history)
+            for (user, assignment), (data, received) in written.items():
+                self.service.result_notifier.notify(user, assignment, data, received)
+            self.service.log.debug(f"Wrote {len(written)} results")
+            return len(written)
+
+    def _flush_each(self, batch: Dict[Tuple[str, str], Tuple[str, Optional[float]]], timings: List[Tuple[str, float, Dict[str, float]]],
+                    history: List[dict]) -> Dict[Tuple[str, str], Tuple[str, Optional[float]]]:
+        """
+        Writes the results of a failed batch in separate transactions. Results failing with an operational error (e.g. a
+        lost connection or a locked database) are kept for the next flush, results failing otherwise (e.g. a violated
+        foreign key) are dropped.
+        :return: the written results
+        """
+        written, retry = dict(), dict()
+        for key, item in batch.items():
+            try:
+                with self.service.session() as session:
+                    self._upsert(session, [self._row(key, item)])
+                written[key] = item
+            except OperationalError as e:
+                self.service.log.warning(f"Error while writing the result of {key[0]} for {key[1]}, retrying: {e}")
+                retry[key] = item
+            except Exception as e:
+                self.service.log.error(f"Dropping the result of {key[0]} for {key[1]}: {e}")
+        try:
+            with self.service.session() as session:
+                self._insert_statistics(session, timings, history)
+            timings, history = list(), list()
+        except OperationalError as e:
+            self.service.log.warning(f"Error while writing {len(timings)} timings and {len(history)} history entries, retrying: {e}")
+        except Exception as e:
+            self.service.log.error(f"Dropping {len(timings)} timings and {len(history)} history entries: {e}")
+            timings, history = list(), list()
+        self._requeue(retry, timings, history)
+        return written
+
+    def _skip_deleted(self, batch: Dict[Tuple[str, str], Tuple[str, Optional[float]]], timings: List[Tuple[str, float, Dict[str, float]]], history: List[dict]):
+        """
+        Drops the results, timings and history entries of deleted or missing tasks
+        """
+        assignments = {assignment for _, assignment in batch} | {assignment for assignment, _, _ in timings} | {entry["assignment"] for entry in history}
+        with self.service.session() as session:
+            live = {id for (id,) in session.query(AutograderZip.id).filter(AutograderZip.id.in_(assignments), AutograderZip.state != State.deleted)}
+        if len(live) == len(assignments):
+            return batch, timings, history
+        self.service.log.info(f"Dropping the results of the deleted tasks {', '.join(sorted(assignments - live))}")
+        return ({key: item for key, item in batch.items() if key[1] in live}, [timing for timing in timings if timing[0] in live],
+                [entry for entry in history if entry["assignment"] in live])
+
+    def _requeue(self, batch: Dict[Tuple[str, str], Tuple[str, Optional[float]]], timings: List[Tuple[str, float, Dict[str, float]]], history: List[dict]):
+        with self._lock:
+            self._timings = timings + self._timings
+            self._history = history + self._history
+            # Keep results for the next flush unless a newer result arrived in the meantime
+            for key, item in batch.items():
+                self._pending.setdefault(key, item)
+
+    @staticmethod
+    def _row(key: Tuple[str, str], item: Tuple[str, Optional[float]]) -> dict:
+        (user, assignment), (data, received) = key, item
+        return {"user": user, "assignment": assignment, "data": data, "received": received}
+
+    @staticmethod
+    def _insert_statistics(session, timings: List[Tuple[str, float, Dict[str, float]]], history: List[dict]):
+        now = time.time()
+        session.bulk_insert_mappings(JobTiming, [dict(timing, assignment=assignment, finished=datetime.datetime.utcnow(), write=now - put)
+                                                 for assignment, put, timing in timings])
+        session.bulk_insert_mappings(ResultHistory, history)
+
+    @staticmethod
+    def _upsert(session, rows: List[dict]):
+        dialect = session.get_bind().dialect.name
+        if dialect == "sqlite":
+            insert = sqlite.insert
+        elif dialect == "postgresql":
+            insert = postgresql.insert
+        else:
+            for row in rows:
+                existing = session.query(Result).filter_by(assignment=row["assignment"], user=row["user"]).first()
+                if existing:
+                    existing.data = row["data"]
+                    existing.received = row["received"]
+                else:
+                    session.add(Result(**row))
+            return
+        statement = insert(Result.__table__).values(rows)
+        statement = statement.on_conflict_do_update(index_elements=["user", "assignment"], set_={"data": statement.excluded.data, "received": statement.excluded.received})
+        session.execute(statement)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                self.service.log.exception(e)
@@ -0,0 +1,192 @@
+import datetime
+import threading
+from contextlib import contextmanager
+from typing import List, Optional
+
+from sqlalchemy import text
+
+from livefeedback_hub.db import BacklogEntry, RunningJob
+from livefeedback_hub.helper.temporary_submission import TemporarySubmission
+
+# Key of the PostgreSQL advisory lock guarding the scheduler state
+ADVISORY_LOCK_KEY = 0x4C495645
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Exclusive lock of all processes of the host using a lock file, flock on Unix and msvcrt.locking on Windows
+    :param path: the path of the lock file
+    """
+    with open(path, "a") as lock_file:
+        try:
+            import fcntl
+        except ImportError:
+            import msvcrt
+
+            # Locks the first byte of the file, LK_LOCK gives up after 10 seconds and is therefore repeated
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            return
+
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class SchedulerState:
+    """
+    In-process state of the submission scheduler: the students with a running grading job and the backlog of
+    submissions waiting for the running job of their student. All methods must be called while holding lock().
+    """
+
+    # Flag indicating whether other processes grade the submissions of the backlog as well
+    shared = False
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._running = set()
+        self._backlog: List[TemporarySubmission] = list()
+
+    @contextmanager
+    def lock(self):
+        with self._mutex:
+            yield
+
+    def is_running(self, user_hash: str) -> bool:
+        return user_hash in self._running
+
+    def running_count(self) -> int:
+        return len(self._running)
+
+    def backlog_size(self) -> int:
+        return len(self._backlog)
+
+    def start(self, user_hash: str) -> bool:
+        """
+        Marks a grading job of the student as running
+        :param user_hash: the hashed user name
+        :return: False if a job of the student is already running
+        """
+        if user_hash in self._running:
+            return False
+        self._running.add(user_hash)
+        return True
+
+    def finish(self, user_hash: str):
+        self._running.discard(user_hash)
+
+    def queue(self, submission: TemporarySubmission):
+        """
+        Adds a submission to the backlog replacing an older submission of the same student and task
+        """
+        self._backlog = [x for x in self._backlog if x.user_hash != submission.user_hash or x.id != submission.id]
+        self._backlog.append(submission)
+
+    def pop(self, user_hash: str) -> Optional[TemporarySubmission]:
+        """
+        Removes the oldest submission of the student from the backlog
+        :return: the submission or None if the backlog contains no submission of the student
+        """
+        items = [x for x in self._backlog if x.user_hash == user_hash]
+        if len(items) == 0:
+            return None
+        self._backlog.remove(items[0])
+        return items[0]
+
+    def drain(self) -> List[TemporarySubmission]:
+        """
+        Removes all submissions from the backlog, e.g. to persist them before the process exits
+        :return: the removed submissions
+        """
+        items, self._backlog = self._backlog, list()
+        return items
+
+
+class DatabaseSchedulerState(SchedulerState):
+    """
+    Scheduler state shared by several service processes using the service database. The lock is a PostgreSQL
+    advisory lock or, for SQLite, a file lock next to the database file. Running jobs older than stale_timeout
+    seconds are considered abandoned by a crashed process.
+    """
+
+    shared = True
+
+    def __init__(self, service, stale_timeout: int = 900):
+        super().__init__()
+        self.service = service
+        self.stale_timeout = stale_timeout
+
+    @contextmanager
+    def lock(self):
+        with self._mutex:
+            engine = self.service.engine
+            if engine.dialect.name == "postgresql":
+                with engine.connect() as connection:
+                    connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": ADVISORY_LOCK_KEY})
+                    try:
+                        yield
+                    finally:
+                        connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": ADVISORY_LOCK_KEY})
+            elif engine.dialect.name == "sqlite" and engine.url.database not in (None, "", ":memory:"):
+                with file_lock(f"{engine.url.database}.lock"):
+                    yield
+            else:
+                yield
+
+    def _cutoff(self) -> datetime.datetime:
+        return datetime.datetime.utcnow() - datetime.timedelta(seconds=self.stale_timeout)
+
+    def is_running(self, user_hash: str) -> bool:
+        with self.service.session() as session:
+            return session.query(RunningJob.user).filter(RunningJob.user == user_hash, RunningJob.started >= self._cutoff()).first() is not None
+
+    def running_count(self) -> int:
+        with self.service.session() as session:
+            return session.query(RunningJob).filter(RunningJob.started >= self._cutoff()).count()
+
+    def backlog_size(self) -> int:
+        with self.service.session() as session:
+            return session.query(BacklogEntry).count()
+
+    def start(self, user_hash: str) -> bool:
+        with self.service.session() as session:
+            session.query(RunningJob).filter(RunningJob.user == user_hash, RunningJob.started < self._cutoff()).delete()
+            if session.query(RunningJob.user).filter_by(user=user_hash).first() is not None:
+                return False
+            session.add(RunningJob(user=user_hash, started=datetime.datetime.utcnow()))
+        return True
+
+    def finish(self, user_hash: str):
+        with self.service.session() as session:
+            session.query(RunningJob).filter_by(user=user_hash).delete()
+
+    def queue(self, submission: TemporarySubmission):
+        with self.service.session() as session:
+            session.query(BacklogEntry).filter_by(user=submission.user_hash, assignment=submission.id).delete()
+            session.add(BacklogEntry(user=submission.user_hash, assignment=submission.id, zip_digest=submission.zip_digest, notebook=submission.notebook,
+                                     received=submission.received))
+
+    def pop(self, user_hash: str) -> Optional[TemporarySubmission]:
+        with self.service.session() as session:
+            entry: Optional[BacklogEntry] = session.query(BacklogEntry).filter_by(user=user_hash).order_by(BacklogEntry.id).first()
+            if entry is None:
+                return None
+            session.delete(entry)
+            return TemporarySubmission(notebook=entry.notebook, zip_digest=entry.zip_digest, id=entry.assignment, user_hash=entry.user, received=entry.received)
+
+    def drain(self) -> List[TemporarySubmission]:
+        # The backlog is already persisted and picked up by the other processes
+        return list()
@@ -1,29 +1,81 @@
+import time
 from queue import Queue
+from typing import Callable, Dict, List
 
 from livefeedback_hub.helper.ordered_set import OrderedSet
 
 
 class SetQueue(Queue):
+    """
+    Queue of unique items with priority lanes. Items are taken from the lane with the highest priority (the lowest
+    number) in the order they were added, unless the oldest item of a lane with lower priority waited longer than
+    max_wait seconds, which keeps resubmissions from starving under load. None, used by executors to wake up their
+    threads on shutdown, is only returned once all lanes are empty.
+    """
+
+    def __init__(self, maxsize=0, lanes: int = 1, lane: Callable[[object], int] = lambda item: 0, max_wait: float = 60.0):
+        self.lanes = lanes
+        self.lane = lane
+        self.max_wait = max_wait
+        super().__init__(maxsize)
 
     def _init(self, maxsize):
         self.maxsize = maxsize
-        self.queue = OrderedSet()
+        self._lanes: List[OrderedSet] = [OrderedSet() for _ in range(self.lanes)]
+        self._added: Dict[object, float] = dict()
+        self._sentinels = 0
+
+    def _qsize(self):
+        return sum(len(lane) for lane in self._lanes) + self._sentinels
 
     def _put(self, item):
-        self.queue.add(item)
+        if item is None:
+            self._sentinels += 1
+            return
+        lane = self._lanes[min(max(self.lane(item), 0), self.lanes - 1)]
+        if item not in lane:
+            lane.add(item)
+            self._added[item] = time.monotonic()
 
     def _get(self):
-        return self.queue.pop()
+        heads = [next(iter(lane)) for lane in self._lanes if len(lane) > 0]
+        if len(heads) == 0:
+            self._sentinels -= 1
+            return None
+        item = heads[0]
+        starved = [head for head in heads[1:] if time.monotonic() - self._added[head] > self.max_wait]
+        if starved:
+            item = min(starved, key=lambda head: self._added[head])
+        self._remove(item)
+        return item
+
+    def _remove(self, item):
+        for lane in self._lanes:
+            lane.discard(item)
+        self._added.pop(item, None)
+
+    def items(self) -> list:
+        """
+        :return: the queued items ordered by lane
+        """
+        with self.mutex:
+            return [item for lane in self._lanes for item in lane]
 
     def find(self, fn):
         with self.mutex:
-            for item in self.queue:
-                if fn(item):
-                    return item
+            for lane in self._lanes:
+                for item in lane:
+                    if fn(item):
+                        return item
             return None
 
-    def find_and_remove(self, fn):
+    def find_and_remove(self, fn) -> list:
+        """
+        :return: the removed items
+        """
         with self.mutex:
-            for item in self.queue:
-                if fn(item):
-                    self.queue.remove(item)
+            # Removing while iterating frees the link the iterator is about to follow
+            items = [item for lane in self._lanes for item in lane if fn(item)]
+            for item in items:
+                self._remove(item)
+            return items
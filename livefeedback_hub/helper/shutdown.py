@@ -0,0 +1,147 @@
+import os
+import socket
+import threading
+import time
+from typing import Dict, Tuple
+
+from tornado import gen
+
+from livefeedback_hub.helper.temporary_submission import TemporarySubmission
+
+
+class ShutdownManager:
+    """
+    Keeps track of the gradings and builds of this process so they survive a restart. Once draining, no new work is
+    accepted and the health endpoint reports the service as not ready. Work which is not finished within the deadline
+    is checkpointed to the job queue in the database and resumed by the next start of the service.
+    """
+
+    def __init__(self, service, interval: float = 0.2):
+        self.service = service
+        self.interval = interval
+        self.checkpointed = 0
+        self._draining = threading.Event()
+        self._lock = threading.Lock()
+        self._gradings: Dict[Tuple[str, str], TemporarySubmission] = dict()
+        self._builds: Dict[str, Tuple[str, bool]] = dict()
+
+    @property
+    def draining(self) -> bool:
+        return self._draining.is_set()
+
+    def begin(self):
+        """
+        Stops accepting new submissions and uploads
+        """
+        self._draining.set()
+
+    def grading_started(self, submission: TemporarySubmission):
+        with self._lock:
+            self._gradings[(submission.user_hash, submission.id)] = submission
+
+    def grading_finished(self, user_hash: str, assignment_id: str):
+        with self._lock:
+            self._gradings.pop((user_hash, assignment_id), None)
+
+    def build_queued(self, assignment_id: str, zip_digest: str, update: bool = False):
+        with self._lock:
+            self._builds[assignment_id] = (zip_digest, update)
+
+    def build_finished(self, assignment_id: str):
+        with self._lock:
+            self._builds.pop(assignment_id, None)
+
+    def idle(self) -> bool:
+        """
+        :return: flag indicating whether no grading or build of this process is queued or running
+        """
+        from livefeedback_hub.handlers.submission import submission_executor
+
+        with self._lock:
+            busy = len(self._gradings) + len(self._builds)
+        # The backlog of the scheduler only contains submissions of students with a running grading
+        return busy == 0 and submission_executor._work_queue.qsize() == 0
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Waits for the queued and running work of this process
+        :param timeout: seconds to wait
+        :return: flag indicating whether all work finished in time
+        """
+        deadline = time.monotonic() + timeout
+        idle = 0
+        while True:
+            # A submission taken from the queue is only tracked once its grading started, so idle is checked twice
+            idle = idle + 1 if self.idle() else 0
+            if idle >= 2:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            await gen.sleep(self.interval)
+
+    def checkpoint(self) -> int:
+        """
+        Moves the unfinished work of this process to the job queue. Running gradings and builds are not interrupted, if
+        they finish before the process exits they are simply executed again after the restart.
+        :return: the number of checkpointed jobs
+        """
+        from livefeedback_hub.handlers.submission import process_notebook, submission_executor
+
+        scheduler = self.service.scheduler
+        queued = [TemporarySubmission(notebook=item.kwargs["notebook"], zip_digest=item.kwargs["zip_digest"], id=item.kwargs["id"], user_hash=item.kwargs["user_hash"],
+                                      received=item.kwargs["received"]) for item in submission_executor.find_and_remove(lambda item: item.fn is process_notebook)]
+        with scheduler.lock():
+            backlog = scheduler.drain()
+            with self._lock:
+                running, builds = list(self._gradings.values()), dict(self._builds)
+            for submission in running:
+                # Otherwise the resumed grading waits for the stale timeout of the running job
+                scheduler.finish(submission.user_hash)
+        # Newer submissions replace the older ones of the same student and task in the job queue
+        submissions = running + queued + backlog
+        for submission in submissions:
+            self.service.job_queue.put_grading(submission.user_hash, submission.id, submission.zip_digest, submission.notebook, received=submission.received)
+        for assignment_id, (zip_digest, update) in builds.items():
+            self.service.job_queue.put_build(assignment_id, zip_digest, update=update)
+        self.checkpointed += len(submissions) + len(builds)
+        self.service.log.info(f"Checkpointed {len(submissions)} submissions and {len(builds)} builds")
+        return len(submissions) + len(builds)
+
+    def resume(self) -> int:
+        """
+        Queues the jobs checkpointed by a previous shutdown in this process and rebuilds tasks whose build was lost,
+        e.g. because the process was killed
+        :return: the number of resumed jobs
+        """
+        from livefeedback_hub.db import AutograderZip, JobKind, State
+        from livefeedback_hub.handlers.manage import submit_build
+        from livefeedback_hub.handlers.submission import process_notebook, submission_executor
+
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        resumed, building = 0, set()
+        while True:
+            job = self.service.job_queue.claim(worker_id)
+            if job is None:
+                break
+            # The job is tracked in memory again and checkpointed on the next shutdown
+            if job.kind == JobKind.build:
+                building.add(job.assignment)
+                submit_build(self.service, job.assignment, job.zip_digest, update=job.update)
+            else:
+                submission_executor.submit(process_notebook, service=self.service, zip_digest=job.zip_digest, notebook=job.notebook, id=job.assignment,
+                                           user_hash=job.user, received=job.received)
+            self.service.job_queue.complete(job.id)
+            resumed += 1
+        if self.service.scheduler_backend == "local":
+            # Unless this is the only process, another process may still build the remaining tasks
+            with self.service.session() as session:
+                tasks = session.query(AutograderZip.id, AutograderZip.digest).filter_by(state=State.building).all()
+            for assignment_id, zip_digest in tasks:
+                if assignment_id not in building:
+                    # The digest of an interrupted update is unknown, so the previous version is built again
+                    self.service.log.info(f"Restarting the build of {assignment_id}")
+                    submit_build(self.service, assignment_id, zip_digest)
+                    resumed += 1
+        if resumed:
+            self.service.log.info(f"Resumed {resumed} jobs")
+        return resumed
@@ -0,0 +1,67 @@
+import logging
+import os
+import threading
+import time
+from typing import FrozenSet, Optional
+
+
+class TeacherRoster:
+    """
+    Names of the teachers read from the file configured by FEEDBACK_TEACHERS (one name per line). The names are kept in
+    a set and the file is only read again when its modification time changes, which is checked at most every interval
+    seconds, or when reload is called (e.g. on SIGHUP). Alternatively members of the JupyterHub group configured by
+    FEEDBACK_TEACHER_GROUP are teachers, which requires no file at all.
+    """
+
+    def __init__(self, path: Optional[str] = None, group: Optional[str] = None, interval: float = 5.0):
+        self._path = path
+        self._group = group
+        self.interval = interval
+        self.log = logging.getLogger("tornado.application")
+        self._members: FrozenSet[str] = frozenset()
+        self._loaded = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> Optional[str]:
+        return self._path or os.getenv("FEEDBACK_TEACHERS")
+
+    @property
+    def group(self) -> Optional[str]:
+        return self._group or os.getenv("FEEDBACK_TEACHER_GROUP")
+
+    def members(self) -> FrozenSet[str]:
+        """
+        :return: the names listed in the roster file
+        """
+        if time.monotonic() - self._checked >= self.interval:
+            self._refresh()
+        return self._members
+
+    def reload(self):
+        """
+        Reads the roster file on the next access regardless of its modification time
+        """
+        # No lock, as this is called by signal handlers
+        self._loaded = None
+        self._checked = 0.0
+
+    def _refresh(self):
+        with self._lock:
+            self._checked = time.monotonic()
+            path = self.path
+            if not path:
+                self._members, self._loaded = frozenset(), None
+                return
+            try:
+                stat = os.stat(path)
+                if self._loaded == (path, stat.st_mtime_ns, stat.st_size):
+                    return
+                with open(path, "r") as f:
+                    self._members = frozenset(line.strip() for line in f if line.strip())
+                self._loaded = (path, stat.st_mtime_ns, stat.st_size)
+                self.log.info(f"Loaded {len(self._members)} teachers from {path}")
+            except OSError as e:
+                # Keep the previous roster, e.g. while the file is replaced
+                self.log.warning(f"Error while reading the teachers from {path}: {e}")
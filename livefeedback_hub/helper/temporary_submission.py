@@ -1,11 +1,13 @@
 class TemporarySubmission:
     user_hash = ""
     id = ""
-    autograder_zip = bytes()
+    zip_digest = ""
     notebook = bytes()
+    received = None
 
-    def __init__(self, notebook, autograder_zip, id, user_hash):
+    def __init__(self, notebook, zip_digest, id, user_hash, received=None):
         self.id = id
-        self.autograder_zip = autograder_zip
+        self.received = received
+        self.zip_digest = zip_digest
         self.notebook = notebook
         self.user_hash = user_hash
@@ -0,0 +1,38 @@
+import math
+from typing import Dict, List
+
+from livefeedback_hub.db import JobTiming
+
+STAGES = ["queue", "prepare", "grading", "write"]
+PERCENTILES = [50, 90, 95, 99]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Calculates a percentile using the nearest-rank method
+    :param values: the sorted values
+    :param q: the percentile between 0 and 100
+    """
+    rank = max(math.ceil(q / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def stage_percentiles(service, assignment_id: str, limit: int = 1000) -> Dict[str, object]:
+    """
+    Calculates the percentiles of the stage durations of the latest grading jobs of a task
+    :param service: a service instance used for accessing the database
+    :param assignment_id: the id of the live feedback task
+    :param limit: the number of jobs to consider
+    :return: the number of jobs and the percentiles of every stage and the total duration in seconds
+    """
+    columns = [getattr(JobTiming, stage) for stage in STAGES]
+    with service.session() as session:
+        rows = session.query(*columns).filter_by(assignment=assignment_id).order_by(JobTiming.id.desc()).limit(limit).all()
+    result: Dict[str, object] = {"count": len(rows)}
+    if len(rows) == 0:
+        return result
+    durations = {stage: sorted(row[i] or 0.0 for row in rows) for i, stage in enumerate(STAGES)}
+    durations["total"] = sorted(sum(value or 0.0 for value in row) for row in rows)
+    for stage, values in durations.items():
+        result[stage] = {f"p{q}": percentile(values, q) for q in PERCENTILES}
+    return result
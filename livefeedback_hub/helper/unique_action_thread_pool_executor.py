@@ -1,15 +1,49 @@
+import enum
+import threading
 from concurrent.futures.thread import ThreadPoolExecutor
 
 from livefeedback_hub.helper.set_queue import SetQueue
 
 
+class Priority(enum.IntEnum):
+    """
+    Priority lanes of the submissions, lower values are graded first
+    """
+    owner = 0
+    first = 1
+    resubmission = 2
+
+
 class UniqueActionThreadPoolExecutor(ThreadPoolExecutor):
-    def __init__(self, max_workers=None, thread_name_prefix='', initializer=None, initargs=()):
+    def __init__(self, max_workers=None, thread_name_prefix='', initializer=None, initargs=(), max_wait: float = 60.0):
         super().__init__(max_workers, thread_name_prefix, initializer, initargs)
-        self._work_queue = SetQueue()
+        self._submitting = threading.local()
+        self._work_queue = SetQueue(lanes=len(Priority), lane=self._lane, max_wait=max_wait)
+
+    def _lane(self, item) -> int:
+        # The work item is queued by the thread calling submit
+        return getattr(self._submitting, "priority", Priority.resubmission)
+
+    def submit(self, fn, *args, priority: Priority = Priority.resubmission, **kwargs):
+        """
+        Schedules fn in the lane of the given priority
+        """
+        self._submitting.priority = priority
+        try:
+            return super().submit(fn, *args, **kwargs)
+        finally:
+            del self._submitting.priority
+
+    @property
+    def max_wait(self) -> float:
+        return self._work_queue.max_wait
+
+    @max_wait.setter
+    def max_wait(self, value: float):
+        self._work_queue.max_wait = value
 
-    def find_and_remove(self, fn):
-        self._work_queue.find_and_remove(fn)
+    def find_and_remove(self, fn) -> list:
+        return self._work_queue.find_and_remove(fn)
 
     def find(self, fn):
         return self._work_queue.find(fn)
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import pathlib
+import posixpath
+import re
+import shutil
+import tempfile
+import zipfile
+
+DIGEST_REGEX = re.compile(r"^[a-f0-9]{32}$")
+REQUIRED_ENTRIES = ["run_autograder", "otter_config.json"]
+# Files of an autograder zip which are installed into the grading environment
+ENVIRONMENT_REGEX = re.compile(r"^(run_autograder|setup\.sh|environment\.yml|requirements\.[^/]+)$")
+
+
+class InvalidZipError(ValueError):
+    pass
+
+
+def validate_autograder_zip(path, max_size: int, max_entries: int):
+    """
+    Checks the structure of an autograder zip using its central directory without extracting it
+    :param path: the path of the zip file
+    :param max_size: the maximal size of all extracted files in bytes
+    :param max_entries: the maximal number of files in the zip
+    """
+    try:
+        with zipfile.ZipFile(path, "r") as zip_ref:
+            entries = zip_ref.infolist()
+    except (zipfile.BadZipFile, OSError):
+        raise InvalidZipError("Die Datei ist keine Zip-Datei")
+
+    if len(entries) > max_entries:
+        raise InvalidZipError(f"Die Zip-Datei enthält mehr als {max_entries} Dateien")
+    # zipfile never extracts more than the declared size of an entry
+    if sum(entry.file_size for entry in entries) > max_size:
+        raise InvalidZipError("Die entpackte Zip-Datei ist zu groß")
+    for entry in entries:
+        name = entry.filename
+        if name.startswith("/") or ".." in posixpath.normpath(name).split("/"):
+            raise InvalidZipError(f"Ungültiger Pfad {name}")
+    names = {entry.filename for entry in entries}
+    for required in REQUIRED_ENTRIES:
+        if required not in names:
+            raise InvalidZipError(f"Die Zip-Datei enthält keine Datei {required}")
+
+
+def environment_digest(path, salt: bytes = b"") -> str:
+    """
+    Calculates the hash of the files of an autograder zip which are installed into the grading environment. Zips with
+    the same environment digest only differ in their tests, support files and otter configuration.
+    :param path: the path of the zip file
+    :param salt: additional data influencing the environment, e.g. the Dockerfile
+    :return: the md5 digest of the environment
+    """
+    m = hashlib.md5(salt)
+    with zipfile.ZipFile(path, "r") as zip_ref:
+        for name in sorted(name for name in zip_ref.namelist() if ENVIRONMENT_REGEX.match(name)):
+            m.update(name.encode("utf-8") + b"\0")
+            m.update(zip_ref.read(name) + b"\0")
+    return m.hexdigest()
+
+
+class ZipStore:
+    """
+    Content addressed storage for autograder zips. Every zip is stored once in a file named by its digest, which is
+    the same hash used to tag the docker image of the zip.
+    """
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+
+    def path(self, digest: str) -> pathlib.Path:
+        if not DIGEST_REGEX.match(digest):
+            raise ValueError(f"Invalid digest {digest}")
+        return self.root / digest[:2] / f"{digest}.zip"
+
+    def exists(self, digest: str) -> bool:
+        return self.path(digest).is_file()
+
+    def put(self, data: bytes) -> str:
+        """
+        Stores the zip unless a zip with the same content is already stored
+        :param data: the content of the zip file
+        :return: the digest of the zip
+        """
+        digest = hashlib.md5(data).hexdigest()
+        path = self.path(digest)
+        if path.is_file():
+            return digest
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=path.parent)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        return digest
+
+    def spool_dir(self) -> pathlib.Path:
+        """
+        Directory for temporary files which are moved into the store afterwards
+        """
+        path = self.root / "tmp"
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def put_file(self, path, digest: str) -> str:
+        """
+        Moves a file with a known digest into the store. The file is removed if the zip is already stored.
+        :param path: the path of the file
+        :param digest: the md5 digest of the file
+        :return: the digest of the zip
+        """
+        target = self.path(digest)
+        if target.is_file():
+            os.unlink(path)
+            return digest
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(path), target)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        with open(self.path(digest), "rb") as f:
+            return f.read()
+
+    def remove(self, digest: str):
+        try:
+            self.path(digest).unlink()
+        except FileNotFoundError:
+            pass
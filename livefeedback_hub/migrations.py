@@ -0,0 +1,114 @@
+from typing import Any, Callable, List
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from livefeedback_hub.db import Base, SchemaVersion
+
+
+def _add_lookup_indexes(connection: Connection, service):
+    """
+    Adds indexes for the lookups of tasks by owner and of results by assignment
+    """
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_autograder_zips_owner ON autograder_zips (owner)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_results_assignment ON results (assignment)"))
+
+
+def _move_zips_to_store(connection: Connection, service):
+    """
+    Moves the autograder zips from the data column into the zip store and keeps only their digest
+    """
+    columns = {column["name"] for column in inspect(connection).get_columns("autograder_zips")}
+    if "digest" not in columns:
+        connection.execute(text("ALTER TABLE autograder_zips ADD COLUMN digest VARCHAR"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_autograder_zips_digest ON autograder_zips (digest)"))
+    if "data" not in columns:
+        return
+
+    ids = [row.id for row in connection.execute(text("SELECT id FROM autograder_zips WHERE data IS NOT NULL"))]
+    for id in ids:
+        # Load one zip at a time to keep the memory usage low
+        data = connection.execute(text("SELECT data FROM autograder_zips WHERE id = :id"), {"id": id}).scalar()
+        digest = service.zip_store.put(bytes(data))
+        connection.execute(text("UPDATE autograder_zips SET digest = :digest, data = NULL WHERE id = :id"), {"digest": digest, "id": id})
+    service.log.info(f"Moved {len(ids)} zips to {service.zip_store.root}")
+
+    if connection.dialect.name != "sqlite" or connection.dialect.server_version_info >= (3, 35):
+        connection.execute(text("ALTER TABLE autograder_zips DROP COLUMN data"))
+
+
+def _add_deleted_state(connection: Connection, service):
+    """
+    Adds the state of tasks whose deletion is pending to the enum type of PostgreSQL databases
+    """
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("ALTER TYPE state ADD VALUE IF NOT EXISTS 'deleted'"))
+
+
+def _add_received_columns(connection: Connection, service):
+    """
+    Adds the time a submission was received to the backlog and the job queue
+    """
+    for table in ["backlog", "jobs"]:
+        if "received" not in {column["name"] for column in inspect(connection).get_columns(table)}:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN received FLOAT"))
+
+
+def _add_activity_index(connection: Connection, service):
+    """
+    Adds the index used for the submission statistics of the overview
+    """
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_job_timings_assignment_finished ON job_timings (assignment, finished)"))
+
+
+def _add_result_received(connection: Connection, service):
+    """
+    Adds the time the graded submission was received to the results
+    """
+    if "received" not in {column["name"] for column in inspect(connection).get_columns("results")}:
+        connection.execute(text("ALTER TABLE results ADD COLUMN received FLOAT"))
+
+
+def _drop_timing_assignment_index(connection: Connection, service):
+    """
+    Drops the index of the timings by task, which duplicates the leading column of ix_job_timings_assignment_finished
+    """
+    connection.execute(text("DROP INDEX IF EXISTS ix_job_timings_assignment"))
+
+
+# Migrations are applied in order and must never be reordered or removed. The schema version of a database is the
+# number of applied migrations. New databases are created from the current models and start at the latest version.
+MIGRATIONS: List[Callable[[Connection, Any], None]] = [
+    _add_lookup_indexes,
+    _move_zips_to_store,
+    _add_deleted_state,
+    _add_received_columns,
+    _add_activity_index,
+    _add_result_received,
+    _drop_timing_assignment_index,
+]
+
+
+def migrate(engine: Engine, service) -> int:
+    """
+    Creates missing tables and applies all pending migrations
+    :param engine: the engine of the service database
+    :param service: a service instance used for logging and accessing the zip store
+    :return: the schema version of the database
+    """
+    with engine.begin() as connection:
+        existing = inspect(connection).has_table("autograder_zips")
+        Base.metadata.create_all(connection)
+        entry = connection.execute(SchemaVersion.__table__.select()).first()
+        if entry is None:
+            version = 0 if existing else len(MIGRATIONS)
+            connection.execute(SchemaVersion.__table__.insert().values(version=version))
+        else:
+            version = entry.version
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            service.log.info(f"Migrating database schema to version {number}")
+            migration(connection, service)
+            connection.execute(SchemaVersion.__table__.update().values(version=number))
+
+        return max(version, len(MIGRATIONS))
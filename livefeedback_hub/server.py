@@ -1,31 +1,115 @@
 import logging
 import os
 import pathlib
+import signal
 from urllib.parse import urlparse
 
 import sqlalchemy.orm
 from jupyterhub.services.auth import HubOAuthCallbackHandler
 from jupyterhub.utils import url_path_join
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import URL, make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlalchemy.util.compat import contextmanager
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
 from tornado.web import Application as TornadoApplication
-from traitlets import Unicode, default
+from traitlets import Bool, CaselessStrEnum, Float, Integer, Unicode, default
 from traitlets.config.application import Application
 
-from livefeedback_hub.db import Base, GUID_REGEX
+from livefeedback_hub.db import GUID_REGEX
+from livefeedback_hub.helper.image_gc import ImageCollector
+from livefeedback_hub.helper.job_queue import JobQueue
+from livefeedback_hub.helper.local_grader import LocalGrader
+from livefeedback_hub.helper.metrics import ServiceMetrics
+from livefeedback_hub.helper.profiler import SamplingProfiler
+from livefeedback_hub.helper.result_notifier import ResultNotifier
+from livefeedback_hub.helper.result_writer import ResultWriter
+from livefeedback_hub.helper.scheduler_state import DatabaseSchedulerState, SchedulerState
+from livefeedback_hub.helper.shutdown import ShutdownManager
+from livefeedback_hub.helper.zip_store import ZipStore
+from livefeedback_hub.migrations import migrate
 
 
 class JupyterService(Application):
     url = Unicode()
     prefix = Unicode()
     db_url = Unicode()
+    zip_store_path = Unicode()
+    image_cache_path = Unicode()
+    image_disk_budget = Integer(0)
+    image_gc_interval = Float(300)
+    image_gc_min_idle = Integer(3600)
+    db_pool_size = Integer(5)
+    db_max_overflow = Integer(10)
+    db_pool_pre_ping = Bool(True)
+    db_pool_recycle = Integer(3600)
+    sqlite_journal_mode = CaselessStrEnum(["WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "OFF"], default_value="WAL")
+    sqlite_synchronous = CaselessStrEnum(["OFF", "NORMAL", "FULL", "EXTRA"], default_value="NORMAL")
+    sqlite_busy_timeout = Float(30.0)
+    result_flush_interval = Float(0.5)
+    result_wait_timeout = Float(60)
+    priority_max_wait = Float(60)
+    timing_window = Integer(1000)
+    history_max_window = Integer(24 * 60)
+    export_chunk_size = Integer(1000)
+    overview_page_size = Integer(25)
+    profile_max_duration = Float(60)
+    metrics_token = Unicode()
+    cookie_secret = Unicode()
+    shutdown_timeout = Float(60)
+    scheduler_backend = CaselessStrEnum(["local", "database"], default_value="local")
+    scheduler_stale_timeout = Integer(900)
+    execution_backend = CaselessStrEnum(["local", "worker"], default_value="local")
+    worker_poll_interval = Float(1.0)
+    worker_concurrency = Integer(16)
+    grading_backend = CaselessStrEnum(["docker", "local"], default_value="docker")
+    local_environment_path = Unicode()
+    local_grading_timeout = Integer(300)
+    max_zip_size = Integer(100 * 1024 * 1024)
+    max_zip_extracted_size = Integer(500 * 1024 * 1024)
+    max_zip_entries = Integer(10000)
 
     @default("db_url")
     def _default_db_url(self):
-        return os.environ.get("SERVICE_DB_URL", f"sqlite:///{pathlib.Path(__file__).parent.resolve()}\\data.db")
+        return os.environ.get("SERVICE_DB_URL", f"sqlite:///{pathlib.Path(__file__).parent.resolve() / 'data.db'}")
+
+    @default("zip_store_path")
+    def _default_zip_store_path(self):
+        return os.environ.get("SERVICE_ZIP_STORE", str(pathlib.Path(__file__).parent.resolve() / "zips"))
+
+    @default("image_cache_path")
+    def _default_image_cache_path(self):
+        return os.environ.get("SERVICE_IMAGE_CACHE", "")
+
+    @default("scheduler_backend")
+    def _default_scheduler_backend(self):
+        return os.environ.get("SERVICE_SCHEDULER_BACKEND", "local")
+
+    @default("execution_backend")
+    def _default_execution_backend(self):
+        return os.environ.get("SERVICE_EXECUTION_BACKEND", "local")
+
+    @default("grading_backend")
+    def _default_grading_backend(self):
+        return os.environ.get("SERVICE_GRADING_BACKEND", "docker")
+
+    @default("local_environment_path")
+    def _default_local_environment_path(self):
+        return os.environ.get("SERVICE_LOCAL_ENVIRONMENTS", str(pathlib.Path(__file__).parent.resolve() / "environments"))
+
+    @default("metrics_token")
+    def _default_metrics_token(self):
+        return os.environ.get("SERVICE_METRICS_TOKEN", "")
+
+    @default("cookie_secret")
+    def _default_cookie_secret(self):
+        return os.environ.get("SERVICE_COOKIE_SECRET", "")
+
+    @default("shutdown_timeout")
+    def _default_shutdown_timeout(self):
+        return float(os.environ.get("SERVICE_SHUTDOWN_TIMEOUT", 60))
 
     @default("prefix")
     def _default_prefix(self):
@@ -35,9 +119,46 @@ class JupyterService(Application):
     def _default_url(self):
         return os.environ.get("JUPYTERHUB_SERVICE_URL", "http://[::]:5000")
 
+    def _engine_options(self, url: URL) -> dict:
+        """
+        Collects the engine settings for the configured database
+        :param url: the parsed database url
+        :return: keyword arguments for create_engine
+        """
+        if url.get_backend_name() == "sqlite":
+            # Connections are shared between the IOLoop, the executors and the result writer
+            options = {"connect_args": {"check_same_thread": False, "timeout": self.sqlite_busy_timeout}}
+            if url.database in (None, "", ":memory:"):
+                # Every connection to an in-memory database opens a new database, so all threads share a single one
+                options["poolclass"] = StaticPool
+            else:
+                options["poolclass"] = QueuePool
+                options["pool_size"] = self.db_pool_size
+                options["max_overflow"] = self.db_max_overflow
+            return options
+        return {
+            "pool_size": self.db_pool_size,
+            "max_overflow": self.db_max_overflow,
+            "pool_pre_ping": self.db_pool_pre_ping,
+            "pool_recycle": self.db_pool_recycle,
+        }
+
+    def _set_sqlite_pragmas(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"PRAGMA journal_mode={self.sqlite_journal_mode}")
+            cursor.execute(f"PRAGMA synchronous={self.sqlite_synchronous}")
+        finally:
+            cursor.close()
+
     def _init_db(self):
-        engine = create_engine(url=self.db_url)
-        Base.metadata.create_all(engine)
+        url = make_url(self.db_url)
+        engine = create_engine(url, **self._engine_options(url))
+        if url.get_backend_name() == "sqlite":
+            event.listen(engine, "connect", self._set_sqlite_pragmas)
+        self.metrics.instrument_engine(engine)
+        migrate(engine, self)
+        self.engine = engine
         self.db = sessionmaker(bind=engine)
 
     @contextmanager
@@ -54,13 +175,35 @@ class JupyterService(Application):
 
     def __init__(self, **kwargs):
         from livefeedback_hub.handlers.manage import FeedbackManagementHandler, FeedbackZipAddHandler, FeedbackZipUpdateHandler, FeedbackZipDeleteHandler
-        from livefeedback_hub.handlers.results import FeedbackResultsApiHandler, FeedbackResultsHandler
-        from livefeedback_hub.handlers.submission import FeedbackSubmissionHandler
+        from livefeedback_hub.handlers.results import FeedbackExportApiHandler, FeedbackHistoryApiHandler, FeedbackResultsApiHandler, FeedbackResultsHandler, \
+            FeedbackTimingsApiHandler, FeedbackUserResultApiHandler
+        from livefeedback_hub.handlers.health import HealthHandler
+        from livefeedback_hub.handlers.metrics import MetricsHandler
+        from livefeedback_hub.handlers.profile import ProfileHandler
+        from livefeedback_hub.handlers.submission import FeedbackSubmissionHandler, submission_executor
 
         super().__init__(**kwargs)
         logging.basicConfig(level=logging.INFO)
-        self._init_db()
         self.log: logging.Logger = logging.getLogger("tornado.application")
+        self.zip_store = ZipStore(self.zip_store_path)
+        self.metrics = ServiceMetrics(self)
+        self._init_db()
+        self.result_notifier = ResultNotifier(ttl=self.scheduler_stale_timeout)
+        self.shutdown_manager = ShutdownManager(self)
+        self.profiler = SamplingProfiler()
+        submission_executor.max_wait = self.priority_max_wait
+        self.result_writer = ResultWriter(self, interval=self.result_flush_interval)
+        self.local_grader = LocalGrader(self, self.local_environment_path, timeout=self.local_grading_timeout)
+        self.image_collector = ImageCollector(self, self.image_disk_budget, interval=self.image_gc_interval, min_idle=self.image_gc_min_idle)
+        self.job_queue = JobQueue(self, stale_timeout=self.scheduler_stale_timeout)
+        # Grading workers run in separate processes and therefore always share the scheduler state via the database
+        if self.scheduler_backend == "database" or self.execution_backend == "worker":
+            self.scheduler = DatabaseSchedulerState(self, stale_timeout=self.scheduler_stale_timeout)
+        else:
+            self.scheduler = SchedulerState()
+        if not self.cookie_secret and self.scheduler_backend == "database":
+            # The login cookies are signed with the secret, so other processes reject the cookies of this one
+            self.log.warning("SERVICE_COOKIE_SECRET is not set, logins are only accepted by the process which handled them")
         xsrf_cookies = True
         if "xsrf_cookies" in kwargs:
             xsrf_cookies = kwargs["xsrf_cookies"]
@@ -73,6 +216,14 @@ class JupyterService(Application):
                 (url_path_join(self.prefix, f"manage/delete/({GUID_REGEX})"), FeedbackZipDeleteHandler, {"service": self}),
                 (url_path_join(self.prefix, f"results/({GUID_REGEX})"), FeedbackResultsHandler, {"service": self}),
                 (url_path_join(self.prefix, f"api/results/({GUID_REGEX})"), FeedbackResultsApiHandler, {"service": self}),
+                (url_path_join(self.prefix, f"api/timings/({GUID_REGEX})"), FeedbackTimingsApiHandler, {"service": self}),
+                (url_path_join(self.prefix, f"api/feedback/({GUID_REGEX})"), FeedbackUserResultApiHandler, {"service": self}),
+                (url_path_join(self.prefix, f"api/history/({GUID_REGEX})"), FeedbackHistoryApiHandler, {"service": self}),
+                (url_path_join(self.prefix, "api/export"), FeedbackExportApiHandler, {"service": self}),
+                (url_path_join(self.prefix, f"api/export/({GUID_REGEX})"), FeedbackExportApiHandler, {"service": self}),
+                (url_path_join(self.prefix, "metrics"), MetricsHandler, {"service": self}),
+                (url_path_join(self.prefix, "health"), HealthHandler, {"service": self}),
+                (url_path_join(self.prefix, "profile"), ProfileHandler, {"service": self}),
                 (
                     url_path_join(self.prefix, "oauth_callback"),
                     HubOAuthCallbackHandler,
@@ -81,22 +232,62 @@ class JupyterService(Application):
             template_path=os.path.join(os.path.dirname(__file__), "templates"),
             static_path=os.path.join(os.path.dirname(__file__), "static"),
             static_url_prefix=url_path_join(self.prefix, "static/"),
-            cookie_secret=os.urandom(32),
+            cookie_secret=self.cookie_secret or os.urandom(32),
             xsrf_cookies=xsrf_cookies,
         )
 
     def start(self):
         self.log.info("Starting server")
-        http_server = HTTPServer(self.app)
+        self.http_server = HTTPServer(self.app)
         url = urlparse(self.url)
-        http_server.listen(url.port, url.hostname)
+        self.http_server.listen(url.port, url.hostname)
         self.log.info("Listening on %s", self.url)
-        IOLoop.current().start()
+        self.result_writer.start()
+        if self.grading_backend == "local":
+            self.local_grader.start()
+        from livefeedback_hub.handlers.manage import reconcile_images, resume_deletions
+        from livefeedback_hub.helper.misc import roster
+
+        # SIGHUP does not exist on Windows, the roster is still reloaded once its file changes
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda signum, frame: roster.reload())
+        loop = IOLoop.current()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: loop.add_callback_from_signal(self.shutdown))
+        resume_deletions(self)
+        if self.execution_backend == "local":
+            self.shutdown_manager.resume()
+            reconcile_images(self)
+            if self.grading_backend == "docker":
+                self.image_collector.start()
+        try:
+            loop.start()
+        finally:
+            self.image_collector.stop()
+            self.result_writer.stop()
+
+    async def shutdown(self):
+        """
+        Stops accepting new work, waits up to shutdown_timeout seconds for the queued and running work and checkpoints
+        the remaining work to the database before the IOLoop is stopped
+        """
+        if self.shutdown_manager.draining:
+            return
+        self.log.info(f"Shutting down, waiting up to {self.shutdown_timeout}s for running jobs")
+        self.shutdown_manager.begin()
+        if not await self.shutdown_manager.drain(self.shutdown_timeout):
+            self.shutdown_manager.checkpoint()
+        self.http_server.stop()
+        IOLoop.current().stop()
 
 
 def main(**kwargs):
     service = JupyterService(**kwargs)
     service.start()
+    if service.shutdown_manager.checkpointed:
+        # Exiting would otherwise wait for the running gradings, which are resumed after the restart anyway
+        logging.shutdown()
+        os._exit(0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Set
+
+from livefeedback_hub.db import Job, JobKind
+from livefeedback_hub.handlers.manage import build, manage_executor, reconcile_images
+from livefeedback_hub.handlers.submission import process_notebook, submission_executor
+from livefeedback_hub.server import JupyterService
+
+
+class Worker:
+    """
+    Grading worker running the jobs queued by the web processes. Every worker uses the docker daemon of its host, missing
+    images are built from the shared zip store before grading.
+    """
+
+    def __init__(self, service: JupyterService):
+        self.service = service
+        self.id = f"{socket.gethostname()}:{os.getpid()}"
+        self._slots = threading.BoundedSemaphore(service.worker_concurrency)
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._claimed: Set[int] = set()
+        # Claims are refreshed well before they are considered stale, e.g. builds are not bounded by a timeout
+        self.heartbeat_interval = max(service.scheduler_stale_timeout / 3, service.worker_poll_interval)
+        self._heartbeat_at = time.monotonic()
+
+    def run_once(self) -> bool:
+        """
+        Claims a job if a slot is free and runs it in the background
+        :return: flag indicating whether a job was claimed
+        """
+        if not self._slots.acquire(timeout=self.service.worker_poll_interval):
+            return False
+        try:
+            job = self.service.job_queue.claim(self.id)
+        except Exception:
+            self._slots.release()
+            raise
+        if job is None:
+            self._slots.release()
+            return False
+        self.service.log.info(f"Worker {self.id} claimed {job.kind.name} job {job.id} for {job.assignment}")
+        with self._lock:
+            self._claimed.add(job.id)
+        executor = manage_executor if job.kind == JobKind.build else submission_executor
+        executor.submit(self._execute, job)
+        return True
+
+    def _execute(self, job: Job):
+        try:
+            if job.kind == JobKind.build:
+                build(self.service, job.assignment, job.zip_digest, update=job.update)
+            else:
+                process_notebook(self.service, zip_digest=job.zip_digest, notebook=job.notebook, id=job.assignment, user_hash=job.user, received=job.received)
+        except Exception as e:
+            self.service.log.exception(e)
+        finally:
+            with self._lock:
+                self._claimed.discard(job.id)
+            self.service.job_queue.complete(job.id)
+            self._slots.release()
+
+    def heartbeat(self, force: bool = False) -> int:
+        """
+        Refreshes the claims of the running jobs once the heartbeat interval passed
+        :param force: flag indicating whether the claims are refreshed regardless of the interval
+        :return: the number of refreshed claims
+        """
+        if not force and time.monotonic() - self._heartbeat_at < self.heartbeat_interval:
+            return 0
+        self._heartbeat_at = time.monotonic()
+        with self._lock:
+            claimed = list(self._claimed)
+        return self.service.job_queue.heartbeat(self.id, claimed)
+
+    def run(self):
+        self.service.log.info(f"Starting grading worker {self.id}")
+        self.service.result_writer.start()
+        if self.service.grading_backend == "local":
+            self.service.local_grader.start()
+        reconcile_images(self.service)
+        if self.service.grading_backend == "docker":
+            self.service.image_collector.start()
+        try:
+            while not self._stopped.is_set():
+                try:
+                    self.heartbeat()
+                    claimed = self.run_once()
+                except Exception as e:
+                    self.service.log.exception(e)
+                    claimed = False
+                if not claimed:
+                    self._stopped.wait(self.service.worker_poll_interval)
+        finally:
+            # Wait for the claimed jobs before writing the remaining results, their claims must not go stale meanwhile
+            acquired = 0
+            while acquired < self.service.worker_concurrency:
+                if self._slots.acquire(timeout=self.service.worker_poll_interval):
+                    acquired += 1
+                else:
+                    try:
+                        self.heartbeat()
+                    except Exception as e:
+                        self.service.log.exception(e)
+            self.service.image_collector.stop()
+            self.service.result_writer.stop()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def main(**kwargs):
+    kwargs.setdefault("execution_backend", "worker")
+    worker = Worker(JupyterService(**kwargs))
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -29,6 +29,7 @@ setup_args = dict(
     long_description_content_type="text/markdown",
     packages=setuptools.find_packages(),
     install_requires=install_requires,
+    extras_require={"postgres": ["psycopg2-binary"], "parquet": ["pyarrow"]},
     zip_safe=False,
     include_package_data=True,
     python_requires=">=3.6",
@@ -48,6 +49,7 @@ setup_args = dict(
         "console_scripts": [
             "livefeedback-hub.py = livefeedback_hub.server:main",
             "livefeedback-hub = livefeedback_hub.server:main",
+            "livefeedback-hub-worker = livefeedback_hub.worker:main",
         ]
     },
 )
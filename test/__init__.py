@@ -1,2 +1,4 @@
 import os
+import tempfile
 os.environ["SERVICE_DB_URL"] = "sqlite:///:memory:"
+os.environ["SERVICE_ZIP_STORE"] = tempfile.mkdtemp()
@@ -0,0 +1,231 @@
+"""
+Load test of the submission and results pipelines.
+
+Starts a JupyterService with a stubbed grader instead of otter's docker containers, simulates students submitting (and
+resubmitting) notebooks and teachers polling the results API and reports throughput, queue wait and latencies.
+
+    python -m test.benchmark --students 300 --tasks 3 --duration 120 --latency 2
+"""
+import argparse
+import asyncio
+import json
+import random
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from unittest.mock import patch
+
+import pandas as pd
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from livefeedback_hub.db import AutograderZip, JobTiming, State
+from livefeedback_hub.handlers.submission import submission_executor
+from livefeedback_hub.helper.misc import get_user_hash
+from livefeedback_hub.helper.timings import PERCENTILES, STAGES, percentile
+from livefeedback_hub.server import JupyterService
+
+USER_HEADER = "X-Benchmark-User"
+
+
+@dataclass
+class Config:
+    students: int = 100
+    teachers: int = 2
+    tasks: int = 2
+    # Seconds students keep working on their tasks
+    duration: float = 30.0
+    # Students send their first submission within this share of the duration
+    ramp_up: float = 0.2
+    # Mean seconds between two submissions of a student
+    think_time: float = 10.0
+    # Probability that a student submits again after the previous submission
+    resubmit: float = 0.8
+    # Mean and standard deviation of the stubbed grading in seconds
+    latency: float = 1.0
+    jitter: float = 0.2
+    questions: int = 5
+    poll_interval: float = 2.0
+    db_url: Optional[str] = None
+    seed: Optional[int] = None
+
+
+@dataclass
+class Recorder:
+    submissions: List[float] = field(default_factory=list)
+    polls: List[float] = field(default_factory=list)
+    errors: Dict[str, int] = field(default_factory=dict)
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def _notebook(task: str, attempt: int) -> bytes:
+    cells = [{"cell_type": "code", "metadata": {}, "source": f"# LIVE: {task}", "outputs": [], "execution_count": None},
+             {"cell_type": "code", "metadata": {}, "source": f"answer = {attempt}", "outputs": [], "execution_count": None}]
+    return json.dumps({"cells": cells, "metadata": {}, "nbformat": 4, "nbformat_minor": 4}).encode("utf-8")
+
+
+def _grader(config: Config, rng: random.Random):
+    """
+    Replacement of containers.grade_assignments sleeping for the configured latency
+    """
+
+    def grade(path, image, **kwargs):
+        time.sleep(max(rng.gauss(config.latency, config.jitter), 0.0))
+        scores = {f"q{i}": [float(rng.random() < 0.7)] for i in range(1, config.questions + 1)}
+        scores["file"] = [path]
+        return pd.DataFrame(scores)
+
+    return grade
+
+
+def _current_user(handler):
+    name = handler.request.headers.get(USER_HEADER)
+    return {"name": name, "groups": []} if name else None
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    if len(values) == 0:
+        return {}
+    return {f"p{q}": percentile(values, q) for q in PERCENTILES}
+
+
+async def _student(client: AsyncHTTPClient, base: str, name: str, task: str, config: Config, rng: random.Random, recorder: Recorder, deadline: float):
+    await asyncio.sleep(rng.uniform(0, config.duration * config.ramp_up))
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        response = await client.fetch(f"{base}/submit", method="POST", body=_notebook(task, attempt), headers={USER_HEADER: name}, raise_error=False)
+        recorder.submissions.append(time.perf_counter() - started)
+        if response.code != 200:
+            recorder.error(f"submit {response.code}")
+        attempt += 1
+        think = rng.expovariate(1 / config.think_time)
+        if rng.random() > config.resubmit or time.monotonic() + think > deadline:
+            return
+        await asyncio.sleep(think)
+
+
+async def _teacher(client: AsyncHTTPClient, base: str, name: str, tasks: List[str], config: Config, recorder: Recorder, deadline: float):
+    while time.monotonic() < deadline:
+        for task in tasks:
+            started = time.perf_counter()
+            response = await client.fetch(f"{base}/api/results/{task}", headers={USER_HEADER: name}, raise_error=False)
+            recorder.polls.append(time.perf_counter() - started)
+            if response.code not in (200, 204):
+                recorder.error(f"results {response.code}")
+        await asyncio.sleep(config.poll_interval)
+
+
+async def _drain(service: JupyterService, interval: float = 0.1):
+    """
+    Waits until all queued submissions are graded
+    """
+    idle = 0
+    while idle < 3:
+        await asyncio.sleep(interval)
+        with service.scheduler.lock():
+            busy = submission_executor._work_queue.qsize() + service.scheduler.running_count() + service.scheduler.backlog_size()
+        idle = idle + 1 if busy == 0 else 0
+    service.result_writer.flush()
+
+
+async def run(config: Config) -> Dict[str, object]:
+    """
+    Runs the load test
+    :param config: the simulated load
+    :return: the measured throughput and latencies
+    """
+    rng = random.Random(config.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            patch("jupyterhub.services.auth.HubAuthenticated.get_current_user", new=_current_user), \
+            patch("livefeedback_hub.handlers.submission.ensure_image"), \
+            patch("otter.grade.containers.grade_assignments", new=_grader(config, random.Random(config.seed))):
+        service = JupyterService(xsrf_cookies=False, db_url=config.db_url or f"sqlite:///{tmp_dir}/data.db", zip_store_path=f"{tmp_dir}/zips")
+        teachers = [f"teacher{i}" for i in range(config.teachers)]
+        tasks: Dict[str, List[str]] = {teacher: [] for teacher in teachers}
+        with service.session() as session:
+            for i in range(config.tasks):
+                task, teacher = str(uuid.uuid4()), teachers[i % len(teachers)]
+                session.add(AutograderZip(id=task, owner=get_user_hash({"name": teacher}), description=f"Benchmark {i}", digest=uuid.uuid4().hex, state=State.ready))
+                tasks[teacher].append(task)
+        all_tasks = [task for owned in tasks.values() for task in owned]
+
+        sock, port = bind_unused_port()
+        server = HTTPServer(service.app)
+        server.add_sockets([sock])
+        service.result_writer.start()
+        base = f"http://127.0.0.1:{port}{service.prefix.rstrip('/')}"
+        client = AsyncHTTPClient(force_instance=True, max_clients=config.students + config.teachers)
+        recorder = Recorder()
+        try:
+            started = time.monotonic()
+            deadline = started + config.duration
+            students = [_student(client, base, f"student{i}", rng.choice(all_tasks), config, rng, recorder, deadline) for i in range(config.students)]
+            polling = [_teacher(client, base, teacher, tasks[teacher], config, recorder, deadline) for teacher in teachers if tasks[teacher]]
+            await asyncio.gather(*students, *polling)
+            submitted = time.monotonic()
+            await _drain(service)
+            finished = time.monotonic()
+        finally:
+            client.close()
+            server.stop()
+            service.result_writer.stop()
+
+        with service.session() as session:
+            rows = session.query(*[getattr(JobTiming, stage) for stage in STAGES]).filter(JobTiming.assignment.in_(all_tasks)).all()
+        service.engine.dispose()
+
+    graded = len(rows)
+    report: Dict[str, object] = {
+        "submissions": len(recorder.submissions),
+        "graded": graded,
+        # Queued submissions replaced by a newer submission of the same student are never graded
+        "superseded": len(recorder.submissions) - graded,
+        "polls": len(recorder.polls),
+        "errors": recorder.errors,
+        "duration": finished - started,
+        "drain": finished - submitted,
+        "throughput": graded / (finished - started),
+        "submit_latency": _summary(recorder.submissions),
+        "results_latency": _summary(recorder.polls),
+    }
+    for i, stage in enumerate(STAGES):
+        report[stage] = _summary([row[i] or 0.0 for row in rows])
+    report["total"] = _summary([sum(value or 0.0 for value in row) for row in rows])
+    return report
+
+
+def _print(report: Dict[str, object]):
+    print(f"Submissions: {report['submissions']} ({report['graded']} graded, {report['superseded']} superseded), polls: {report['polls']}")
+    print(f"Duration: {report['duration']:.1f}s (drained in {report['drain']:.1f}s), throughput: {report['throughput']:.2f} gradings/s")
+    if report["errors"]:
+        print(f"Errors: {report['errors']}")
+    print(f"{'':<16}" + "".join(f"{f'p{q}':>10}" for q in PERCENTILES))
+    for key in ["submit_latency", "results_latency", *STAGES, "total"]:
+        values = report[key]
+        print(f"{key:<16}" + "".join(f"{values.get(f'p{q}', float('nan')):>10.3f}" for q in PERCENTILES))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    for name, value in Config().__dict__.items():
+        kind = {"db_url": str, "seed": int}.get(name, type(value))
+        parser.add_argument(f"--{name.replace('_', '-')}", type=kind, default=value)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = vars(parser.parse_args(argv))
+    as_json = args.pop("json")
+    report = asyncio.run(run(Config(**args)))
+    if as_json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print(report)
+
+
+if __name__ == "__main__":
+    main()
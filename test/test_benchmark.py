@@ -0,0 +1,16 @@
+import asyncio
+
+from test.benchmark import Config, run
+
+
+class TestBenchmark:
+
+    def test_run(self):
+        config = Config(students=20, teachers=1, tasks=2, duration=1.5, think_time=0.3, latency=0.02, jitter=0.0, poll_interval=0.2, seed=1)
+        report = asyncio.run(run(config))
+        assert report["errors"] == {}
+        assert report["submissions"] >= 20
+        assert 0 < report["graded"] <= report["submissions"]
+        assert report["polls"] > 0
+        assert report["queue"]["p50"] <= report["queue"]["p99"]
+        assert report["grading"]["p50"] >= 0.02
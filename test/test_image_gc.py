@@ -0,0 +1,101 @@
+import datetime
+from unittest.mock import MagicMock, patch
+
+from otter.grade import utils
+
+from livefeedback_hub.db import AutograderZip, ImageUsage, State
+from livefeedback_hub.handlers import manage
+from livefeedback_hub.server import JupyterService
+from test.test_manage import autograder_zip
+
+
+class TestImageCollector:
+
+    def test_touch(self):
+        service = JupyterService()
+        service.image_collector.touch("a")
+        service.image_collector.flush()
+        with service.session() as session:
+            first = session.query(ImageUsage).get("a").last_used
+        service.image_collector.touch("a")
+        service.image_collector.flush()
+        with service.session() as session:
+            assert session.query(ImageUsage).get("a").last_used >= first
+            session.query(ImageUsage).delete()
+
+    @patch("python_on_whales.docker")
+    def test_collect(self, docker: MagicMock):
+        service = JupyterService(image_disk_budget=100, image_gc_min_idle=3600)
+        old = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "setup.sh")))
+        older = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "setup.sh", "tests/q1.py")))
+        recent = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "setup.sh", "tests/q2.py")))
+        building = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "requirements.txt")))
+        unknown = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "requirements.txt", "setup.sh")))
+        now = datetime.datetime.utcnow()
+        with service.session() as session:
+            session.add(ImageUsage(digest=old, last_used=now - datetime.timedelta(days=1)))
+            session.add(ImageUsage(digest=older, last_used=now - datetime.timedelta(days=2)))
+            session.add(ImageUsage(digest=recent, last_used=now))
+            session.add(AutograderZip(id="1", state=State.building, digest=building))
+
+        fresh = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "tests/q3.py")))
+        created = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=3)
+        images = [MagicMock(repo_tags=[f"{utils.OTTER_DOCKER_IMAGE_TAG}:{digest}"], created=created) for digest in [old, older, recent, building, unknown]]
+        # Built but not graded yet, so no use is recorded
+        images.append(MagicMock(repo_tags=[f"{utils.OTTER_DOCKER_IMAGE_TAG}:{fresh}"], created=datetime.datetime.now(datetime.timezone.utc)))
+        docker.image.list.return_value = images + [MagicMock(repo_tags=["ubuntu:latest"], created=created)]
+        sizes = iter([400, 300, 200, 100])
+        docker.system.disk_free.side_effect = lambda: MagicMock(images=MagicMock(size=next(sizes)))
+
+        removed = service.image_collector.collect()
+        # Images without recorded use count as used when they were created, recent, new and building images are kept
+        assert removed == [unknown, older, old]
+        removed_images = [args.args[0] for args in docker.image.remove.call_args_list]
+        assert removed_images[0] == f"{utils.OTTER_DOCKER_IMAGE_TAG}:{unknown}"
+        assert manage.environment_image(service, unknown) in removed_images
+        # The environment of older is still used by old and recent
+        assert removed_images[2] == f"{utils.OTTER_DOCKER_IMAGE_TAG}:{older}"
+        assert removed_images[3] == f"{utils.OTTER_DOCKER_IMAGE_TAG}:{old}"
+        assert manage.environment_image(service, old) not in removed_images
+        with service.session() as session:
+            session.query(ImageUsage).delete()
+            session.query(AutograderZip).delete()
+
+    @patch("python_on_whales.docker")
+    def test_collect_within_budget(self, docker: MagicMock):
+        service = JupyterService(image_disk_budget=100)
+        docker.system.disk_free.return_value = MagicMock(images=MagicMock(size=100))
+        assert service.image_collector.collect() == []
+        docker.image.remove.assert_not_called()
+
+        service = JupyterService()
+        assert service.image_collector.collect() == []
+        docker.system.disk_free.assert_called_once()
+
+    @patch("livefeedback_hub.handlers.manage.manage_executor.submit", side_effect=lambda fn, *args: fn(*args))
+    @patch("livefeedback_hub.handlers.manage.ensure_image")
+    @patch("python_on_whales.docker")
+    def test_restart_after_collect(self, docker: MagicMock, ensure_image: MagicMock, submit: MagicMock, tmp_path):
+        service = JupyterService(db_url=f"sqlite:///{tmp_path / 'data.db'}", zip_store_path=str(tmp_path / "zips"), image_disk_budget=100, image_gc_min_idle=3600)
+        old = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "setup.sh")))
+        recent = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "requirements.txt")))
+        now = datetime.datetime.utcnow()
+        with service.session() as session:
+            session.add(AutograderZip(id="old", state=State.ready, digest=old))
+            session.add(AutograderZip(id="recent", state=State.ready, digest=recent))
+            session.add(ImageUsage(digest=old, last_used=now - datetime.timedelta(days=1)))
+        service.image_collector.touch(recent)
+        created = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=2)
+        docker.image.list.return_value = [MagicMock(repo_tags=[f"{utils.OTTER_DOCKER_IMAGE_TAG}:{digest}"], created=created) for digest in [old, recent]]
+        sizes = iter([200, 100])
+        docker.system.disk_free.side_effect = lambda: MagicMock(images=MagicMock(size=next(sizes)))
+        assert service.image_collector.collect() == [old]
+
+        # After a restart only the recently used image is restored, the evicted one is built again on its next use
+        restarted = JupyterService(db_url=f"sqlite:///{tmp_path / 'data.db'}", zip_store_path=str(tmp_path / "zips"), image_disk_budget=100, image_gc_min_idle=3600)
+        manage.reconcile_images(restarted)
+        ensure_image.assert_called_once_with(restarted, "recent", recent)
+
+        ensure_image.reset_mock()
+        manage.reconcile_images(JupyterService(db_url=f"sqlite:///{tmp_path / 'data.db'}", zip_store_path=str(tmp_path / "zips")))
+        assert ensure_image.call_count == 2
@@ -0,0 +1,83 @@
+import io
+import json
+import zipfile
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+
+from livefeedback_hub.db import AutograderZip, Result, State
+from livefeedback_hub.handlers import manage, submission
+from livefeedback_hub.server import JupyterService
+from test.test_submission import add_task
+
+test_q1 = 'test = {"name": "q1", "points": 1, "suites": [{"cases": [{"code": ">>> x == 1\\nTrue", "hidden": False, "locked": False}], "scored": True, "setup": "", "teardown": "", "type": "doctest"}]}'
+
+
+def autograder_zip() -> bytes:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as zip_ref:
+        zip_ref.writestr("run_autograder", "")
+        zip_ref.writestr("otter_config.json", "{}")
+        zip_ref.writestr("tests/q1.py", test_q1)
+    return data.getvalue()
+
+
+def notebook(source: str) -> str:
+    return json.dumps({
+        "cells": [{"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [], "source": source}],
+        "metadata": {"kernelspec": {"display_name": "Python 3", "language": "python", "name": "python3"}},
+        "nbformat": 4,
+        "nbformat_minor": 4,
+    })
+
+
+class TestLocalGrader:
+
+    def test_prepare(self, tmp_path):
+        service = JupyterService(grading_backend="local", local_environment_path=str(tmp_path))
+        digest = service.zip_store.put(autograder_zip())
+        env = service.local_grader.prepare(digest)
+        assert (env / "source" / "tests" / "q1.py").is_file()
+        assert not (env / "packages").exists()
+        assert service.local_grader.prepare(digest) == env
+        service.local_grader.remove(digest)
+        assert not env.exists()
+
+    def test_grade(self, tmp_path):
+        service = JupyterService(grading_backend="local", local_environment_path=str(tmp_path / "envs"))
+        digest = service.zip_store.put(autograder_zip())
+        path = tmp_path / "submission.ipynb"
+        path.write_text(notebook("x = 1"))
+        result = service.local_grader.grade(str(path), digest)
+        assert result["q1"][0] == 1.0
+        assert result["file"][0] == "submission.ipynb"
+
+        path.write_text(notebook("x = 2"))
+        assert service.local_grader.grade(str(path), digest)["q1"][0] == 0.0
+
+    @patch("livefeedback_hub.handlers.submission.ensure_image", MagicMock())
+    @patch("otter.grade.containers.grade_assignments")
+    def test_process_notebook(self, grade: MagicMock, tmp_path):
+        service = JupyterService(grading_backend="local", local_environment_path=str(tmp_path))
+        service.local_grader.grade = MagicMock(return_value=pd.DataFrame())
+        add_task(service)
+        submission.process_notebook(service, "digest", bytes("", "utf-8"), "test", "test")
+        grade.assert_not_called()
+        service.local_grader.grade.assert_called_once()
+        assert service.local_grader.grade.call_args.args[1] == "digest"
+        service.result_writer.flush()
+        with service.session() as session:
+            assert session.query(Result).first().user == "test"
+
+    @patch("python_on_whales.docker")
+    def test_build(self, docker: MagicMock, tmp_path):
+        service = JupyterService(grading_backend="local", local_environment_path=str(tmp_path))
+        digest = service.zip_store.put(autograder_zip())
+        with service.session() as session:
+            session.add(AutograderZip(id="1", description="Test", state=State.building))
+        manage.build(service, "1", digest)
+        docker.build.assert_not_called()
+        assert service.local_grader.path(digest).is_dir()
+        with service.session() as session:
+            assert session.query(AutograderZip).first().state == State.ready
+            session.query(AutograderZip).delete()
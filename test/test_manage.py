@@ -1,4 +1,6 @@
+import datetime
 import io
+import threading
 import uuid
 import zipfile
 from unittest.mock import AsyncMock, MagicMock, call, patch
@@ -7,13 +9,16 @@ import pytest
 import tornado.web
 from otter.grade import utils
 from python_on_whales.exceptions import NoSuchImage
-from tornado.httputil import HTTPFile
 from tornado.testing import AsyncHTTPTestCase
 
 import livefeedback_hub.helper.misc
 from livefeedback_hub.helper.misc import get_user_hash, delete_docker_image, calcuate_zip_hash
-from livefeedback_hub.db import AutograderZip, Result, State
+from livefeedback_hub.db import AutograderZip, JobTiming, Result, ResultHistory, State
 from livefeedback_hub.handlers import manage
+from livefeedback_hub.handlers.submission import process_notebook
+from livefeedback_hub.helper.multipart import MultipartSpooler, UploadError
+from livefeedback_hub.helper.unique_action_thread_pool_executor import UniqueActionThreadPoolExecutor
+from livefeedback_hub.helper.zip_store import environment_digest
 from livefeedback_hub.server import JupyterService
 
 
@@ -21,99 +26,268 @@ def compareTasks(x: AutograderZip, y: AutograderZip):
     return x.id == y.id and x.state == y.state and x.owner == y.owner and x.description == y.description
 
 
+def autograder_zip(files=("run_autograder", "otter_config.json", "tests/q1.py")) -> bytes:
+    zip_bytes = io.BytesIO()
+    with zipfile.ZipFile(zip_bytes, "w") as zip_ref:
+        for file in files:
+            zip_ref.writestr(file, "Hello")
+    return zip_bytes.getvalue()
+
+
 class TestManage:
     @pytest.fixture()
     def service(self):
         service = JupyterService()
         return service
 
+    @patch("livefeedback_hub.helper.misc.delete_docker_image")
+    def test_delete_task_in_flight(self, delete: MagicMock, service):
+        with service.session() as session:
+            session.add(AutograderZip(id="deleted", state=State.deleted, digest="digest"))
+            session.add(AutograderZip(id="live", state=State.ready, digest="digest"))
+        executor = UniqueActionThreadPoolExecutor(max_workers=1)
+        blocked = threading.Event()
+        executor.submit(blocked.wait)
+        for id in ["deleted", "live"]:
+            executor.submit(process_notebook, service=service, zip_digest="digest", notebook=b"", id=id, user_hash="user", received=1.0)
+        service.job_queue.put_grading("user", "deleted", "digest", b"")
+        # A grading finishing during the deletion
+        service.result_writer.put("user", "deleted", "q1\n1.0", timing={"queue": 0.0, "prepare": 0.0, "grading": 1.0})
+
+        with patch("livefeedback_hub.handlers.submission.submission_executor", executor):
+            manage.delete_task(service, "deleted")
+        assert [item.kwargs["id"] for item in executor.find_and_remove(lambda item: item.fn is process_notebook)] == ["live"]
+        blocked.set()
+        executor.shutdown()
+        assert service.job_queue.size() == 0
+        assert service.result_writer.flush() == 0
+        with service.session() as session:
+            assert session.query(AutograderZip).filter_by(id="deleted").first() is None
+            for model in [Result, ResultHistory, JobTiming]:
+                assert session.query(model).count() == 0
+
     @patch("python_on_whales.docker.image.remove")
     def test_delete_image(self, mock: MagicMock, service):
         zip = AutograderZip()
-        zip.data = bytes("Test", "utf-8")
+        zip.digest = calcuate_zip_hash(bytes("Test", "utf-8"))
         mock.return_value = None
-        delete_docker_image(service, zip)
+        delete_docker_image(service, zip.digest)
         mock.assert_called_once_with(f"{utils.OTTER_DOCKER_IMAGE_TAG}:0cbc6611f5540bd0809a388dc95a615b", force=True)
 
     @patch("python_on_whales.docker.image.remove")
     def test_delete_image_fails(self, remove: MagicMock, service):
         zip = AutograderZip()
-        zip.data = bytes("Test", "utf-8")
+        zip.digest = calcuate_zip_hash(bytes("Test", "utf-8"))
         remove.side_effect = NoSuchImage([], 0)
         service.log.warning = MagicMock()
-        delete_docker_image(service, zip)
+        delete_docker_image(service, zip.digest)
         service.log.warning.assert_called_once()
 
+    @patch("python_on_whales.docker.image.remove")
+    def test_delete_image_environment(self, remove: MagicMock, service):
+        first = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "setup.sh", "tests/q1.py")))
+        second = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "setup.sh", "tests/q1.py", "tests/q2.py")))
+        environment = manage.environment_image(service, first)
+        with service.session() as session:
+            session.add(AutograderZip(id="1", state=State.deleted, digest=first))
+            session.add(AutograderZip(id="2", state=State.ready, digest=second))
+        delete_docker_image(service, first)
+        # The image of the second task is based on the same environment
+        remove.assert_called_once_with(manage.image_name(first), force=True)
+
+        remove.reset_mock()
+        with service.session() as session:
+            session.query(AutograderZip).filter_by(id="2").update({"state": State.deleted})
+        delete_docker_image(service, second)
+        assert remove.call_args_list == [call(manage.image_name(second), force=True), call(environment, force=True)]
+
+    @patch("python_on_whales.docker.image.remove")
+    def test_delete_image_shared(self, remove: MagicMock, tmp_path):
+        service = JupyterService(image_cache_path=str(tmp_path))
+        digest = service.zip_store.put(autograder_zip())
+        cached = livefeedback_hub.helper.misc.image_cache_file(service, digest)
+        cached.parent.mkdir(parents=True)
+        cached.write_bytes(bytes("Image", "utf-8"))
+        with service.session() as session:
+            session.add(AutograderZip(id="1", state=State.deleted, digest=digest))
+            session.add(AutograderZip(id="2", state=State.ready, digest=digest))
+        # The copied task still uses the image
+        delete_docker_image(service, digest)
+        remove.assert_not_called()
+        assert cached.is_file()
+
     @patch("python_on_whales.docker.image.exists")
     def test_build_update_non_existing(self, exists: MagicMock, service):
-        zip = HTTPFile()
-        zip["body"] = bytes("Test", "utf-8")
+        digest = service.zip_store.put(bytes("Test", "utf-8"))
         exists.return_value = True
-        manage.build(service, "1", zip_file=zip, update=True)
+        manage.build(service, "1", digest, update=True)
         exists.assert_not_called()
 
     @patch("python_on_whales.docker.image.exists")
     def test_build_update_same(self, exists: MagicMock, service):
-        zip = HTTPFile()
-        zip["body"] = bytes("Test", "utf-8")
+        digest = service.zip_store.put(bytes("Test", "utf-8"))
         exists.return_value = True
         with service.session() as session:
             session.add(AutograderZip(id="1", state=State.building))
-        manage.build(service, "1", zip_file=zip, update=True)
+        manage.build(service, "1", digest, update=True)
         exists.assert_called_once_with(f"{utils.OTTER_DOCKER_IMAGE_TAG}:0cbc6611f5540bd0809a388dc95a615b")
         with service.session() as session:
             assert session.query(AutograderZip).filter_by(id="1").first().state == State.ready
+        # The new image counts as used, so the image collector does not remove it before the first submission
+        assert digest in service.image_collector._used
 
     @patch("python_on_whales.docker.image.exists")
     @patch("python_on_whales.docker.build")
     @patch("python_on_whales.docker.image.remove")
     def test_build_update(self, delete: MagicMock, build: MagicMock, exists: MagicMock, service):
-        zip = HTTPFile()
         zip_bytes = io.BytesIO()
         with zipfile.ZipFile(zip_bytes, "w") as zip_ref:
             zip_ref.writestr("content", "Hello")
-        zip["body"] = zip_bytes.getvalue()
+        digest = service.zip_store.put(zip_bytes.getvalue())
         exists.return_value = False
         with service.session() as session:
-            session.add(AutograderZip(id="1", state=State.building, data=bytes("Old", "utf-8")))
+            session.add(AutograderZip(id="1", state=State.building, digest=service.zip_store.put(bytes("Old", "utf-8"))))
 
-        manage.build(service, "1", zip_file=zip, update=True)
+        manage.build(service, "1", digest, update=True)
 
-        exists.assert_called_with(f"{utils.OTTER_DOCKER_IMAGE_TAG}:{calcuate_zip_hash(zip_bytes.getvalue())}")
+        exists.assert_any_call(f"{utils.OTTER_DOCKER_IMAGE_TAG}:{calcuate_zip_hash(zip_bytes.getvalue())}")
 
         delete.assert_called_once_with(f"{utils.OTTER_DOCKER_IMAGE_TAG}:c7268757fbabf48019f4984933539d8a", force=True)
 
-        build.assert_called_once()
+        # Environment image followed by the image containing the tests
+        assert build.call_count == 2
+        environment: call = build.call_args_list[0]
+        assert environment.kwargs["tags"][0].startswith(f"{utils.OTTER_DOCKER_IMAGE_TAG}{manage.ENVIRONMENT_IMAGE_SUFFIX}:")
         args: call = build.call_args
         assert args.kwargs["load"] is True
         assert args.kwargs["tags"] == [f"{utils.OTTER_DOCKER_IMAGE_TAG}:{calcuate_zip_hash(zip_bytes.getvalue())}"]
+        assert args.kwargs["build_args"] == {"ENVIRONMENT_IMAGE": environment.kwargs["tags"][0]}
 
         with service.session() as session:
             assert session.query(AutograderZip).filter_by(id="1").first().state == State.ready
-            assert session.query(AutograderZip).filter_by(id="1").first().data == zip_bytes.getvalue()
+            assert session.query(AutograderZip).filter_by(id="1").first().digest == calcuate_zip_hash(zip_bytes.getvalue())
+        assert service.zip_store.get(calcuate_zip_hash(zip_bytes.getvalue())) == zip_bytes.getvalue()
+        assert not service.zip_store.exists(calcuate_zip_hash(bytes("Old", "utf-8")))
 
     @patch("python_on_whales.docker.image.exists")
     @patch("python_on_whales.docker.build")
     @patch("python_on_whales.docker.image.remove")
     def test_build_update_fails(self, delete: MagicMock, build: MagicMock, exists: MagicMock, service):
-        zip = HTTPFile()
-        zip["body"] = bytes("Test", "utf-8")
+        digest = service.zip_store.put(bytes("Test", "utf-8"))
         exists.return_value = False
         with service.session() as session:
-            session.add(AutograderZip(id="1", state=State.building, data=bytes("Old", "utf-8")))
+            session.add(AutograderZip(id="1", state=State.building, digest=calcuate_zip_hash(bytes("Old", "utf-8"))))
         build.side_effect = Exception()
         try:
-            manage.build(service, "1", zip_file=zip, update=True)
+            manage.build(service, "1", digest, update=True)
         except Exception as e:
             assert e is not None
 
-        exists.assert_called_with(f"{utils.OTTER_DOCKER_IMAGE_TAG}:0cbc6611f5540bd0809a388dc95a615b")
+        exists.assert_any_call(f"{utils.OTTER_DOCKER_IMAGE_TAG}:0cbc6611f5540bd0809a388dc95a615b")
 
         delete.assert_not_called()
 
         with service.session() as session:
             assert session.query(AutograderZip).filter_by(id="1").first().state == State.error
-            assert session.query(AutograderZip).filter_by(id="1").first().data == bytes("Old", "utf-8")
+            assert session.query(AutograderZip).filter_by(id="1").first().digest == calcuate_zip_hash(bytes("Old", "utf-8"))
+        assert not service.zip_store.exists(digest)
+
+    @patch("python_on_whales.docker.build")
+    def test_build_same_environment(self, build: MagicMock, service):
+        first = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "setup.sh", "tests/q1.py")))
+        second = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "setup.sh", "tests/q1.py", "tests/q2.py")))
+        other = service.zip_store.put(autograder_zip(files=("run_autograder", "otter_config.json", "setup.sh", "requirements.txt", "tests/q1.py")))
+        assert environment_digest(service.zip_store.path(first)) == environment_digest(service.zip_store.path(second))
+        assert environment_digest(service.zip_store.path(first)) != environment_digest(service.zip_store.path(other))
+
+        built = set()
+        with patch("python_on_whales.docker.image.exists", side_effect=lambda image: image in built):
+            build.side_effect = lambda *args, **kwargs: built.update(kwargs["tags"]) or []
+            manage.build_image(service, "1", first)
+            assert build.call_count == 2
+            manage.build_image(service, "1", second)
+            # Only the tests are added to the existing environment
+            assert build.call_count == 3
+            assert build.call_args.kwargs["file"].endswith("Dockerfile")
+            manage.build_image(service, "1", other)
+            assert build.call_count == 5
+
+    @patch("python_on_whales.docker.image.exists")
+    @patch("python_on_whales.docker.image.load")
+    @patch("python_on_whales.docker.image.save")
+    @patch("livefeedback_hub.handlers.manage.build_image")
+    def test_ensure_image(self, build_image: MagicMock, save: MagicMock, load: MagicMock, exists: MagicMock, tmp_path):
+        service = JupyterService(image_cache_path=str(tmp_path))
+        digest = calcuate_zip_hash(bytes("Test", "utf-8"))
+        exists.return_value = True
+        manage.ensure_image(service, "1", digest)
+        build_image.assert_not_called()
+        load.assert_not_called()
+        assert digest not in service.image_collector._used
+
+        # Missing and not cached: build it again and export it
+        exists.return_value = False
+        save.side_effect = lambda image, output: open(output, "wb").write(bytes("Image", "utf-8"))
+        manage.ensure_image(service, "1", digest)
+        build_image.assert_called_once_with(service, "1", digest)
+        assert digest in service.image_collector._used
+        save.assert_called_once()
+        assert livefeedback_hub.helper.misc.image_cache_file(service, digest).read_bytes() == bytes("Image", "utf-8")
+
+        # Missing but cached: load it
+        manage.ensure_image(service, "1", digest)
+        build_image.assert_called_once()
+        load.assert_called_once_with(str(livefeedback_hub.helper.misc.image_cache_file(service, digest)), quiet=True)
+
+    @patch("livefeedback_hub.handlers.manage.manage_executor.submit", side_effect=lambda fn, *args: fn(*args))
+    @patch("livefeedback_hub.handlers.manage.ensure_image")
+    def test_reconcile_images(self, ensure_image: MagicMock, submit: MagicMock, service):
+        with service.session() as session:
+            session.add(AutograderZip(id="1", state=State.ready, digest=calcuate_zip_hash(bytes("1", "utf-8"))))
+            session.add(AutograderZip(id="2", state=State.ready, digest=calcuate_zip_hash(bytes("2", "utf-8"))))
+            session.add(AutograderZip(id="3", state=State.building, digest=calcuate_zip_hash(bytes("3", "utf-8"))))
+
+        def ensure(service, id, digest):
+            if id == "2":
+                raise Exception()
+
+        ensure_image.side_effect = ensure
+        manage.reconcile_images(service)
+        assert ensure_image.call_count == 2
+        with service.session() as session:
+            assert session.query(AutograderZip).filter_by(id="1").first().state == State.ready
+            assert session.query(AutograderZip).filter_by(id="2").first().state == State.error
+            assert session.query(AutograderZip).filter_by(id="3").first().state == State.building
+            session.query(AutograderZip).delete()
+
+    def test_multipart_spooler(self, tmp_path):
+        body = (b'--Boundary\r\nContent-Disposition: form-data; name="description"\r\n\r\nHello\r\n'
+                b'--Boundary\r\nContent-Disposition: form-data; name="zip"; filename="autograder.zip"\r\n'
+                b'Content-Type: application/zip\r\n\r\n' + autograder_zip() + b'\r\n--Boundary--\r\n')
+        for size in [1, 7, len(body)]:
+            spooler = MultipartSpooler(b"Boundary", tmp_path, max_file_size=1024 * 1024)
+            for i in range(0, len(body), size):
+                spooler.feed(body[i:i + size])
+            spooler.finish()
+            assert spooler.fields == {"description": [b"Hello"]}
+            zip_file = spooler.files["zip"]
+            assert zip_file.filename == "autograder.zip"
+            assert zip_file.digest == calcuate_zip_hash(autograder_zip())
+            with open(zip_file.path, "rb") as f:
+                assert f.read() == autograder_zip()
+            spooler.cleanup()
+        assert list(tmp_path.iterdir()) == []
+
+    def test_multipart_spooler_limits(self, tmp_path):
+        spooler = MultipartSpooler(b"Boundary", tmp_path, max_file_size=10)
+        with pytest.raises(UploadError):
+            spooler.feed(b'--Boundary\r\nContent-Disposition: form-data; name="zip"; filename="a.zip"\r\n\r\n' + bytes(100))
+        spooler.cleanup()
+        spooler = MultipartSpooler(b"Boundary", tmp_path, max_file_size=10)
+        spooler.feed(b'--Boundary\r\nContent-Disposition: form-data; name="description"\r\n\r\nHello')
+        with pytest.raises(UploadError):
+            spooler.finish()
+        assert list(tmp_path.iterdir()) == []
 
 
 class TestManageHandler(AsyncHTTPTestCase):
@@ -126,6 +300,7 @@ class TestManageHandler(AsyncHTTPTestCase):
         with self.service.session() as session:
             session.query(AutograderZip).delete()
             session.query(Result).delete()
+            session.query(JobTiming).delete()
 
         super().tearDown()
 
@@ -139,11 +314,11 @@ class TestManageHandler(AsyncHTTPTestCase):
 
         with patch.object(tornado.web.RequestHandler, "render", new_callable=AsyncMock) as mock:
             self.fetch("/")
-            mock.assert_called_once_with("overview.html", tasks=[], base="/")
+            mock.assert_called_once_with("overview.html", tasks=[], activity={}, page=1, pages=1, base="/")
 
-        zip = AutograderZip(id="1", description="Test 1", state=State.building, data=bytes("Old", "utf-8"), owner=livefeedback_hub.helper.misc.get_user_hash(get_current_user_mock.return_value))
-        zip2 = AutograderZip(id="2", description="Test 2", state=State.building, data=bytes("Old", "utf-8"), owner=livefeedback_hub.helper.misc.get_user_hash({"name": "user"}))
-        zip3 = AutograderZip(id="3", description="Test 3", state=State.building, data=bytes("Old", "utf-8"), owner=livefeedback_hub.helper.misc.get_user_hash(get_current_user_mock.return_value))
+        zip = AutograderZip(id="1", description="Test 1", state=State.building, digest=calcuate_zip_hash(bytes("Old", "utf-8")), owner=livefeedback_hub.helper.misc.get_user_hash(get_current_user_mock.return_value))
+        zip2 = AutograderZip(id="2", description="Test 2", state=State.building, digest=calcuate_zip_hash(bytes("Old", "utf-8")), owner=livefeedback_hub.helper.misc.get_user_hash({"name": "user"}))
+        zip3 = AutograderZip(id="3", description="Test 3", state=State.building, digest=calcuate_zip_hash(bytes("Old", "utf-8")), owner=livefeedback_hub.helper.misc.get_user_hash(get_current_user_mock.return_value))
 
         with self.service.session() as session:
             session.add(zip)
@@ -166,6 +341,41 @@ class TestManageHandler(AsyncHTTPTestCase):
                 y = session.merge(zip3)
                 assert compareTasks(x, y) is True
 
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("livefeedback_hub.helper.misc.teachers")
+    def test_load_pages(self, teachers: MagicMock, get_current_user_mock: MagicMock):
+        teachers.return_value = ["admin"]
+        get_current_user_mock.return_value = {"name": "admin"}
+        owner = livefeedback_hub.helper.misc.get_user_hash(get_current_user_mock.return_value)
+        finished = datetime.datetime(2022, 4, 1, 10, 30)
+        with self.service.session() as session:
+            for i in range(5):
+                session.add(AutograderZip(id=str(i), description=f"Test {i}", state=State.ready, digest=calcuate_zip_hash(bytes("Old", "utf-8")), owner=owner))
+            graded = int((finished - datetime.datetime(1970, 1, 1)).total_seconds())
+            # Two submissions with two questions each
+            for question in ["q1", "q2"]:
+                session.add(ResultHistory(assignment="3", user="a", graded=graded - 300, question=question, score=1.0))
+                session.add(ResultHistory(assignment="3", user="b", graded=graded, question=question, score=0.0))
+                session.add(ResultHistory(assignment="0", user="a", graded=graded, question=question, score=1.0))
+        self.service.overview_page_size = 2
+        try:
+            with patch.object(tornado.web.RequestHandler, "render", new_callable=AsyncMock) as mock:
+                self.fetch("/?page=2")
+                kwargs = mock.call_args.kwargs
+                with self.service.session() as session:
+                    assert [session.merge(task).id for task in kwargs["tasks"]] == ["2", "3"]
+                assert kwargs["activity"] == {"3": (2, finished)}
+                assert (kwargs["page"], kwargs["pages"]) == (2, 3)
+                self.fetch("/?page=10")
+                with self.service.session() as session:
+                    assert [session.merge(task).id for task in mock.call_args.kwargs["tasks"]] == ["4"]
+            response = self.fetch("/?page=2")
+            assert response.code == 200
+            assert "01.04.2022 10:30 UTC" in response.body.decode()
+            assert self.fetch("/?page=abc").code == 400
+        finally:
+            self.service.overview_page_size = 25
+
     @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
     @patch("livefeedback_hub.helper.misc.teachers")
     def test_load_no_teacher(self, teachers: MagicMock, get_current_user_mock: MagicMock):
@@ -197,7 +407,7 @@ class TestManageHandler(AsyncHTTPTestCase):
         get_current_user_mock.return_value = {"name": "admin"}
         id = str(uuid.uuid4())
         with self.service.session() as session:
-            zip = AutograderZip(id=id, description="Test", state=State.building, data=bytes("Old", "utf-8"), owner=get_user_hash({"name": "user"}))
+            zip = AutograderZip(id=id, description="Test", state=State.building, digest=calcuate_zip_hash(bytes("Old", "utf-8")), owner=get_user_hash({"name": "user"}))
             session.add(zip)
 
         response = self.fetch(f"/manage/edit/{id}")
@@ -210,7 +420,7 @@ class TestManageHandler(AsyncHTTPTestCase):
         get_current_user_mock.return_value = {"name": "teacher"}
         id = str(uuid.uuid4())
         with self.service.session() as session:
-            zip = AutograderZip(id=id, description="Test", state=State.building, data=bytes("Old", "utf-8"), owner=get_user_hash(get_current_user_mock.return_value))
+            zip = AutograderZip(id=id, description="Test", state=State.building, digest=calcuate_zip_hash(bytes("Old", "utf-8")), owner=get_user_hash(get_current_user_mock.return_value))
             session.add(zip)
 
         response = self.fetch(f"/manage/edit/{id}")
@@ -227,26 +437,26 @@ class TestManageHandler(AsyncHTTPTestCase):
         # create the body
 
         # opening boundary
-        body = "--%s\r\n" % boundary
+        body = b"--%s\r\n" % boundary.encode()
 
         # data for description
-        body += 'Content-Disposition: form-data; name="description"\r\n'
-        body += "\r\n"  # blank line
-        body += f"{description}\r\n"
+        body += b'Content-Disposition: form-data; name="description"\r\n'
+        body += b"\r\n"  # blank line
+        body += f"{description}\r\n".encode()
 
         # separator boundary
-        body += "--%s\r\n" % boundary
+        body += b"--%s\r\n" % boundary.encode()
 
         if file is not None:
             # data for zip
-            body += 'Content-Disposition: form-data; name="zip"; filename="autograder.zip"\r\n'
-            body += "\r\n"  # blank line
-            body += "%s\r\n" % file
+            body += b'Content-Disposition: form-data; name="zip"; filename="autograder.zip"\r\n'
+            body += b"\r\n"  # blank line
+            body += file + b"\r\n"
         else:
             # Simulate no file
-            body += 'Content-Disposition: form-data; name="zip"; filename=""\r\nContent-Type: application/octet-stream\r\n'
+            body += b'Content-Disposition: form-data; name="zip"; filename=""\r\nContent-Type: application/octet-stream\r\n'
         # the closing boundary
-        body += "--%s--\r\n" % boundary
+        body += b"--%s--\r\n" % boundary.encode()
         return (headers, body)
 
     @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
@@ -277,12 +487,14 @@ class TestManageHandler(AsyncHTTPTestCase):
         get_current_user_mock.return_value = {"name": "teacher", "groups": ["teacher"]}
         id = str(uuid.uuid4())
         with self.service.session() as session:
-            zip = AutograderZip(id=id, description="Test", state=State.ready, data=bytes("Old", "utf-8"), owner=get_user_hash(get_current_user_mock.return_value))
+            zip = AutograderZip(id=id, description="Test", state=State.ready, digest=calcuate_zip_hash(bytes("Old", "utf-8")), owner=get_user_hash(get_current_user_mock.return_value))
             session.add(zip)
-        headers, body = self.generate_request(bytes("Test", "utf-8"), "Hello")
+        headers, body = self.generate_request(autograder_zip(), "Hello")
         response = self.fetch(f"/manage/edit/{id}", method="POST", headers=headers, body=body, follow_redirects=False)
         assert response.code == 302
         submit.assert_called_once()
+        assert submit.call_args.args[3] == calcuate_zip_hash(autograder_zip())
+        assert self.service.zip_store.get(calcuate_zip_hash(autograder_zip())) == autograder_zip()
         with self.service.session() as session:
             assert session.query(AutograderZip).filter_by(id=id).first().state == State.building
             assert session.query(AutograderZip).filter_by(id=id).first().description == "Hello"
@@ -295,7 +507,7 @@ class TestManageHandler(AsyncHTTPTestCase):
         get_current_user_mock.return_value = {"name": "teacher"}
         id = str(uuid.uuid4())
         with self.service.session() as session:
-            zip = AutograderZip(id=id, description="Test", state=State.ready, data=bytes("Old", "utf-8"), owner=get_user_hash(get_current_user_mock.return_value))
+            zip = AutograderZip(id=id, description="Test", state=State.ready, digest=calcuate_zip_hash(bytes("Old", "utf-8")), owner=get_user_hash(get_current_user_mock.return_value))
             session.add(zip)
         headers, body = self.generate_request(None, "Hello")
         response = self.fetch(f"/manage/edit/{id}", method="POST", headers=headers, body=body, follow_redirects=False)
@@ -333,13 +545,45 @@ class TestManageHandler(AsyncHTTPTestCase):
     def test_add_grader_post(self, teachers: MagicMock, submit: MagicMock, get_current_user_mock: MagicMock):
         teachers.return_value = ["teacher"]
         get_current_user_mock.return_value = {"name": "teacher"}
-        headers, body = self.generate_request(bytes("Test", "utf-8"), "Hello")
+        headers, body = self.generate_request(autograder_zip(), "Hello")
         response = self.fetch("/manage/add", method="POST", headers=headers, body=body, follow_redirects=False)
         assert response.code == 302
         submit.assert_called_once()
         with self.service.session() as session:
             assert session.query(AutograderZip).first().state == State.building
             assert session.query(AutograderZip).first().description == "Hello"
+            assert self.service.zip_store.exists(session.query(AutograderZip).first().digest)
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("livefeedback_hub.handlers.manage.manage_executor.submit")
+    @patch("livefeedback_hub.helper.misc.teachers")
+    def test_add_grader_post_invalid(self, teachers: MagicMock, submit: MagicMock, get_current_user_mock: MagicMock):
+        teachers.return_value = ["teacher"]
+        get_current_user_mock.return_value = {"name": "teacher"}
+        for file in [bytes("Test", "utf-8"), autograder_zip(files=["run_autograder", "tests/q1.py"]), autograder_zip(files=["run_autograder", "otter_config.json", "../q1.py"])]:
+            headers, body = self.generate_request(file, "Hello")
+            response = self.fetch("/manage/add", method="POST", headers=headers, body=body, follow_redirects=False)
+            assert response.code == 400
+        submit.assert_not_called()
+        with self.service.session() as session:
+            assert session.query(AutograderZip).count() == 0
+        assert list(self.service.zip_store.spool_dir().iterdir()) == []
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("livefeedback_hub.handlers.manage.manage_executor.submit")
+    @patch("livefeedback_hub.helper.misc.teachers")
+    def test_add_grader_post_too_large(self, teachers: MagicMock, submit: MagicMock, get_current_user_mock: MagicMock):
+        teachers.return_value = ["teacher"]
+        get_current_user_mock.return_value = {"name": "teacher"}
+        zip_bytes = io.BytesIO()
+        with zipfile.ZipFile(zip_bytes, "w", compression=zipfile.ZIP_DEFLATED) as zip_ref:
+            for file in ["run_autograder", "otter_config.json"]:
+                zip_ref.writestr(file, "Hello")
+            zip_ref.writestr("bomb", "0" * (self.service.max_zip_extracted_size + 1))
+        headers, body = self.generate_request(zip_bytes.getvalue(), "Hello")
+        response = self.fetch("/manage/add", method="POST", headers=headers, body=body, follow_redirects=False)
+        assert response.code == 400
+        submit.assert_not_called()
 
     @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
     @patch("livefeedback_hub.helper.misc.teachers")
@@ -360,16 +604,37 @@ class TestManageHandler(AsyncHTTPTestCase):
         assert response.code == 403
 
     @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("livefeedback_hub.handlers.manage.manage_executor.submit")
     @patch("livefeedback_hub.helper.misc.delete_docker_image")
     @patch("livefeedback_hub.helper.misc.teachers")
-    def test_delete(self, teachers: MagicMock, delete: MagicMock, get_current_user_mock: MagicMock):
+    def test_delete(self, teachers: MagicMock, delete: MagicMock, submit: MagicMock, get_current_user_mock: MagicMock):
         teachers.return_value = ["teacher"]
         get_current_user_mock.return_value = {"name": "teacher"}
         id = str(uuid.uuid4())
         with self.service.session() as session:
-            zip = AutograderZip(id=id, description="Test", state=State.ready, data=bytes("Old", "utf-8"), owner=get_user_hash(get_current_user_mock.return_value))
+            digest = self.service.zip_store.put(bytes("Old", "utf-8"))
+            zip = AutograderZip(id=id, description="Test", state=State.ready, digest=digest, owner=get_user_hash(get_current_user_mock.return_value))
             session.add(zip)
+            for i in range(5):
+                session.add(Result(user=str(i), assignment=id, data="q1"))
+                session.add(ResultHistory(user=str(i), assignment=id, graded=0, question="q1", score=1.0))
 
         response = self.fetch(f"/manage/delete/{id}", follow_redirects=False)
         assert response.code == 302
+        # The task is hidden immediately and removed in the background
+        submit.assert_called_once_with(manage.delete_task, self.service, id)
+        delete.assert_not_called()
+        with self.service.session() as session:
+            assert session.query(AutograderZip).filter_by(id=id).first().state == State.deleted
+        response = self.fetch(f"/results/{id}")
+        assert response.code == 403
+        response = self.fetch(f"/manage/delete/{id}")
+        assert response.code == 403
+
+        manage.delete_task(self.service, id, chunk_size=2)
         delete.assert_called_once()
+        with self.service.session() as session:
+            assert session.query(AutograderZip).filter_by(id=id).first() is None
+            assert session.query(Result).filter_by(assignment=id).count() == 0
+            assert session.query(ResultHistory).filter_by(assignment=id).count() == 0
+        assert not self.service.zip_store.exists(digest)
@@ -0,0 +1,36 @@
+from unittest.mock import MagicMock, patch
+
+from tornado.testing import AsyncHTTPTestCase
+
+from livefeedback_hub.server import JupyterService
+
+
+class TestMetricsHandler(AsyncHTTPTestCase):
+    service = JupyterService(xsrf_cookies=False)
+
+    def get_app(self):
+        return self.service.app
+
+    def tearDown(self):
+        self.service.metrics_token = ""
+        super().tearDown()
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    def test_metrics(self, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "teacher"}
+        code = self.fetch("/api/results/333e2069-612e-4e0c-a4ac-e6ec1eaa44f0").code
+        response = self.fetch("/metrics")
+        assert response.code == 200
+        body = response.body.decode()
+        assert 'livefeedback_executor_queue_depth{executor="submission"} 0.0' in body
+        assert 'livefeedback_executor_queue_depth{executor="manage"} 0.0' in body
+        assert "livefeedback_backlog_size 0.0" in body
+        assert "livefeedback_running_jobs 0.0" in body
+        assert "livefeedback_db_query_duration_seconds_count" in body
+        assert f'livefeedback_request_duration_seconds_count{{code="{code}",handler="FeedbackResultsApiHandler",method="GET"}} 1.0' in body
+
+    def test_metrics_token(self):
+        self.service.metrics_token = "secret"
+        assert self.fetch("/metrics").code == 403
+        assert self.fetch("/metrics", headers={"Authorization": "Bearer wrong"}).code == 403
+        assert self.fetch("/metrics", headers={"Authorization": "Bearer secret"}).code == 200
@@ -0,0 +1,90 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+from livefeedback_hub.db import AutograderZip, Base, Result, SchemaVersion, State
+from livefeedback_hub.helper.misc import calcuate_zip_hash
+from livefeedback_hub.migrations import MIGRATIONS
+from livefeedback_hub.server import JupyterService
+
+
+def indexes(service: JupyterService, table: str):
+    return {index["name"] for index in inspect(service.engine).get_indexes(table)}
+
+
+class TestMigrations:
+
+    def test_new_database(self, tmp_path):
+        service = JupyterService(db_url=f"sqlite:///{tmp_path / 'data.db'}")
+        with service.session() as session:
+            assert session.query(SchemaVersion).one().version == len(MIGRATIONS)
+        assert "ix_autograder_zips_owner" in indexes(service, "autograder_zips")
+        assert "ix_results_assignment" in indexes(service, "results")
+        assert indexes(service, "job_timings") == {"ix_job_timings_assignment_finished"}
+
+    def test_existing_database(self, tmp_path):
+        url = f"sqlite:///{tmp_path / 'data.db'}"
+        # Schema and data of a deployment created before migrations were introduced
+        engine = create_engine(url)
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE autograder_zips (id VARCHAR NOT NULL, owner VARCHAR, data BLOB, description VARCHAR, state VARCHAR(8), PRIMARY KEY (id))"))
+            connection.execute(text("CREATE TABLE results (id INTEGER NOT NULL, user VARCHAR, assignment VARCHAR, data VARCHAR, PRIMARY KEY (id), UNIQUE (user, assignment), FOREIGN KEY(assignment) REFERENCES autograder_zips (id))"))
+            connection.execute(text("INSERT INTO autograder_zips VALUES ('1', 'owner', X'4F6C64', 'Test', 'ready')"))
+            connection.execute(text("INSERT INTO results (user, assignment, data) VALUES ('user', '1', 'q1')"))
+        engine.dispose()
+
+        service = JupyterService(db_url=url)
+        assert "ix_autograder_zips_owner" in indexes(service, "autograder_zips")
+        assert "ix_results_assignment" in indexes(service, "results")
+        assert "ix_autograder_zips_digest" in indexes(service, "autograder_zips")
+        assert service.zip_store.get(calcuate_zip_hash(bytes("Old", "utf-8"))) == bytes("Old", "utf-8")
+        with service.session() as session:
+            assert session.query(SchemaVersion).one().version == len(MIGRATIONS)
+            assert session.query(AutograderZip).one().description == "Test"
+            assert session.query(AutograderZip).one().digest == calcuate_zip_hash(bytes("Old", "utf-8"))
+            assert session.query(Result).one().data == "q1"
+
+        # Starting again does not apply any migration
+        service = JupyterService(db_url=url)
+        with service.session() as session:
+            assert session.query(SchemaVersion).count() == 1
+            assert session.query(SchemaVersion).one().version == len(MIGRATIONS)
+
+    @pytest.mark.skipif(os.getenv("SERVICE_TEST_POSTGRES_URL") is None, reason="PostgreSQL not configured")
+    def test_postgresql(self):
+        url = os.getenv("SERVICE_TEST_POSTGRES_URL")
+        engine = create_engine(url)
+        # Schema and data of a PostgreSQL deployment created before migrations were introduced
+        Base.metadata.drop_all(engine)
+        with engine.begin() as connection:
+            connection.execute(text("DROP TYPE IF EXISTS state"))
+            connection.execute(text("CREATE TYPE state AS ENUM ('ready', 'building', 'error')"))
+            connection.execute(text("CREATE TABLE autograder_zips (id VARCHAR NOT NULL, owner VARCHAR, data BYTEA, description VARCHAR, state state, PRIMARY KEY (id))"))
+            connection.execute(text("CREATE TABLE results (id SERIAL NOT NULL, \"user\" VARCHAR, assignment VARCHAR, data VARCHAR, PRIMARY KEY (id), UNIQUE (\"user\", assignment), "
+                                    "FOREIGN KEY(assignment) REFERENCES autograder_zips (id))"))
+            connection.execute(text("INSERT INTO autograder_zips VALUES ('1', 'owner', 'Old'::bytea, 'Test', 'ready')"))
+            connection.execute(text("INSERT INTO results (\"user\", assignment, data) VALUES ('user', '1', 'q1')"))
+        engine.dispose()
+
+        service = JupyterService(db_url=url)
+        try:
+            assert "data" not in {column["name"] for column in inspect(service.engine).get_columns("autograder_zips")}
+            with service.session() as session:
+                assert session.query(SchemaVersion).one().version == len(MIGRATIONS)
+                assert session.query(AutograderZip).one().digest == calcuate_zip_hash(bytes("Old", "utf-8"))
+                # The state added by a migration can be stored
+                session.query(AutograderZip).update({"state": State.deleted})
+            with service.session() as session:
+                assert session.query(AutograderZip).one().state == State.deleted
+                session.query(AutograderZip).update({"state": State.ready})
+            # Existing results are updated by the upserts of the result writer
+            service.result_writer.put("user", "1", "q1\n1.0", received=1.0)
+            service.result_writer.put("other", "1", "q1\n0.0")
+            assert service.result_writer.flush() == 2
+            with service.session() as session:
+                assert session.query(Result).count() == 2
+                assert session.query(Result).filter_by(user="user").one().data == "q1\n1.0"
+                assert session.query(Result).filter_by(user="user").one().received == 1.0
+        finally:
+            Base.metadata.drop_all(service.engine)
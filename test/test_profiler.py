@@ -0,0 +1,94 @@
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from livefeedback_hub.helper.profiler import IDLE_FRAMES, ProfilerBusyError, SamplingProfiler, folded
+from livefeedback_hub.server import JupyterService
+
+
+def busy_grading(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestSamplingProfiler:
+
+    def test_profile(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=busy_grading, args=(stop,), name="ThreadPoolExecutor-0_3")
+        thread.start()
+        try:
+            stacks = SamplingProfiler().profile(0.2, interval=0.005)
+        finally:
+            stop.set()
+            thread.join()
+        busy = [stack for stack in stacks if stack.startswith("ThreadPoolExecutor-0;") and "test.test_profiler:busy_grading" in stack]
+        assert len(busy) > 0
+        assert sum(stacks[stack] for stack in busy) > 5
+        # Waiting threads are only included on request
+        assert not any(stack.rsplit(";", 1)[1] in IDLE_FRAMES for stack in stacks)
+
+    def test_idle(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait, name="waiting")
+        thread.start()
+        try:
+            stacks = SamplingProfiler().profile(0.05, interval=0.005, idle=True)
+        finally:
+            stop.set()
+            thread.join()
+        assert any(stack.startswith("waiting;") and stack.endswith("threading:Event.wait;threading:Condition.wait") for stack in stacks)
+
+    def test_busy(self):
+        profiler = SamplingProfiler()
+        with profiler._lock:
+            assert profiler.running
+            with pytest.raises(ProfilerBusyError):
+                profiler.profile(0.01)
+        assert not profiler.running
+
+    def test_folded(self):
+        assert folded({"b;c": 2, "a": 1}) == "a 1\nb;c 2\n"
+
+
+class TestProfileHandler(AsyncHTTPTestCase):
+    service = JupyterService(xsrf_cookies=False)
+
+    def get_app(self):
+        return self.service.app
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("livefeedback_hub.helper.misc.teachers")
+    def test_profile(self, teachers: MagicMock, get_current_user_mock: MagicMock):
+        teachers.return_value = ["teacher"]
+        get_current_user_mock.return_value = {"name": "teacher"}
+        started = time.monotonic()
+        response = self.fetch("/profile?seconds=0.1&interval=0.01&idle=1")
+        assert response.code == 200
+        assert time.monotonic() - started >= 0.1
+        lines = response.body.decode().splitlines()
+        assert len(lines) > 0
+        assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+        # The IOLoop thread serving the request is sampled as well
+        assert any(line.startswith("MainThread;") for line in lines)
+        assert self.fetch("/profile?seconds=abc").code == 400
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("livefeedback_hub.helper.misc.teachers")
+    def test_profile_access(self, teachers: MagicMock, get_current_user_mock: MagicMock):
+        teachers.return_value = []
+        get_current_user_mock.return_value = {"name": "student"}
+        assert self.fetch("/profile?seconds=0").code == 403
+        get_current_user_mock.return_value = {"name": "admin", "admin": True}
+        assert self.fetch("/profile?seconds=0").code == 200
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("livefeedback_hub.helper.misc.teachers")
+    def test_profile_busy(self, teachers: MagicMock, get_current_user_mock: MagicMock):
+        teachers.return_value = ["teacher"]
+        get_current_user_mock.return_value = {"name": "teacher"}
+        with self.service.profiler._lock:
+            assert self.fetch("/profile?seconds=0").code == 409
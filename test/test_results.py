@@ -1,10 +1,15 @@
+import io
+import json
+import time
 import uuid
 from unittest.mock import MagicMock, patch
 
+import pytest
 from tornado.testing import AsyncHTTPTestCase
 
 import livefeedback_hub.helper.misc
-from livefeedback_hub.db import AutograderZip, Result, State
+from livefeedback_hub.helper.misc import calcuate_zip_hash
+from livefeedback_hub.db import AutograderZip, JobTiming, Result, ResultHistory, State
 from livefeedback_hub.server import JupyterService
 
 
@@ -18,6 +23,8 @@ class TestResultHandler(AsyncHTTPTestCase):
         with self.service.session() as session:
             session.query(AutograderZip).delete()
             session.query(Result).delete()
+            session.query(JobTiming).delete()
+            session.query(ResultHistory).delete()
 
         super().tearDown()
 
@@ -26,7 +33,7 @@ class TestResultHandler(AsyncHTTPTestCase):
         get_current_user_mock.return_value = {"name": "admin", "groups": ["teacher"]}
         id = str(uuid.uuid4())
         with self.service.session() as session:
-            zip = AutograderZip(id=id, description="Test", state=State.building, data=bytes("Old", "utf-8"),
+            zip = AutograderZip(id=id, description="Test", state=State.building, digest=calcuate_zip_hash(bytes("Old", "utf-8")),
                                 owner=livefeedback_hub.helper.misc.get_user_hash(get_current_user_mock.return_value))
             session.add(zip)
         response = self.fetch(f"/results/{id}")
@@ -46,10 +53,139 @@ class TestResultHandler(AsyncHTTPTestCase):
         get_current_user_mock.return_value = {"name": "admin", "groups": ["teacher"]}
         id = str(uuid.uuid4())
         with self.service.session() as session:
-            zip = AutograderZip(id=id, description="Test", state=State.building, data=bytes("Old", "utf-8"),
+            zip = AutograderZip(id=id, description="Test", state=State.building, digest=calcuate_zip_hash(bytes("Old", "utf-8")),
                                 owner=livefeedback_hub.helper.misc.get_user_hash({"name": "user"}))
             session.add(zip)
         response = self.fetch(f"/results/{id}")
         assert response.code == 403
         response = self.fetch(f"/api/results/{id}")
         assert response.code == 403
+        response = self.fetch(f"/api/timings/{id}")
+        assert response.code == 403
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    def test_timings(self, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "admin", "groups": ["teacher"]}
+        id = str(uuid.uuid4())
+        with self.service.session() as session:
+            zip = AutograderZip(id=id, description="Test", state=State.ready, digest=calcuate_zip_hash(bytes("Old", "utf-8")),
+                                owner=livefeedback_hub.helper.misc.get_user_hash(get_current_user_mock.return_value))
+            session.add(zip)
+        response = self.fetch(f"/api/timings/{id}")
+        assert response.code == 204
+
+        for i in range(1, 101):
+            self.service.result_writer.put(str(i), id, "q1", timing={"queue": float(i), "prepare": 0.5, "grading": 2.0})
+        self.service.result_writer.put("other", "other", "q1", timing={"queue": 1000.0, "prepare": 0.5, "grading": 2.0})
+        self.service.result_writer.flush()
+
+        response = self.fetch(f"/api/timings/{id}")
+        assert response.code == 200
+        timings = json.loads(response.body)
+        assert timings["count"] == 100
+        assert timings["queue"] == {"p50": 50.0, "p90": 90.0, "p95": 95.0, "p99": 99.0}
+        assert timings["prepare"]["p99"] == 0.5
+        assert timings["grading"]["p50"] == 2.0
+        assert timings["write"]["p50"] >= 0
+        assert timings["total"]["p50"] >= 52.5
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    def test_history(self, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "admin", "groups": ["teacher"]}
+        id = str(uuid.uuid4())
+        with self.service.session() as session:
+            zip = AutograderZip(id=id, description="Test", state=State.ready, digest=calcuate_zip_hash(bytes("Old", "utf-8")),
+                                owner=livefeedback_hub.helper.misc.get_user_hash(get_current_user_mock.return_value))
+            session.add(zip)
+        assert self.fetch(f"/api/history/{id}").code == 204
+        assert self.fetch(f"/api/history/{id}?window=abc").code == 400
+
+        # Every result is kept in the history, even if a newer result of the student replaced it
+        minute = int(time.time()) // 60 * 60
+        with patch("livefeedback_hub.helper.result_writer.time.time", return_value=minute + 1):
+            self.service.result_writer.put("1", id, "q1,q2,file\n0.0,1.0,test.ipynb")
+            self.service.result_writer.put("1", id, "q1,q2,file\n1.0,1.0,test.ipynb")
+            self.service.result_writer.put("2", id, "q1,q2,file\n0.0,0.5,test.ipynb")
+            self.service.result_writer.put("2", "other", "q1\n1.0")
+        self.service.result_writer.flush()
+        with self.service.session() as session:
+            assert session.query(Result).filter_by(assignment=id).count() == 2
+            session.add(ResultHistory(assignment=id, user="3", graded=int(time.time()) - 3 * 3600, question="q1", score=1.0))
+
+        response = self.fetch(f"/api/history/{id}?window=10")
+        assert response.code == 200
+        history = json.loads(response.body)
+        assert history["window"] == 10
+        assert len(history["buckets"]) == 1
+        assert history["buckets"][0]["start"] == minute
+        questions = history["buckets"][0]["questions"]
+        assert questions["q1"] == {"submissions": 3, "passed": 1 / 3, "score": 1 / 3}
+        assert questions["q2"] == {"submissions": 3, "passed": 1.0, "score": 2.5 / 3}
+
+        response = self.fetch(f"/api/history/{id}?window=1000000")
+        assert json.loads(response.body)["window"] == self.service.history_max_window
+        assert sum(bucket["questions"]["q1"]["submissions"] for bucket in json.loads(response.body)["buckets"]) == 4
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    def test_history_not_owner(self, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "admin", "groups": ["teacher"]}
+        id = str(uuid.uuid4())
+        with self.service.session() as session:
+            session.add(AutograderZip(id=id, description="Test", state=State.ready, digest=calcuate_zip_hash(bytes("Old", "utf-8")), owner="other"))
+        assert self.fetch(f"/api/history/{id}").code == 403
+
+    def _add_export_results(self, owner: str):
+        ids = [str(uuid.uuid4()), str(uuid.uuid4())]
+        with self.service.session() as session:
+            session.add(AutograderZip(id=ids[0], description="First", state=State.ready, digest=calcuate_zip_hash(bytes("First", "utf-8")), owner=owner))
+            session.add(AutograderZip(id=ids[1], description="Second", state=State.ready, digest=calcuate_zip_hash(bytes("Second", "utf-8")), owner=owner))
+            session.add(AutograderZip(id="other", description="Other", state=State.ready, digest=calcuate_zip_hash(bytes("Other", "utf-8")), owner="other"))
+            for user in range(5):
+                session.add(Result(user=str(user), assignment=ids[0], data=f"file,q1,q2\ntest.ipynb,{user % 2},1.0"))
+            session.add(Result(user="1", assignment=ids[1], data="file,q1\ntest.ipynb,0.5"))
+            session.add(Result(user="1", assignment="other", data="file,q1\ntest.ipynb,1.0"))
+        return ids
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    def test_export(self, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "admin", "groups": ["teacher"]}
+        ids = self._add_export_results(livefeedback_hub.helper.misc.get_user_hash(get_current_user_mock.return_value))
+        self.service.export_chunk_size = 2
+        try:
+            response = self.fetch(f"/api/export/{ids[0]}")
+            assert response.code == 200
+            assert response.headers["Content-Type"] == "text/csv"
+            lines = response.body.decode().splitlines()
+            assert lines[0] == "assignment,user,question,score"
+            assert lines[1:5] == [f"{ids[0]},0,q1,0.0", f"{ids[0]},0,q2,1.0", f"{ids[0]},1,q1,1.0", f"{ids[0]},1,q2,1.0"]
+            assert len(lines) == 11
+
+            # Without id, all tasks of the teacher are exported
+            lines = self.fetch("/api/export").body.decode().splitlines()
+            assert len(lines) == 12
+            assert f"{ids[1]},1,q1,0.5" in lines
+        finally:
+            self.service.export_chunk_size = 1000
+
+        assert self.fetch("/api/export/333e2069-612e-4e0c-a4ac-e6ec1eaa44f0").code == 403
+        assert self.fetch(f"/api/export/{ids[0]}?format=xlsx").code == 400
+        with self.service.session() as session:
+            session.query(Result).delete()
+        assert self.fetch(f"/api/export/{ids[0]}").code == 204
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    def test_export_parquet(self, get_current_user_mock: MagicMock):
+        pq = pytest.importorskip("pyarrow.parquet")
+        get_current_user_mock.return_value = {"name": "admin", "groups": ["teacher"]}
+        ids = self._add_export_results(livefeedback_hub.helper.misc.get_user_hash(get_current_user_mock.return_value))
+        self.service.export_chunk_size = 2
+        try:
+            response = self.fetch("/api/export?format=parquet")
+        finally:
+            self.service.export_chunk_size = 1000
+        assert response.code == 200
+        table = pq.read_table(io.BytesIO(response.body))
+        assert table.column_names == ["assignment", "user", "question", "score"]
+        assert table.num_rows == 11
+        assert pq.ParquetFile(io.BytesIO(response.body)).num_row_groups == 3
+        assert sorted(table.column("assignment").to_pylist()) == sorted([ids[0]] * 10 + [ids[1]])
@@ -0,0 +1,100 @@
+import asyncio
+import json
+import threading
+from unittest.mock import MagicMock, patch
+
+from tornado.testing import AsyncHTTPTestCase
+
+from livefeedback_hub.db import AutograderZip, Job, JobKind, State
+from livefeedback_hub.handlers.submission import process_notebook
+from livefeedback_hub.helper.shutdown import ShutdownManager
+from livefeedback_hub.helper.temporary_submission import TemporarySubmission
+from livefeedback_hub.helper.unique_action_thread_pool_executor import UniqueActionThreadPoolExecutor
+from livefeedback_hub.server import JupyterService
+from test.test_submission import notebook
+
+
+class TestShutdownManager:
+
+    def test_drain(self):
+        service = JupyterService()
+        manager = ShutdownManager(service, interval=0.01)
+        assert asyncio.run(manager.drain(1))
+        manager.build_queued("1", "digest")
+        assert not asyncio.run(manager.drain(0.05))
+        manager.build_finished("1")
+        assert manager.idle()
+
+    def test_checkpoint(self, tmp_path):
+        service = JupyterService(db_url=f"sqlite:///{tmp_path / 'data.db'}")
+        manager = service.shutdown_manager
+        executor = UniqueActionThreadPoolExecutor(max_workers=1)
+        blocked = threading.Event()
+        executor.submit(blocked.wait)
+        executor.submit(process_notebook, service=service, zip_digest="digest", notebook=b"queued", id="a", user_hash="queued", received=1.0)
+        manager.grading_started(TemporarySubmission(notebook=b"running", zip_digest="digest", id="a", user_hash="running", received=2.0))
+        with service.scheduler.lock():
+            service.scheduler.start("running")
+            service.scheduler.queue(TemporarySubmission(notebook=b"backlog", zip_digest="digest", id="b", user_hash="running", received=3.0))
+        manager.build_queued("c", "new", update=True)
+
+        with patch("livefeedback_hub.handlers.submission.submission_executor", executor):
+            assert manager.checkpoint() == 4
+        blocked.set()
+        executor.shutdown()
+        with service.scheduler.lock():
+            assert service.scheduler.backlog_size() == 0
+            assert not service.scheduler.is_running("running")
+        with service.session() as session:
+            jobs = session.query(Job).order_by(Job.id).all()
+            assert [(job.kind, job.user, job.assignment, job.notebook) for job in jobs] == [
+                (JobKind.grade, "running", "a", b"running"), (JobKind.grade, "queued", "a", b"queued"), (JobKind.grade, "running", "b", b"backlog"),
+                (JobKind.build, None, "c", None)]
+            assert jobs[3].zip_digest == "new" and jobs[3].update
+
+    @patch("livefeedback_hub.handlers.manage.manage_executor")
+    @patch("livefeedback_hub.handlers.submission.submission_executor")
+    def test_resume(self, submission_executor: MagicMock, manage_executor: MagicMock, tmp_path):
+        service = JupyterService(db_url=f"sqlite:///{tmp_path / 'data.db'}")
+        service.job_queue.put_grading("user", "a", "digest", b"notebook", received=1.0)
+        service.job_queue.put_build("b", "new", update=True)
+        with service.session() as session:
+            session.add(AutograderZip(id="b", owner="owner", digest="old", state=State.building))
+            session.add(AutograderZip(id="c", owner="owner", digest="lost", state=State.building))
+            session.add(AutograderZip(id="d", owner="owner", digest="ready", state=State.ready))
+
+        assert service.shutdown_manager.resume() == 3
+        assert service.job_queue.size() == 0
+        submission_executor.submit.assert_called_once_with(process_notebook, service=service, zip_digest="digest", notebook=b"notebook", id="a", user_hash="user",
+                                                           received=1.0)
+        assert [call.args[1:] for call in manage_executor.submit.call_args_list] == [(service, "b", "new"), (service, "c", "lost")]
+        assert not service.shutdown_manager.idle()
+
+
+class TestDraining(AsyncHTTPTestCase):
+    service = JupyterService(xsrf_cookies=False)
+
+    def get_app(self):
+        return self.service.app
+
+    def tearDown(self):
+        self.service.shutdown_manager = ShutdownManager(self.service)
+        super().tearDown()
+
+    def test_health(self):
+        response = self.fetch("/health")
+        assert response.code == 200
+        assert json.loads(response.body) == {"status": "ready"}
+        self.service.shutdown_manager.begin()
+        response = self.fetch("/health")
+        assert response.code == 503
+        assert json.loads(response.body) == {"status": "draining"}
+
+    @patch("livefeedback_hub.handlers.submission.submission_executor")
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    def test_submit_while_draining(self, get_current_user_mock: MagicMock, submission_executor: MagicMock):
+        get_current_user_mock.return_value = {"name": "student"}
+        self.service.shutdown_manager.begin()
+        response = self.fetch("/submit", method="POST", body=notebook)
+        assert response.code == 503
+        submission_executor.submit.assert_not_called()
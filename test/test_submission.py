@@ -1,46 +1,274 @@
+import asyncio
+import json
+import threading
 import time
 from unittest.mock import MagicMock, patch
 
 import pandas as pd
+import pytest
+from sqlalchemy.exc import OperationalError
 from tornado.testing import AsyncHTTPTestCase
+from tornado.util import TimeoutError
 
-import livefeedback_hub
-from livefeedback_hub.db import AutograderZip, Result, State
+from livefeedback_hub.db import AutograderZip, JobTiming, Result, State
 from livefeedback_hub.handlers import submission
-from livefeedback_hub.helper.misc import get_user_hash
+from livefeedback_hub.helper.misc import calcuate_zip_hash, get_user_hash
+from livefeedback_hub.helper.result_notifier import ResultNotifier, parse_scores
+from livefeedback_hub.helper.scheduler_state import file_lock
+from livefeedback_hub.helper.set_queue import SetQueue
+from livefeedback_hub.helper.unique_action_thread_pool_executor import Priority, UniqueActionThreadPoolExecutor
+from livefeedback_hub.helper.temporary_submission import TemporarySubmission
 from livefeedback_hub.server import JupyterService
 
 notebook = '{ "cells": [ { "cell_type": "code", "metadata": {}, "source": "# LIVE: 333e2069-612e-4e0c-a4ac-e6ec1eaa44f0" } ], "metadata": { "kernelspec": { "display_name": "Python 3", "language": "python", "name": "python3" }, "language_info": { "codemirror_mode": { "name": "ipython", "version": 3 }, "file_extension": ".py", "mimetype": "text/x-python", "name": "python", "nbconvert_exporter": "python", "pygments_lexer": "ipython3", "version": "3.6.5" }, "varInspector": { "cols": { "lenName": 16, "lenType": 16, "lenVar": 40 }, "kernels_config": { "python": { "delete_cmd_postfix": "", "delete_cmd_prefix": "del ", "library": "var_list.py", "varRefreshCmd": "print(var_dic_list())" }, "r": { "delete_cmd_postfix": ") ", "delete_cmd_prefix": "rm(", "library": "var_list.r", "varRefreshCmd": "cat(var_dic_list()) " } }, "types_to_exclude": [ "module", "function", "builtin_function_or_method", "instance", "_Feature" ], "window_display": false } }, "nbformat": 4, "nbformat_minor": 4}'
 notebook_without_id = '{ "cells": [ { "cell_type": "code", "metadata": {}, "source": "" } ], "metadata": { "kernelspec": { "display_name": "Python 3", "language": "python", "name": "python3" }, "language_info": { "codemirror_mode": { "name": "ipython", "version": 3 }, "file_extension": ".py", "mimetype": "text/x-python", "name": "python", "nbconvert_exporter": "python", "pygments_lexer": "ipython3", "version": "3.6.5" }, "varInspector": { "cols": { "lenName": 16, "lenType": 16, "lenVar": 40 }, "kernels_config": { "python": { "delete_cmd_postfix": "", "delete_cmd_prefix": "del ", "library": "var_list.py", "varRefreshCmd": "print(var_dic_list())" }, "r": { "delete_cmd_postfix": ") ", "delete_cmd_prefix": "rm(", "library": "var_list.r", "varRefreshCmd": "cat(var_dic_list()) " } }, "types_to_exclude": [ "module", "function", "builtin_function_or_method", "instance", "_Feature" ], "window_display": false } }, "nbformat": 4, "nbformat_minor": 4}'
 
 
+def add_task(service: JupyterService, id: str = "test"):
+    # Results are only written for existing tasks
+    with service.session() as session:
+        session.add(AutograderZip(id=id, state=State.ready, digest=calcuate_zip_hash(bytes("", "utf-8"))))
+
+
 class TestSubmission:
 
+    @patch("livefeedback_hub.handlers.submission.ensure_image", MagicMock())
     @patch("otter.grade.containers.grade_assignments")
     def test_process_notebook(self, grade: MagicMock):
         service = JupyterService()
+        add_task(service)
         grade.return_value = pd.DataFrame()
-        submission.process_notebook(service, bytes("", "utf-8"), bytes("", "utf-8"), "test", "test")
+        submission.process_notebook(service, calcuate_zip_hash(bytes("", "utf-8")), bytes("", "utf-8"), "test", "test")
         grade.assert_called_once()
+        service.result_writer.flush()
         with service.session() as session:
             assert session.query(Result).first().user == "test"
 
+    @patch("livefeedback_hub.handlers.submission.ensure_image", MagicMock())
+    @patch("otter.grade.containers.grade_assignments")
+    def test_process_notebook_timing(self, grade: MagicMock):
+        service = JupyterService()
+        add_task(service)
+        grade.side_effect = lambda *args, **kwargs: time.sleep(0.1) or pd.DataFrame()
+        submission.process_notebook(service, calcuate_zip_hash(bytes("", "utf-8")), bytes("", "utf-8"), "test", "test", received=time.time() - 5)
+        service.result_writer.flush()
+        with service.session() as session:
+            timing = session.query(JobTiming).filter_by(assignment="test").one()
+            assert timing.queue >= 5
+            assert timing.grading >= 0.1
+            assert timing.prepare >= 0
+            assert timing.write >= 0
+            session.query(JobTiming).delete()
+
+    @patch("livefeedback_hub.handlers.submission.ensure_image", MagicMock())
     @patch("otter.grade.containers.grade_assignments")
     def test_process_notebook_twice(self, grade: MagicMock):
         service = JupyterService()
+        add_task(service)
         grade.return_value = pd.DataFrame()
-        submission.process_notebook(service, bytes("", "utf-8"), bytes("test", "utf-8"), "test", "test")
-        submission.process_notebook(service, bytes("", "utf-8"), bytes("test-2", "utf-8"), "test", "test")
+        submission.process_notebook(service, calcuate_zip_hash(bytes("", "utf-8")), bytes("test", "utf-8"), "test", "test")
+        submission.process_notebook(service, calcuate_zip_hash(bytes("", "utf-8")), bytes("test-2", "utf-8"), "test", "test")
+        service.result_writer.flush()
         with service.session() as session:
             assert session.query(Result).first().user == "test"
             assert session.query(Result).count() == 1
 
-        submission.process_notebook(service, bytes("", "utf-8"), bytes("test-3", "utf-8"), "test", "test1")
+        submission.process_notebook(service, calcuate_zip_hash(bytes("", "utf-8")), bytes("test-3", "utf-8"), "test", "test1")
+        service.result_writer.flush()
 
         with service.session() as session:
             assert session.query(Result).first().user == "test"
             assert session.query(Result).count() == 2
 
+    @patch("livefeedback_hub.handlers.submission.ensure_image")
+    @patch("otter.grade.containers.grade_assignments")
+    def test_process_notebook_deleted(self, grade: MagicMock, ensure_image: MagicMock):
+        service = JupyterService()
+        with service.session() as session:
+            session.add(AutograderZip(id="test", state=State.deleted, digest="digest"))
+        submission.process_notebook(service, "digest", bytes("", "utf-8"), "test", "test")
+        # The image of the deleted task is not restored
+        ensure_image.assert_not_called()
+        grade.assert_not_called()
+        assert not service.scheduler.is_running("test")
+
+    @patch("otter.grade.containers.grade_assignments")
+    def test_process_notebook_running(self, grade: MagicMock):
+        service = JupyterService()
+        grade.return_value = pd.DataFrame()
+        service.scheduler.start("test")
+        submission.process_notebook(service, calcuate_zip_hash(bytes("", "utf-8")), bytes("test", "utf-8"), "test", "test")
+        grade.assert_not_called()
+        assert service.scheduler.pop("test").notebook == bytes("test", "utf-8")
+
+    def test_database_scheduler_state(self, tmp_path):
+        # Two services sharing one database like two processes of a deployment
+        url = f"sqlite:///{tmp_path / 'data.db'}"
+        first = JupyterService(db_url=url, scheduler_backend="database")
+        second = JupyterService(db_url=url, scheduler_backend="database")
+        with first.scheduler.lock():
+            assert first.scheduler.start("user")
+        with second.scheduler.lock():
+            assert second.scheduler.is_running("user")
+            assert not second.scheduler.start("user")
+            second.scheduler.queue(TemporarySubmission(notebook=bytes("1", "utf-8"), zip_digest="digest", id="a", user_hash="user"))
+            second.scheduler.queue(TemporarySubmission(notebook=bytes("2", "utf-8"), zip_digest="digest", id="b", user_hash="user"))
+            second.scheduler.queue(TemporarySubmission(notebook=bytes("3", "utf-8"), zip_digest="digest", id="a", user_hash="user"))
+        with first.scheduler.lock():
+            first.scheduler.finish("user")
+            assert not second.scheduler.is_running("user")
+            assert first.scheduler.pop("user").notebook == bytes("2", "utf-8")
+            item = first.scheduler.pop("user")
+            assert item.notebook == bytes("3", "utf-8")
+            assert item.id == "a"
+            assert item.zip_digest == "digest"
+            assert first.scheduler.pop("user") is None
+
+    def test_process_notebook_shared(self, tmp_path):
+        url = f"sqlite:///{tmp_path / 'data.db'}"
+        first = JupyterService(db_url=url, scheduler_backend="database")
+        second = JupyterService(db_url=url, scheduler_backend="database")
+        with first.scheduler.lock():
+            assert first.scheduler.start("user")
+        second.result_notifier.expect("user", "a", 1.0)
+        submission.process_notebook(second, "digest", bytes("1", "utf-8"), "a", "user", received=1.0)
+        # The queued submission may be graded by the first service, so the second one does not wait for it
+        assert second.result_notifier.expected("user", "a") is None
+        with first.scheduler.lock():
+            assert first.scheduler.backlog_size() == 1
+
+    def test_file_lock(self, tmp_path):
+        path = str(tmp_path / "data.db.lock")
+        acquired = threading.Event()
+
+        def acquire():
+            with file_lock(path):
+                acquired.set()
+
+        with file_lock(path):
+            thread = threading.Thread(target=acquire)
+            thread.start()
+            assert not acquired.wait(0.1)
+        assert acquired.wait(5)
+        thread.join()
+
+    def test_file_lock_windows(self, tmp_path):
+        msvcrt = MagicMock()
+        # fcntl is missing on Windows
+        with patch.dict("sys.modules", {"fcntl": None, "msvcrt": msvcrt}):
+            with file_lock(str(tmp_path / "data.db.lock")):
+                assert msvcrt.locking.call_args.args[1:] == (msvcrt.LK_LOCK, 1)
+        assert msvcrt.locking.call_args.args[1:] == (msvcrt.LK_UNLCK, 1)
+
+    def test_database_scheduler_state_stale(self, tmp_path):
+        service = JupyterService(db_url=f"sqlite:///{tmp_path / 'data.db'}", scheduler_backend="database", scheduler_stale_timeout=-1)
+        assert service.scheduler.start("user")
+        assert not service.scheduler.is_running("user")
+        assert service.scheduler.start("user")
+
+    def test_result_writer_batch(self):
+        service = JupyterService()
+        add_task(service)
+        service.result_writer.put("user1", "test", "q1\n0.0")
+        service.result_writer.put("user1", "test", "q1\n1.0")
+        service.result_writer.put("user2", "test", "q1\n0.0")
+        assert service.result_writer.pending() == 2
+        assert service.result_writer.flush() == 2
+        assert service.result_writer.pending() == 0
+        service.result_writer.put("user2", "test", "q1\n1.0")
+        assert service.result_writer.flush() == 1
+        with service.session() as session:
+            assert session.query(Result).count() == 2
+            assert session.query(Result).filter_by(user="user1").first().data == "q1\n1.0"
+            assert session.query(Result).filter_by(user="user2").first().data == "q1\n1.0"
+        assert service.result_writer.flush() == 0
+
+    def test_result_writer_invalid(self):
+        service = JupyterService()
+        with service.engine.connect() as connection:
+            # Violated foreign keys fail like on PostgreSQL
+            connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+        with service.session() as session:
+            session.add(AutograderZip(id="live", state=State.ready, digest="digest"))
+        service.result_writer.put("user", "live", "q1\n1.0")
+        service.result_writer.put("user", "deleted", "q1\n1.0")
+        assert service.result_writer.flush() == 1
+        # The invalid result is dropped instead of blocking later flushes
+        assert service.result_writer.pending() == 0
+        with service.session() as session:
+            assert [result.assignment for result in session.query(Result).all()] == ["live"]
+
+    def test_result_writer_retry(self):
+        service = JupyterService()
+        add_task(service)
+        upsert = service.result_writer._upsert
+
+        def locked(session, rows):
+            if any(row["user"] == "locked" for row in rows):
+                raise OperationalError("INSERT", {}, Exception("database is locked"))
+            upsert(session, rows)
+
+        service.result_writer.put("user", "test", "q1\n1.0")
+        service.result_writer.put("locked", "test", "q1\n1.0")
+        with patch.object(service.result_writer, "_upsert", side_effect=locked):
+            assert service.result_writer.flush() == 1
+        assert service.result_writer.pending() == 1
+        assert service.result_writer.flush() == 1
+        with service.session() as session:
+            assert session.query(Result).count() == 2
+
+    def test_set_queue_find_and_remove(self):
+        queue = SetQueue()
+        for item in range(5):
+            queue.put(item)
+        assert queue.find_and_remove(lambda item: item % 2 == 0) == [0, 2, 4]
+        assert queue.items() == [1, 3]
+        assert queue.qsize() == 2
+
+
+class TestPriorityQueue:
+
+    def test_lanes(self):
+        queue = SetQueue(lanes=3, lane=lambda item: item[0])
+        for item in [(2, "a"), (1, "b"), (2, "c"), (0, "d"), (1, "e")]:
+            queue.put(item)
+        queue.put(None)
+        queue.put((0, "f"))
+        assert [queue.get()[1] for _ in range(6)] == ["d", "f", "b", "e", "a", "c"]
+        # None wakes up the threads of an executor once all work is done
+        assert queue.get() is None
+        assert queue.qsize() == 0
+
+    def test_starvation(self):
+        queue = SetQueue(lanes=3, lane=lambda item: item[0], max_wait=60)
+        with patch("livefeedback_hub.helper.set_queue.time.monotonic", return_value=0):
+            queue.put((2, "old"))
+        with patch("livefeedback_hub.helper.set_queue.time.monotonic", return_value=10):
+            queue.put((1, "first"))
+        with patch("livefeedback_hub.helper.set_queue.time.monotonic", return_value=50):
+            queue.put((0, "owner"))
+            assert queue.get()[1] == "owner"
+        with patch("livefeedback_hub.helper.set_queue.time.monotonic", return_value=100):
+            queue.put((0, "owner"))
+            # Both lanes waited too long, the oldest item is taken first
+            assert [queue.get()[1] for _ in range(3)] == ["old", "first", "owner"]
+
+    def test_executor(self):
+        executor = UniqueActionThreadPoolExecutor(max_workers=1)
+        started = threading.Event()
+        blocked = threading.Event()
+        order = []
+        try:
+            executor.submit(lambda: started.set() or blocked.wait(5))
+            assert started.wait(5)
+            futures = [executor.submit(order.append, priority, priority=priority) for priority in [Priority.resubmission, Priority.first, Priority.owner]]
+            blocked.set()
+            for future in futures:
+                future.result(5)
+        finally:
+            executor.shutdown()
+        assert order == [Priority.owner, Priority.first, Priority.resubmission]
+
 
 class TestSubmissionHandler(AsyncHTTPTestCase):
     service = JupyterService(xsrf_cookies=False)
@@ -79,6 +307,7 @@ class TestSubmissionHandler(AsyncHTTPTestCase):
         response = self.fetch("/submit", method="POST", body=notebook_without_id)
         assert response.code == 200
 
+    @patch("livefeedback_hub.handlers.submission.ensure_image", MagicMock())
     @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
     @patch("otter.grade.containers.grade_assignments")
     @patch("livefeedback_hub.handlers.submission.add_or_update_results")
@@ -88,7 +317,7 @@ class TestSubmissionHandler(AsyncHTTPTestCase):
         self.service.log.exception = MagicMock()
         with self.service.session() as session:
             zip = AutograderZip(id="333e2069-612e-4e0c-a4ac-e6ec1eaa44f0", description="Test", state=State.ready,
-                                data=bytes("Old", "utf-8"),
+                                digest=calcuate_zip_hash(bytes("Old", "utf-8")),
                                 owner=get_user_hash(get_current_user_mock.return_value))
             session.add(zip)
         response = self.fetch("/submit", method="POST", body=notebook)
@@ -100,6 +329,7 @@ class TestSubmissionHandler(AsyncHTTPTestCase):
         self.service.log.exception.assert_called_once()
         add_or_update_results.assert_not_called()
 
+    @patch("livefeedback_hub.handlers.submission.ensure_image", MagicMock())
     @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
     @patch("otter.grade.containers.grade_assignments")
     def test_submit_success(self, grade: MagicMock, get_current_user_mock: MagicMock):
@@ -108,7 +338,7 @@ class TestSubmissionHandler(AsyncHTTPTestCase):
         self.service.log.exception = MagicMock()
         with self.service.session() as session:
             zip = AutograderZip(id="333e2069-612e-4e0c-a4ac-e6ec1eaa44f0", description="Test", state=State.ready,
-                                data=bytes("Old", "utf-8"),
+                                digest=calcuate_zip_hash(bytes("Old", "utf-8")),
                                 owner=get_user_hash(get_current_user_mock.return_value))
             session.add(zip)
 
@@ -121,19 +351,69 @@ class TestSubmissionHandler(AsyncHTTPTestCase):
 
     @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
     @patch("livefeedback_hub.handlers.submission.submission_executor.submit")
-    @patch.object(livefeedback_hub.handlers.submission, "running_store", {get_user_hash({"name": "student"})})
     def test_submit_twice(self, submit: MagicMock, get_current_user_mock: MagicMock):
         get_current_user_mock.return_value = {"name": "student"}
+        self.service.scheduler.start(get_user_hash(get_current_user_mock.return_value))
+        self.addCleanup(self.service.scheduler.finish, get_user_hash(get_current_user_mock.return_value))
 
         with self.service.session() as session:
             zip = AutograderZip(id="333e2069-612e-4e0c-a4ac-e6ec1eaa44f0", description="Test", state=State.ready,
-                                data=bytes("Old", "utf-8"),
+                                digest=calcuate_zip_hash(bytes("Old", "utf-8")),
                                 owner=get_user_hash(get_current_user_mock.return_value))
             session.add(zip)
 
         response = self.fetch("/submit", method="POST", body=notebook)
         assert response.code == 200
         submit.assert_not_called()
+        item = self.service.scheduler.pop(get_user_hash(get_current_user_mock.return_value))
+        assert item.id == "333e2069-612e-4e0c-a4ac-e6ec1eaa44f0"
+        assert item.notebook == notebook.encode()
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("livefeedback_hub.handlers.submission.submission_executor.submit")
+    def test_submit_strip_outputs(self, submit: MagicMock, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "student"}
+        with self.service.session() as session:
+            zip = AutograderZip(id="333e2069-612e-4e0c-a4ac-e6ec1eaa44f0", description="Test", state=State.ready,
+                                digest=calcuate_zip_hash(bytes("Old", "utf-8")),
+                                owner=get_user_hash(get_current_user_mock.return_value))
+            session.add(zip)
+        nb = json.loads(notebook)
+        nb["metadata"]["widgets"] = {"application/vnd.jupyter.widget-state+json": {"state": {}}}
+        nb["cells"][0]["execution_count"] = 1
+        nb["cells"][0]["outputs"] = [{"output_type": "display_data", "data": {"image/png": "A" * 10000}, "metadata": {}}]
+        nb["cells"].append({"cell_type": "markdown", "metadata": {}, "source": "![a](attachment:a.png)", "attachments": {"a.png": {"image/png": "A" * 10000}}})
+
+        response = self.fetch("/submit", method="POST", body=json.dumps(nb))
+        assert response.code == 200
+        submit.assert_called_once()
+        stripped = json.loads(submit.call_args.kwargs["notebook"])
+        assert "widgets" not in stripped["metadata"]
+        assert stripped["cells"][0]["outputs"] == []
+        assert stripped["cells"][0]["execution_count"] is None
+        assert stripped["cells"][0]["source"] == nb["cells"][0]["source"]
+        assert "attachments" not in stripped["cells"][1]
+        assert stripped["cells"][1]["source"] == nb["cells"][1]["source"]
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("livefeedback_hub.handlers.submission.submission_executor.submit")
+    def test_submit_priority(self, submit: MagicMock, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "student"}
+        id = "333e2069-612e-4e0c-a4ac-e6ec1eaa44f0"
+        with self.service.session() as session:
+            session.add(AutograderZip(id=id, description="Test", state=State.ready, digest=calcuate_zip_hash(bytes("Old", "utf-8")), owner="teacher"))
+
+        assert self.fetch("/submit", method="POST", body=notebook).code == 200
+        assert submit.call_args.kwargs["priority"] == Priority.first
+        with self.service.session() as session:
+            session.add(Result(user=get_user_hash(get_current_user_mock.return_value), assignment=id, data="q1\n1.0"))
+        assert self.fetch("/submit", method="POST", body=notebook).code == 200
+        assert submit.call_args.kwargs["priority"] == Priority.resubmission
+
+        with self.service.session() as session:
+            session.query(AutograderZip).filter_by(id=id).update({"owner": get_user_hash(get_current_user_mock.return_value)})
+        assert self.fetch("/submit", method="POST", body=notebook).code == 200
+        assert submit.call_args.kwargs["priority"] == Priority.owner
 
 
 class TestQueueSubmissionHandler(AsyncHTTPTestCase):
@@ -157,7 +437,7 @@ class TestQueueSubmissionHandler(AsyncHTTPTestCase):
 
         with self.service.session() as session:
             zip = AutograderZip(id="333e2069-612e-4e0c-a4ac-e6ec1eaa44f0", description="Test", state=State.ready,
-                                data=bytes("Old", "utf-8"),
+                                digest=calcuate_zip_hash(bytes("Old", "utf-8")),
                                 owner=get_user_hash(get_current_user_mock.return_value))
             session.add(zip)
         find.return_value.kwargs = {"id": "Test"}
@@ -168,3 +448,125 @@ class TestQueueSubmissionHandler(AsyncHTTPTestCase):
         response = self.fetch("/submit", method="POST", body=notebook)
         assert response.code == 200
         submit.assert_called_once()
+
+
+class TestResultNotifier:
+
+    def test_parse_scores(self):
+        assert parse_scores("q1,q2,file\n1.0,,test.ipynb\n") == {"q1": 1.0, "q2": 0.0}
+        assert parse_scores("") == {}
+
+    def test_notify(self):
+        notifier = ResultNotifier()
+        now = time.time()
+
+        async def wait():
+            notifier.expect("user", "task", now)
+            assert notifier.expected("user", "task") == now
+            waiting = asyncio.ensure_future(notifier.wait("user", "task", now, timeout=5))
+            await asyncio.sleep(0)
+            # Results of older submissions are not awaited
+            notifier.notify("user", "task", "q1\n0.0", now - 5)
+            notifier.notify("other", "task", "q1\n0.0", now + 10)
+            assert notifier.expected("user", "task") == now
+            notifier.notify("user", "task", "q1\n1.0", now)
+            assert await waiting == "q1\n1.0"
+            assert notifier.expected("user", "task") is None
+            assert notifier.waiting() == 0
+            with pytest.raises(TimeoutError):
+                await notifier.wait("user", "task", now + 10, timeout=0.01)
+            assert notifier.waiting() == 0
+
+        asyncio.run(wait())
+
+    def test_expire(self):
+        notifier = ResultNotifier(ttl=60)
+        notifier.expect("user", "task", time.time() - 120)
+        assert notifier.expected("user", "task") is None
+        received = time.time()
+        notifier.expect("user", "task", received)
+        # Only the expectation of the given submission is forgotten
+        notifier.forget("user", "task", received - 1)
+        assert notifier.expected("user", "task") == received
+        notifier.forget("user", "task", received)
+        assert notifier.expected("user", "task") is None
+
+
+class TestSubmitAndWait(AsyncHTTPTestCase):
+    service = JupyterService(xsrf_cookies=False, result_flush_interval=0.05)
+    id = "333e2069-612e-4e0c-a4ac-e6ec1eaa44f0"
+
+    def get_app(self):
+        return self.service.app
+
+    def setUp(self):
+        super().setUp()
+        self.service.result_writer.start()
+        with self.service.session() as session:
+            session.add(AutograderZip(id=self.id, description="Test", state=State.ready, digest=calcuate_zip_hash(bytes("Old", "utf-8")), owner="teacher"))
+
+    def tearDown(self):
+        self.service.result_writer.stop()
+        with self.service.session() as session:
+            session.query(AutograderZip).delete()
+            session.query(Result).delete()
+        super().tearDown()
+
+    @patch("livefeedback_hub.handlers.submission.ensure_image", MagicMock())
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("otter.grade.containers.grade_assignments")
+    def test_submit_wait(self, grade: MagicMock, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "student"}
+        grade.side_effect = lambda *args, **kwargs: time.sleep(0.2) or pd.DataFrame({"q1": [1.0], "q2": [0.0], "file": ["test.ipynb"]})
+        response = self.fetch("/submit?wait=10", method="POST", body=notebook)
+        assert response.code == 200
+        assert json.loads(response.body) == {"q1": 1.0, "q2": 0.0}
+
+        response = self.fetch(f"/api/feedback/{self.id}")
+        assert response.code == 200
+        assert json.loads(response.body) == {"q1": 1.0, "q2": 0.0}
+
+    @patch("livefeedback_hub.handlers.submission.ensure_image", MagicMock())
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("otter.grade.containers.grade_assignments")
+    def test_submit_wait_timeout(self, grade: MagicMock, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "student"}
+        grade.side_effect = lambda *args, **kwargs: time.sleep(1) or pd.DataFrame({"q1": [1.0], "file": ["test.ipynb"]})
+        response = self.fetch("/submit?wait=0.1", method="POST", body=notebook)
+        assert response.code == 202
+        assert self.fetch(f"/api/feedback/{self.id}").code == 202
+        response = self.fetch(f"/api/feedback/{self.id}?wait=10")
+        assert response.code == 200
+        assert json.loads(response.body) == {"q1": 1.0}
+
+    @patch("livefeedback_hub.handlers.submission.ensure_image", MagicMock())
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("otter.grade.containers.grade_assignments")
+    def test_submit_wait_failing(self, grade: MagicMock, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "student"}
+        grade.side_effect = Exception()
+        response = self.fetch("/submit?wait=10", method="POST", body=notebook)
+        assert response.code == 204
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    def test_feedback_graded_elsewhere(self, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "student"}
+        user_hash = get_user_hash({"name": "student"})
+        received = time.time()
+        self.service.result_notifier.expect(user_hash, self.id, received)
+        with self.service.session() as session:
+            session.add(Result(assignment=self.id, user=user_hash, data="q1\n1.0", received=received - 5))
+        assert self.fetch(f"/api/feedback/{self.id}").code == 202
+        with self.service.session() as session:
+            session.query(Result).update({Result.data: "q1\n0.5", Result.received: received})
+        response = self.fetch(f"/api/feedback/{self.id}")
+        assert response.code == 200
+        assert json.loads(response.body) == {"q1": 0.5}
+        assert self.service.result_notifier.expected(user_hash, self.id) is None
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    def test_feedback(self, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "student"}
+        assert self.fetch(f"/api/feedback/{self.id}?wait=10").code == 204
+        assert self.fetch(f"/api/feedback/{self.id}?wait=abc").code == 400
+        assert self.fetch("/api/feedback/5e3d2069-612e-4e0c-a4ac-e6ec1eaa44f0").code == 403
@@ -0,0 +1,55 @@
+import os
+from unittest.mock import patch
+
+from livefeedback_hub.helper import misc
+from livefeedback_hub.helper.teacher_roster import TeacherRoster
+
+
+class TestTeacherRoster:
+
+    def test_members(self, tmp_path):
+        path = tmp_path / "teachers"
+        path.write_text("alice\n\nbob \n")
+        roster = TeacherRoster(str(path), interval=0)
+        assert roster.members() == {"alice", "bob"}
+
+    def test_cached(self, tmp_path):
+        path = tmp_path / "teachers"
+        path.write_text("alice\n")
+        roster = TeacherRoster(str(path), interval=60)
+        assert roster.members() == {"alice"}
+        path.write_text("carol\n")
+        assert roster.members() == {"alice"}
+        roster.reload()
+        assert roster.members() == {"carol"}
+
+    def test_reload_changed(self, tmp_path):
+        path = tmp_path / "teachers"
+        path.write_text("alice\n")
+        roster = TeacherRoster(str(path), interval=0)
+        assert roster.members() == {"alice"}
+        with patch("builtins.open") as mock:
+            assert roster.members() == {"alice"}
+            mock.assert_not_called()
+        path.write_text("alice\ncarol\n")
+        os.utime(path, ns=(0, 0))
+        assert roster.members() == {"alice", "carol"}
+
+    def test_missing_file(self, tmp_path):
+        path = tmp_path / "teachers"
+        path.write_text("alice\n")
+        roster = TeacherRoster(str(path), interval=0)
+        assert roster.members() == {"alice"}
+        path.unlink()
+        assert roster.members() == {"alice"}
+        assert TeacherRoster(str(tmp_path / "missing"), interval=0).members() == set()
+
+    def test_group(self, tmp_path):
+        path = tmp_path / "teachers"
+        path.write_text("alice\n")
+        with patch.object(misc, "roster", TeacherRoster(str(path), group="teachers", interval=0)):
+            assert misc.is_teacher({"name": "alice", "groups": []})
+            assert misc.is_teacher({"name": "bob", "groups": ["teachers"]})
+            assert not misc.is_teacher({"name": "carol", "groups": ["students"]})
+            assert not misc.is_teacher({"name": "carol"})
+            assert not misc.is_teacher(None)
@@ -0,0 +1,143 @@
+import datetime
+import threading
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+from tornado.testing import AsyncHTTPTestCase
+
+from livefeedback_hub.db import AutograderZip, Job, JobKind, Result, State
+from livefeedback_hub.helper.misc import calcuate_zip_hash, get_user_hash
+from livefeedback_hub.server import JupyterService
+from livefeedback_hub.worker import Worker
+from test.test_submission import add_task, notebook
+
+
+def run_directly(fn, *args, **kwargs):
+    fn(*args, **kwargs)
+
+
+class TestJobQueue:
+
+    def test_claim(self, tmp_path):
+        url = f"sqlite:///{tmp_path / 'data.db'}"
+        web = JupyterService(db_url=url, execution_backend="worker")
+        worker = JupyterService(db_url=url, execution_backend="worker")
+        web.job_queue.put_grading("user", "a", "digest", bytes("1", "utf-8"))
+        web.job_queue.put_grading("user", "a", "digest", bytes("2", "utf-8"))
+        web.job_queue.put_build("b", "digest")
+        assert web.job_queue.size() == 2
+
+        job = worker.job_queue.claim("first")
+        assert job.kind == JobKind.grade
+        assert job.notebook == bytes("2", "utf-8")
+        # Claimed jobs are not replaced by newer submissions
+        web.job_queue.put_grading("user", "a", "digest", bytes("3", "utf-8"))
+        assert worker.job_queue.claim("second").kind == JobKind.build
+        assert worker.job_queue.claim("second").notebook == bytes("3", "utf-8")
+        assert worker.job_queue.claim("second") is None
+        worker.job_queue.complete(job.id)
+        assert web.job_queue.size() == 2
+
+    def test_claim_stale(self, tmp_path):
+        service = JupyterService(db_url=f"sqlite:///{tmp_path / 'data.db'}", scheduler_stale_timeout=-1)
+        service.job_queue.put_build("b", "digest")
+        assert service.job_queue.claim("first").assignment == "b"
+        assert service.job_queue.claim("second").assignment == "b"
+
+    def test_heartbeat(self, tmp_path):
+        service = JupyterService(db_url=f"sqlite:///{tmp_path / 'data.db'}", scheduler_stale_timeout=60)
+        service.job_queue.put_build("b", "digest")
+        job = service.job_queue.claim("first")
+        with service.session() as session:
+            session.query(Job).update({"claimed_at": datetime.datetime.utcnow() - datetime.timedelta(seconds=120)})
+        # Only the claiming worker refreshes its claim
+        assert service.job_queue.heartbeat("second", [job.id]) == 0
+        assert service.job_queue.heartbeat("first", [job.id]) == 1
+        assert service.job_queue.claim("second") is None
+
+
+class TestWorker:
+
+    @patch("livefeedback_hub.worker.submission_executor.submit", side_effect=run_directly)
+    @patch("livefeedback_hub.handlers.submission.ensure_image")
+    @patch("otter.grade.containers.grade_assignments")
+    def test_grade(self, grade: MagicMock, ensure_image: MagicMock, submit: MagicMock, tmp_path):
+        service = JupyterService(db_url=f"sqlite:///{tmp_path / 'data.db'}", execution_backend="worker")
+        grade.return_value = pd.DataFrame()
+        add_task(service)
+        service.job_queue.put_grading("user", "test", calcuate_zip_hash(bytes("", "utf-8")), bytes("", "utf-8"))
+
+        worker = Worker(service)
+        assert worker.run_once()
+        ensure_image.assert_called_once_with(service, "test", calcuate_zip_hash(bytes("", "utf-8")))
+        grade.assert_called_once()
+        assert service.job_queue.size() == 0
+        assert not worker.run_once()
+        service.result_writer.flush()
+        with service.session() as session:
+            assert session.query(Result).first().user == "user"
+
+    @patch("livefeedback_hub.worker.manage_executor.submit", side_effect=run_directly)
+    @patch("livefeedback_hub.worker.build")
+    def test_build(self, build: MagicMock, submit: MagicMock, tmp_path):
+        service = JupyterService(db_url=f"sqlite:///{tmp_path / 'data.db'}", execution_backend="worker")
+        service.job_queue.put_build("test", "digest", update=True)
+        assert Worker(service).run_once()
+        build.assert_called_once_with(service, "test", "digest", update=True)
+        assert service.job_queue.size() == 0
+
+    @patch("livefeedback_hub.worker.build")
+    def test_build_heartbeat(self, build: MagicMock, tmp_path):
+        service = JupyterService(db_url=f"sqlite:///{tmp_path / 'data.db'}", execution_backend="worker", scheduler_stale_timeout=60)
+        finished = threading.Event()
+        build.side_effect = lambda *args, **kwargs: finished.wait(5)
+        service.job_queue.put_build("test", "digest")
+        worker = Worker(service)
+        assert worker.run_once()
+        try:
+            assert worker.heartbeat() == 0
+            with service.session() as session:
+                session.query(Job).update({"claimed_at": datetime.datetime.utcnow() - datetime.timedelta(seconds=120)})
+            # The running build keeps its claim although it takes longer than the stale timeout
+            assert worker.heartbeat(force=True) == 1
+            assert service.job_queue.claim("other") is None
+        finally:
+            finished.set()
+        # Wait for the build to release its slot
+        for _ in range(service.worker_concurrency):
+            assert worker._slots.acquire(timeout=5)
+        assert worker.heartbeat(force=True) == 0
+        assert service.job_queue.size() == 0
+
+
+class TestWorkerSubmissionHandler(AsyncHTTPTestCase):
+    service = JupyterService(xsrf_cookies=False, execution_backend="worker")
+
+    def get_app(self):
+        return self.service.app
+
+    def tearDown(self):
+        with self.service.session() as session:
+            session.query(AutograderZip).delete()
+            session.query(Job).delete()
+
+        super().tearDown()
+
+    @patch("jupyterhub.services.auth.HubAuthenticated.get_current_user")
+    @patch("livefeedback_hub.handlers.submission.submission_executor.submit")
+    def test_submit(self, submit: MagicMock, get_current_user_mock: MagicMock):
+        get_current_user_mock.return_value = {"name": "student"}
+        with self.service.session() as session:
+            zip = AutograderZip(id="333e2069-612e-4e0c-a4ac-e6ec1eaa44f0", description="Test", state=State.ready,
+                                digest=calcuate_zip_hash(bytes("Old", "utf-8")),
+                                owner=get_user_hash(get_current_user_mock.return_value))
+            session.add(zip)
+
+        response = self.fetch("/submit", method="POST", body=notebook)
+        assert response.code == 200
+        submit.assert_not_called()
+        job = self.service.job_queue.claim("worker")
+        assert job.user == get_user_hash(get_current_user_mock.return_value)
+        assert job.assignment == "333e2069-612e-4e0c-a4ac-e6ec1eaa44f0"
+        assert job.zip_digest == calcuate_zip_hash(bytes("Old", "utf-8"))
+        assert job.notebook == notebook.encode()